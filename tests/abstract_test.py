@@ -7,6 +7,11 @@ logger = logging.getLogger(__name__)
 #logging.getLogger('tulip').setLevel(logging.ERROR)
 logger.setLevel(logging.DEBUG)
 
+import os
+import shutil
+import tempfile
+import cPickle as pickle
+
 from nose.tools import assert_raises
 
 import matplotlib
@@ -14,6 +19,7 @@ import matplotlib
 matplotlib.use('Agg')
 
 import numpy as np
+from scipy import sparse as sp
 
 from tulip import abstract, hybrid
 import polytope as pc
@@ -172,6 +178,810 @@ def test_transient_regions():
     #ax = ab.plot(show_ts=True)
     #ax.figure.savefig('./very_simple.pdf')
 
+def test_worklist_order():
+    """sparse worklist visits pairs as np.nonzero on a dense matrix"""
+    from tulip.abstract.discretization import (
+        _SparseRelation, _Worklist, _reachable_within, reachable_within
+    )
+    
+    dense = np.array([[1, 1, 0, 0],
+                      [1, 1, 1, 0],
+                      [0, 1, 1, 1],
+                      [0, 0, 1, 1]])
+    adj = _SparseRelation.from_matrix(dense)
+    assert(len(adj) == np.sum(dense))
+    assert(np.all(adj.to_lil().todense() == dense))
+    
+    power = np.dot(dense, dense) > 0
+    for i in xrange(4):
+        assert(_reachable_within(2, adj, i) == set(np.nonzero(power[i])[0]))
+    # dense version
+    assert(np.all(reachable_within(2, dense, dense) == power))
+    
+    IJ = _Worklist(4)
+    for r, c in [(2, 1), (0, 3), (2, 0), (0, 1)]:
+        IJ.add(r, c)
+    IJ.remove(0, 3)
+    IJ.grow(1)
+    IJ.add(4, 0)
+    popped = []
+    while IJ:
+        popped.append(IJ.pop())
+    assert(popped == [(0, 1), (2, 0), (2, 1), (4, 0)])
+    
+    # by key, re-added pairs with their new key
+    key = {(0, 1):3, (2, 0):1, (2, 1):2}
+    IJ = _Worklist(3)
+    for pair in key:
+        IJ.add(*pair)
+    IJ.set_key(lambda r, c: key[(r, c)])
+    assert(IJ.peek(2) == [(2, 0), (2, 1)])
+    IJ.remove(2, 0)
+    key[(2, 0)] = 4
+    IJ.add(2, 0)
+    popped = []
+    while IJ:
+        popped.append(IJ.pop())
+    assert(popped == [(2, 1), (0, 1), (2, 0)])
+    
+    # removed pairs do not accumulate in the heap
+    IJ = _Worklist(10)
+    for r in xrange(10):
+        for c in xrange(10):
+            IJ.add(r, c)
+    for r in xrange(10):
+        for c in xrange(1, 10):
+            IJ.remove(r, c)
+    assert(len(IJ._heap) <= 2 * len(IJ))
+    assert([IJ.pop() for k in xrange(10)] == [(r, 0) for r in xrange(10)])
+
+def square_system(u=0.5, A=None, props=None):
+    """Return partition and dynamics over the square [0, 2]^2.
+    
+    @param u: inputs range over [-u, u]^2
+    @param A: system matrix, by default the identity
+    @param props: continuous propositions,
+        by default 'goal' over [1, 2]^2
+    
+    @return: C{(dom, ppp, sys)}
+    """
+    dom = pc.box2poly([[0.0, 2.0], [0.0, 2.0]])
+    if props is None:
+        props = {'goal': pc.box2poly([[1.0, 2.0], [1.0, 2.0]])}
+    ppp = abstract.prop2part(dom, props)
+    ppp, new2old_reg = abstract.part2convex(ppp)
+    
+    if A is None:
+        A = np.eye(2)
+    U = pc.box2poly([[-u, u], [-u, u]])
+    sys = hybrid.LtiSysDyn(A, np.eye(2), None, None, U, None, dom)
+    return dom, ppp, sys
+
+def test_discretize_n_jobs():
+    """parallel discretize yields the same abstraction as serial"""
+    dom, ppp, sys = square_system()
+    
+    ab1 = abstract.discretize(ppp, sys, N=1, min_cell_volume=0.2)
+    ab2 = abstract.discretize(ppp, sys, N=1, min_cell_volume=0.2, n_jobs=2)
+    
+    assert(len(ab1.ppp) == len(ab2.ppp))
+    assert(set(ab1.ts.transitions()) == set(ab2.ts.transitions()))
+    for r1, r2 in zip(ab1.ppp, ab2.ppp):
+        assert(r1 == r2)
+
+def test_discretize_budget():
+    """discretize within budgets returns a sound coarser abstraction"""
+    dom, ppp, sys = square_system()
+    
+    full = abstract.discretize(ppp, sys, N=1, min_cell_volume=0.2)
+    assert(full.stats['stopped'] is None)
+    assert(full.stats['unexplored'] == [])
+    
+    ab = abstract.discretize(ppp, sys, N=1, min_cell_volume=0.2,
+                             max_iterations=5, priority='props')
+    assert(ab.stats['stopped'] == 'max_iterations')
+    assert(ab.stats['n_checked'] == 5)
+    assert(ab.stats['unexplored'])
+    
+    ab = abstract.discretize(ppp, sys, N=1, min_cell_volume=0.2,
+                             time_budget=0.0)
+    assert(ab.stats['stopped'] == 'time_budget')
+    assert(len(ab.ppp) == len(ppp))
+    assert(not ab.ts.transitions())
+    
+    ab = abstract.discretize(ppp, sys, N=1, min_cell_volume=0.2,
+                             max_cells=len(ppp) + 2, priority='volume')
+    assert(ab.stats['stopped'] is None)
+    assert(ab.stats['n_not_split'] > 0)
+    assert(len(ab.ppp) < len(full.ppp))
+    # transitions found hold for the whole cells
+    for i, j in ab.ts.transitions():
+        trans_set = ab.pwa_ppp[ab._ppp2pwa[i]][0]
+        s0 = abstract.solve_feasible(ab.ppp[i], ab.ppp[j], sys, N=1,
+                                     trans_set=trans_set)
+        assert(ab.ppp[i].diff(s0).volume < 1e-7)
+    
+    with assert_raises(ValueError):
+        abstract.discretize(ppp, sys, priority='area')
+
+def test_discretize_resume():
+    """discretize resumed from a checkpoint completes the abstraction"""
+    dom, ppp, sys = square_system()
+    
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmp_dir, 'discretize.ckpt')
+        ab1 = abstract.discretize(ppp, sys, N=1, min_cell_volume=0.2,
+                                  checkpoint=fname)
+        
+        # simulate interruption, including a partially written record
+        size = os.path.getsize(fname)
+        with open(fname, 'r+b') as f:
+            f.truncate(size // 2)
+        
+        ab2 = abstract.discretize(ppp, sys, N=1, min_cell_volume=0.2,
+                                  checkpoint=fname, resume_from=fname)
+        
+        assert(len(ab1.ppp) == len(ab2.ppp))
+        assert(set(ab1.ts.transitions()) == set(ab2.ts.transitions()))
+        for r1, r2 in zip(ab1.ppp, ab2.ppp):
+            assert(r1 == r2)
+        
+        with assert_raises(ValueError):
+            abstract.discretize(ppp, sys, N=2, min_cell_volume=0.2,
+                                resume_from=fname)
+        
+        # same number of regions, other dynamics
+        sys2 = hybrid.LtiSysDyn(np.eye(2), 2 * np.eye(2), None, None,
+                                sys.Uset, None, dom)
+        with assert_raises(ValueError):
+            abstract.discretize(ppp, sys2, N=1, min_cell_volume=0.2,
+                                resume_from=fname)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_abstraction_save_load():
+    """saved abstractions are loaded with the same regions and ts"""
+    dom, ppp, sys = square_system()
+    ab = abstract.discretize(ppp, sys, N=1, min_cell_volume=0.2)
+    
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmp_dir, 'ab.npz')
+        ab.save(fname)
+        for mmap in (True, False):
+            ab2 = abstract.AbstractPwa.load(fname, mmap=mmap)
+            assert(len(ab2.ppp) == len(ab.ppp))
+            for r1, r2 in zip(ab.ppp, ab2.ppp):
+                assert(r1 == r2)
+                assert(r1.props == r2.props)
+            assert(np.all(ab2.ppp.adj.todense() == ab.ppp.adj.todense()))
+            assert(ab2.ppp2ts == ab.ppp2ts)
+            assert(ab2.disc_params == ab.disc_params)
+            for i in xrange(len(ab.ppp)):
+                assert(ab2.ppp2pwa(i)[0] == ab.ppp2pwa(i)[0])
+                assert(ab2.ppp2orig(i)[0] == ab.ppp2orig(i)[0])
+                assert(ab2.ppp2sys(i)[0] == ab.ppp2sys(i)[0])
+            assert(set(ab2.ts.transitions()) == set(ab.ts.transitions()))
+            for s in ab.ts.states:
+                assert(ab2.ts.states[s]['ap'] == ab.ts.states[s]['ap'])
+            ax = ab2.plot(show_ts=True, only_adjacent=True)
+            assert(ax is not None)
+        
+        # pickled before save and load existed
+        state = dict(ab.__dict__)
+        state['ts'] = state.pop('_ts')
+        del state['_ts_loader']
+        del state['stats']
+        ab3 = abstract.AbstractPwa.__new__(abstract.AbstractPwa)
+        ab3.__setstate__(state)
+        assert(set(ab3.ts.transitions()) == set(ab.ts.transitions()))
+        assert(ab3.stats == dict())
+        
+        sw = abstract.AbstractSwitched(
+            ppp=ab.ppp, ts=ab.ts, ppp2ts=ab.ppp2ts,
+            modes={('e', 's'): ab},
+            ppp2modes={('e', 's'): range(len(ab.ppp))})
+        sw.save(fname)
+        sw2 = abstract.AbstractSwitched.load(fname)
+        assert(sw2.modes.keys() == [('e', 's')])
+        assert(sw2.ppp2modes == sw.ppp2modes)
+        assert(set(sw2.ts.transitions()) ==
+               set(sw2.modes[('e', 's')].ts.transitions()))
+        axs = sw2.plot(show_ts=True)
+        assert(len(axs) == 2)
+        with assert_raises(ValueError):
+            abstract.AbstractPwa.load(fname)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_abstraction_cache():
+    """abstractions are computed again only if their inputs change"""
+    dom, ppp, sys = square_system()
+    
+    cache_dir = tempfile.mkdtemp()
+    try:
+        ab1 = abstract.discretize(ppp, sys, N=1, min_cell_volume=0.2,
+                                  cache_dir=cache_dir)
+        assert(len(os.listdir(cache_dir)) == 1)
+        ab2 = abstract.discretize(ppp, sys, N=1, min_cell_volume=0.2,
+                                  cache_dir=cache_dir, n_jobs=1)
+        assert(isinstance(ab2.ppp, abstract.PackedPartition))
+        assert(len(ab1.ppp) == len(ab2.ppp))
+        assert(set(ab1.ts.transitions()) == set(ab2.ts.transitions()))
+        assert(len(os.listdir(cache_dir)) == 1)
+        
+        abstract.discretize(ppp, sys, N=2, min_cell_volume=0.2,
+                            cache_dir=cache_dir)
+        assert(len(os.listdir(cache_dir)) == 2)
+        
+        # switched systems reuse the abstraction of each mode
+        modes = [('a', 'x'), ('a', 'y')]
+        U2 = pc.box2poly([[-0.2, 0.2], [-0.2, 0.2]])
+        sys2 = hybrid.LtiSysDyn(np.eye(2), np.eye(2), None, None, U2, None,
+                                dom)
+        switched = hybrid.SwitchedSysDyn(
+            disc_domain_size=(1, 2),
+            dynamics={modes[0]:hybrid.PwaSysDyn([sys], dom),
+                      modes[1]:hybrid.PwaSysDyn([sys2], dom)},
+            env_labels=['a'], disc_sys_labels=['x', 'y'],
+            cts_ss=dom)
+        disc_params = {
+            mode:{'N':1, 'trans_length':1, 'min_cell_volume':0.5}
+            for mode in modes}
+        sw1 = abstract.discretize_switched(ppp, switched, disc_params,
+                                           cache_dir=cache_dir)
+        # merged and each mode
+        assert(len(os.listdir(cache_dir)) == 5)
+        sw2 = abstract.discretize_switched(ppp, switched, disc_params,
+                                           cache_dir=cache_dir)
+        assert(len(os.listdir(cache_dir)) == 5)
+        assert(isinstance(sw1.ppp, abstract.PropPreservingPartition))
+        assert(isinstance(sw2.ppp, abstract.PropPreservingPartition))
+        assert(set(sw1.ts.transitions()) == set(sw2.ts.transitions()))
+        for mode in modes:
+            ts1 = sw1.modes[mode].ts
+            ts2 = sw2.modes[mode].ts
+            assert(set(ts1.transitions()) == set(ts2.transitions()))
+        
+        # merged and mode ('a', 'y')
+        disc_params[modes[1]]['N'] = 2
+        abstract.discretize_switched(ppp, switched, disc_params,
+                                     cache_dir=cache_dir)
+        assert(len(os.listdir(cache_dir)) == 7)
+        
+        # incomplete abstractions are not cached
+        disc_params[modes[1]]['max_iterations'] = 2
+        abstract.discretize_switched(ppp, switched, disc_params,
+                                     cache_dir=cache_dir)
+        assert(len(os.listdir(cache_dir)) == 7)
+        del disc_params[modes[1]]['max_iterations']
+        disc_params[modes[1]]['priority'] = lambda si, sj: 0
+        abstract.discretize_switched(ppp, switched, disc_params,
+                                     cache_dir=cache_dir)
+        assert(len(os.listdir(cache_dir)) == 7)
+        del disc_params[modes[1]]['priority']
+        
+        cache = abstract.AbstractionCache(cache_dir, max_disk_bytes=1)
+        cache.put('a', ab1)
+        assert(cache.stats['evictions'] == 8)
+        assert(cache.get('a') is None)
+        assert(cache.stats['misses'] == 1)
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_multiproc_merge_partitions():
+    """tree merge of partitions equals sequential merge"""
+    from tulip.abstract.discretization import (
+        merge_partitions, multiproc_merge_partitions, _TaskPool)
+    
+    dom, ppp, sys = square_system(u=0.3)
+    U = sys.Uset
+    abstractions = dict()
+    for k, K in enumerate([[0.2, 0.0], [0.0, 0.2], [-0.2, -0.2]]):
+        K = np.array(K).reshape(2, 1)
+        sys = hybrid.LtiSysDyn(np.eye(2), np.eye(2), None, K, U, None, dom)
+        abstractions[('e', str(k))] = abstract.discretize(
+            ppp, sys, N=1, min_cell_volume=0.3)
+    
+    ab1, labels1 = merge_partitions(abstractions)
+    pool = _TaskPool(2)
+    try:
+        results = [
+            multiproc_merge_partitions(abstractions, 1),
+            multiproc_merge_partitions(abstractions, 2),
+            multiproc_merge_partitions(abstractions, pool=pool)]
+    finally:
+        pool.close()
+    for ab2, labels2 in results:
+        assert(len(ab2.ppp) == len(ab1.ppp))
+        for r1, r2 in zip(ab1.ppp, ab2.ppp):
+            assert(r1 == r2)
+            assert(r1.props == r2.props)
+        assert(ab2.ppp2modes == ab1.ppp2modes)
+        assert(labels2 == labels1)
+        assert((ab2.ppp.adj != ab1.ppp.adj).nnz == 0)
+    
+    # transitions over the merged partition
+    from tulip.abstract.discretization import get_transitions
+    mode = ('e', '0')
+    n = len(ab1.ppp)
+    for trans_length in (1, 2):
+        t1 = get_transitions(ab1, mode, None, N=1,
+                             trans_length=trans_length)
+        t2 = get_transitions(ab1, mode, None, N=1,
+                             trans_length=trans_length,
+                             n_jobs=2, chunk_size=5)
+        assert(sp.issparse(t1))
+        assert((t1 != t2).nnz == 0)
+        
+        # candidates are the pairs within trans_length steps
+        adj = ab1.ppp.adj.toarray()
+        reach = np.linalg.matrix_power(adj, trans_length) > 0
+        for i, j in zip(*t1.nonzero()):
+            assert(reach[j, i])
+        assert(t1.nnz > n)
+    
+    # one pool and one file for all modes
+    tmp_dir = tempfile.mkdtemp()
+    fname = os.path.join(tmp_dir, 'merged.npz')
+    ab1.save(fname)
+    pool = _TaskPool(2)
+    try:
+        for mode in abstractions:
+            t1 = get_transitions(ab1, mode, None, N=1)
+            t2 = get_transitions(ab1, mode, None, N=1, chunk_size=5,
+                                 pool=pool, fname=fname)
+            assert((t1 != t2).nnz == 0)
+    finally:
+        pool.close()
+        shutil.rmtree(tmp_dir)
+
+def test_multiproc_discretize_switched():
+    """parallel discretize_switched yields the same abstraction"""
+    dom, ppp, sys = square_system(u=0.3)
+    U = sys.Uset
+    modes = [('a', 'x'), ('a', 'y')]
+    dynamics = dict()
+    for mode, K in zip(modes, [[0.2, 0.0], [0.0, -0.2]]):
+        K = np.array(K).reshape(2, 1)
+        sys = hybrid.LtiSysDyn(np.eye(2), np.eye(2), None, K, U, None, dom)
+        dynamics[mode] = hybrid.PwaSysDyn([sys], dom)
+    switched = hybrid.SwitchedSysDyn(
+        disc_domain_size=(1, 2), dynamics=dynamics,
+        env_labels=['a'], disc_sys_labels=['x', 'y'], cts_ss=dom)
+    disc_params = {
+        mode:{'N':1, 'trans_length':1, 'min_cell_volume':0.5}
+        for mode in modes}
+    
+    sw1 = abstract.discretize_switched(ppp, switched, disc_params)
+    sw2 = abstract.multiproc_discretize_switched(
+        ppp, switched, disc_params, n_jobs=2)
+    assert(len(sw1.ppp) == len(sw2.ppp))
+    for r1, r2 in zip(sw1.ppp, sw2.ppp):
+        assert(r1 == r2)
+    edges1 = {(i, j, d['sys_actions'])
+              for i, j, d in sw1.ts.transitions(data=True)}
+    edges2 = {(i, j, d['sys_actions'])
+              for i, j, d in sw2.ts.transitions(data=True)}
+    assert(edges1 == edges2)
+    
+    # workers are daemons, so modes are abstracted serially
+    for params in disc_params.itervalues():
+        params['n_jobs'] = 2
+    sw3 = abstract.multiproc_discretize_switched(
+        ppp, switched, disc_params, n_jobs=2)
+    assert(len(sw3.ppp) == len(sw1.ppp))
+    
+    disc_params[modes[0]]['checkpoint'] = 'mode0.ckpt'
+    with assert_raises(ValueError):
+        abstract.multiproc_discretize_switched(
+            ppp, switched, disc_params, n_jobs=2)
+    assert(not os.path.exists('mode0.ckpt'))
+
+def _fail_task(x):
+    if x == 2:
+        raise ValueError('bad task')
+    return x + 1
+
+def _exit_task(x):
+    if x == 2:
+        os._exit(3)
+    return x + 1
+
+def test_task_pool():
+    """worker pool returns results in order and surfaces failures"""
+    from tulip.abstract.discretization import _TaskPool
+    
+    pool = _TaskPool(2, poll=0.1)
+    try:
+        assert(pool.map(_fail_task, [(0,), (1,), (3,)]) == [1, 2, 4])
+        with assert_raises(RuntimeError):
+            pool.map(_fail_task, [(0,), (2,)])
+    finally:
+        pool.close()
+    
+    pool = _TaskPool(2, poll=0.1)
+    try:
+        with assert_raises(RuntimeError):
+            pool.map(_exit_task, [(k,) for k in xrange(4)])
+    finally:
+        pool.close()
+
+def test_feasibility_cache():
+    """solve_feasible results are memoized in memory and on disk"""
+    dom, ppp, sys = square_system()
+    p1 = pc.box2poly([[0.0, 1.0], [0.0, 1.0]])
+    p2 = pc.box2poly([[1.0, 2.0], [0.0, 1.0]])
+    
+    # disabled by default
+    assert(abstract.feasible.cache is None)
+    old_cache = abstract.feasible.cache
+    cache_dir = tempfile.mkdtemp()
+    try:
+        abstract.feasible.cache = abstract.FeasibilityCache(
+            maxsize=1, cache_dir=cache_dir)
+        cache = abstract.feasible.cache
+        
+        s1 = abstract.solve_feasible(p1, p2, sys, N=1)
+        s2 = abstract.solve_feasible(p1, p2, sys, N=1)
+        assert(cache.stats['misses'] == 1)
+        assert(cache.stats['hits'] == 1)
+        # shared, not copied
+        assert(s1 is s2)
+        
+        # evicts p1 ---> p2 from memory, not disk
+        abstract.solve_feasible(p2, p1, sys, N=1)
+        assert(cache.stats['evictions'] == 1)
+        s3 = abstract.solve_feasible(p1, p2, sys, N=1)
+        assert(cache.stats['disk_hits'] == 1)
+        assert(s1 == s3)
+        
+        # different horizon: a new key
+        abstract.solve_feasible(p1, p2, sys, N=2)
+        assert(cache.stats['misses'] == 3)
+        assert(len(os.listdir(cache_dir)) == 3)
+        
+        # propositions are not part of the key
+        r1 = pc.Region([p1], ['a'])
+        r2 = pc.Region([p2], ['b'])
+        s4 = abstract.solve_feasible(r1, r2, sys, N=1)
+        assert(cache.stats['misses'] == 3)
+        assert(s1 == s4)
+    finally:
+        abstract.feasible.cache = old_cache
+        shutil.rmtree(cache_dir)
+
+def test_feasibility_cache_argument():
+    """a FeasibilityCache passed to discretize reaches its workers"""
+    dom, ppp, sys = square_system()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = abstract.FeasibilityCache(cache_dir=cache_dir)
+        
+        # only the settings are pickled
+        c = pickle.loads(pickle.dumps(cache))
+        assert(c is pickle.loads(pickle.dumps(cache)))
+        assert(c.cache_dir == cache_dir)
+        
+        ab = abstract.discretize(ppp, sys, N=1, min_cell_volume=0.2,
+                                 feasibility_cache=cache)
+        assert(abstract.feasible.cache is None)
+        n = cache.stats['misses']
+        assert(n > 0)
+        assert(len(os.listdir(cache_dir)) == n)
+        
+        # workers share the disk tier
+        cache.clear()
+        ab2 = abstract.discretize(ppp, sys, N=1, min_cell_volume=0.2,
+                                  n_jobs=2, feasibility_cache=cache)
+        assert(len(os.listdir(cache_dir)) >= n)
+        assert(set(ab.ts.transitions()) == set(ab2.ts.transitions()))
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_closed_loop_chain_cache():
+    """backward reachable sets are shared by cells of one trans_set"""
+    dom = pc.box2poly([[0.0, 4.0], [0.0, 2.0]])
+    U = pc.box2poly([[-0.5, 0.5], [-0.5, 0.5]])
+    sys = hybrid.LtiSysDyn(np.eye(2), np.eye(2), None, None, U, None, dom)
+    trans_set = pc.box2poly([[0.0, 3.0], [0.0, 2.0]])
+    a = pc.box2poly([[0.0, 1.0], [0.0, 2.0]])
+    b = pc.box2poly([[1.0, 2.0], [0.0, 2.0]])
+    target = pc.box2poly([[3.0, 4.0], [0.0, 2.0]])
+    
+    # default settings
+    assert(abstract.feasible.cache is None)
+    chains = abstract.feasible._chains
+    chains.clear()
+    sa = abstract.solve_feasible(a, target, sys, N=3, trans_set=trans_set)
+    # 2 steps within trans_set
+    assert(chains.stats['misses'] == 2)
+    sb = abstract.solve_feasible(b, target, sys, N=3, trans_set=trans_set)
+    assert(chains.stats['misses'] == 2)
+    assert(chains.stats['hits'] == 2)
+    
+    # same sets as computed without sharing
+    chains.clear()
+    assert(abstract.solve_feasible(b, target, sys, N=3,
+                                   trans_set=trans_set) == sb)
+    assert(chains.stats['hits'] == 0)
+    
+    # cells split from one cell share them in discretize
+    ppp = abstract.prop2part(dom, {'goal':target})
+    ppp, new2old_reg = abstract.part2convex(ppp)
+    chains.clear()
+    abstract.discretize(ppp, sys, N=3, min_cell_volume=0.5)
+    assert(chains.stats['hits'] > 0)
+
+def test_compile_dynamics():
+    """compiled dynamics are reused until the system is modified"""
+    from tulip.abstract.feasible import compile_dynamics, createLM
+    
+    dom = pc.box2poly([[0.0, 2.0], [0.0, 2.0]])
+    U = pc.box2poly([[-0.5, 0.5], [-0.5, 0.5]])
+    W = pc.box2poly([[-0.1, 0.1], [-0.1, 0.1]])
+    sys = hybrid.LtiSysDyn(np.eye(2), np.eye(2), np.eye(2), None, U, W, dom)
+    
+    cd = compile_dynamics(sys, 3)
+    assert(compile_dynamics(sys, 3) is cd)
+    assert(compile_dynamics(sys, 2) is not cd)
+    
+    p = pc.box2poly([[0.0, 1.0], [0.0, 1.0]])
+    L, M = createLM(sys, 3, p, p, p)
+    assert(L.shape == (4*4 + 4*3, 2 + 2*3))
+    
+    sys.A = 2 * np.eye(2)
+    assert(compile_dynamics(sys, 3) is not cd)
+    L2, M2 = createLM(sys, 3, p, p, p)
+    assert(not np.allclose(L, L2))
+
+def test_may_reach():
+    """pairs rejected by may_reach have no reachable subset"""
+    from tulip.abstract.feasible import may_reach
+    
+    dom = pc.box2poly([[-4.0, 4.0], [-4.0, 4.0]])
+    U = pc.box2poly([[-0.1, 0.1], [-0.1, 0.1]])
+    K = np.array([[1.0], [0.0]])
+    sys = hybrid.LtiSysDyn(np.eye(2), np.eye(2), None, K, U, None, dom)
+    
+    p0 = pc.box2poly([[0.0, 1.0], [0.0, 1.0]])
+    left = pc.box2poly([[-1.0, 0.0], [0.0, 1.0]])
+    right = pc.box2poly([[1.0, 2.0], [0.0, 1.0]])
+    far = pc.box2poly([[3.0, 4.0], [0.0, 1.0]])
+    
+    assert(may_reach(p0, right, sys, 1))
+    assert(not may_reach(p0, left, sys, 1))
+    assert(not may_reach(p0, far, sys, 1))
+    assert(may_reach(p0, far, sys, 3, trans_set=dom))
+    
+    # intermediate states must remain in trans_set
+    assert(not may_reach(p0, far, sys, 3))
+    
+    s0 = abstract.solve_feasible(p0, left, sys, N=1)
+    assert(not pc.is_fulldim(p0.intersect(s0)))
+
+def test_region_index():
+    """RegionIndex finds the same neighbors as pairwise checks"""
+    from tulip.abstract.spatial import RegionIndex
+    
+    regions = [
+        pc.box2poly([[x, x + 1.0], [y, y + 1.0]])
+        for x in xrange(6) for y in xrange(5)
+    ]
+    index = RegionIndex(regions, leaf_size=3)
+    assert(len(index) == 30)
+    
+    def brute(region):
+        return [k for k, r in enumerate(regions)
+                if pc.is_adjacent(region, r)]
+    
+    for region in regions:
+        near = index.query(region)
+        assert(set(brute(region)) <= set(near))
+        assert(len(near) <= 9)
+    
+    # split cell 7 and add a far cell
+    regions[7] = pc.box2poly([[1.0, 1.5], [2.0, 3.0]])
+    index.update(7, regions[7])
+    regions.append(pc.box2poly([[1.5, 2.0], [2.0, 3.0]]))
+    index.insert(30, regions[30])
+    regions.append(pc.box2poly([[10.0, 11.0], [0.0, 1.0]]))
+    index.insert(31, regions[31])
+    assert(index.query(regions[31]) == [31])
+    for region in regions:
+        assert(set(brute(region)) <= set(index.query(region)))
+    
+    for k in xrange(30):
+        index.remove(k)
+    assert(index.query(regions[7]) == [30])
+    assert(index.query_box([0.0, 0.0], [20.0, 20.0]) == [30, 31])
+    with assert_raises(ValueError):
+        index.insert(30, regions[30])
+
+def test_postarea_transitions():
+    """batched post areas agree with get_postarea"""
+    from tulip.abstract import discretization
+    
+    dom = pc.box2poly([[0.0, 4.0], [0.0, 3.0]])
+    regions = [
+        pc.Region([pc.box2poly([[x, x + 1.0], [y, y + 1.0]])], [])
+        for x in xrange(4) for y in xrange(3)
+    ]
+    ppp = abstract.PropPreservingPartition(
+        domain=dom, regions=regions, prop_regions={})
+    A = np.array([[0.9, 0.2], [-0.1, 0.8]])
+    K = np.array([[0.3], [0.2]])
+    E = np.eye(2)
+    W = pc.box2poly([[-0.1, 0.1], [-0.1, 0.1]])
+    U = pc.box2poly([[-1.0, 1.0], [-1.0, 1.0]])
+    sys = hybrid.LtiSysDyn(A, np.eye(2), E, K, U, W, dom)
+    
+    for N in (1, 2):
+        trans = discretization.get_postarea_transitions(ppp, sys, N)
+        assert(sp.issparse(trans))
+        assert(trans.shape == (12, 13))
+        
+        extp_d = pc.extreme(W)
+        for i, region in enumerate(regions):
+            post = discretization.get_postarea(region, sys, extp_d, N)
+            row = [int(not pc.is_empty(pc.intersect(post, r)))
+                   for r in regions]
+            row.append(int(not pc.is_empty(pc.mldivide(post, dom))))
+            assert(trans[i].toarray().flatten().tolist() == row)
+    
+    # chunks of regions in a pool of workers, partition shared in a file
+    sys2 = hybrid.LtiSysDyn(-A, np.eye(2), E, K, U, W, dom)
+    cont_dyn = {'a':sys, 'b':sys2}
+    trans = abstract.multiproc_postarea_transitions(
+        ['a', 'b'], ppp, cont_dyn, N=2, n_jobs=2, chunk_size=5)
+    for mode, dyn in cont_dyn.iteritems():
+        expected = discretization.get_postarea_transitions(ppp, dyn, 2)
+        assert(trans[mode].shape == (12, 13))
+        assert((trans[mode] != expected).nnz == 0)
+
+def test_region_geometry():
+    """geometric properties are memoized until a region changes"""
+    import pickle
+    from copy import deepcopy
+    from tulip.abstract.spatial import geometry
+    
+    p = pc.box2poly([[0.0, 2.0], [0.0, 1.0]])
+    q = pc.box2poly([[2.0, 3.0], [0.0, 1.0]])
+    r = pc.Region([p, q], ['a'])
+    
+    g = geometry(r)
+    assert(geometry(r) is g)
+    l, u = g.bounding_box
+    assert(np.allclose(l, [0.0, 0.0]) and np.allclose(u, [3.0, 1.0]))
+    assert(g.volume is geometry(r).volume)
+    assert(g.cheby_ball[0] == pc.cheby_ball(r)[0])
+    assert(g.extreme.shape == (8, 2))
+    assert(g.hull == pc.box2poly([[0.0, 3.0], [0.0, 1.0]]))
+    assert(g.digest != geometry(p).digest)
+    
+    # copies compute their own, assigned arrays are detected
+    r2 = deepcopy(r)
+    assert(geometry(r2) is not g)
+    assert(geometry(r2).digest == g.digest)
+    r3 = pickle.loads(pickle.dumps(r2))
+    assert(geometry(r3).digest == g.digest)
+    q.scale(2.0)
+    assert(geometry(r) is not g)
+    assert(geometry(r).digest != g.digest)
+    r.list_poly = [p]
+    assert(geometry(r).digest == geometry(p).digest)
+    assert(geometry(r).extreme.shape == (4, 2))
+
+def test_find_discrete_states():
+    """batch point location agrees with find_discrete_state"""
+    dom = pc.box2poly([[0.0, 4.0], [0.0, 3.0]])
+    regions = [
+        pc.Region([pc.box2poly([[x, x + 1.0], [y, y + 1.0]])])
+        for x in xrange(4) for y in xrange(3)
+    ]
+    # non-convex region
+    regions[0] = pc.Region([
+        pc.box2poly([[0.0, 1.0], [0.0, 1.0]]),
+        pc.Polytope(np.array([[-1.0, 0.0], [0.0, -1.0], [1.0, 1.0]]),
+                    np.array([-1.0, -1.0, 2.5]))
+    ])
+    ppp = abstract.PropPreservingPartition(domain=dom, regions=regions)
+    
+    np.random.seed(0)
+    x = np.random.uniform(-0.5, 4.5, size=(300, 2))
+    x[0] = [1.0, 1.0]
+    found = abstract.find_discrete_states(x, ppp)
+    for xi, k in zip(x, found):
+        k0 = abstract.find_discrete_state(xi, ppp)
+        if k0 is None:
+            assert(k == -1)
+        else:
+            assert(k == k0)
+    assert(found[0] == 0)
+    
+    locator = abstract.PointLocator(ppp)
+    assert(np.all(abstract.find_discrete_states(x, locator) == found))
+
+def test_compiled_controller():
+    """CompiledController.step agrees with get_input"""
+    cont_props = {'a':pc.box2poly([[0.0, 1.0], [0.0, 1.0]])}
+    dom, ppp, sys = square_system(props=cont_props)
+    ab = abstract.discretize(ppp, sys, N=2, min_cell_volume=0.5)
+    
+    controller = abstract.CompiledController(sys, ab)
+    for i, j in ab.ts.transitions():
+        rc, x = pc.cheby_ball(ab.ppp[i])
+        x = x.flatten()
+        u1 = abstract.get_input(x, sys, ab, i, j)
+        u2 = controller.step(x, i, j)
+        assert(u2.shape == (2, 2))
+        assert(np.allclose(u1, u2, atol=1e-5))
+        
+        # warm-started
+        u3 = controller.step(x, i, j)
+        assert(np.allclose(u1, u3, atol=1e-5))
+
+def test_get_input_batch():
+    """get_input_batch agrees with get_input, serially and in parallel"""
+    cont_props = {'a':pc.box2poly([[0.0, 1.0], [0.0, 1.0]])}
+    dom, ppp, sys = square_system(props=cont_props)
+    ab = abstract.discretize(ppp, sys, N=2, min_cell_volume=0.5)
+    
+    i, j = sorted(ab.ts.transitions())[-1]
+    l, u = ab.ppp[i].bounding_box
+    np.random.seed(0)
+    X0 = np.random.uniform(l.flatten(), u.flatten(), size=(6, 2))
+    # outside of the domain
+    X0[-1] = [10.0, 10.0]
+    
+    U1, feasible1 = abstract.get_input_batch(X0, sys, ab, i, j)
+    U2, feasible2 = abstract.get_input_batch(X0, sys, ab, i, j, n_jobs=2)
+    assert(U1.shape == (6, 2, 2))
+    assert(not feasible1[-1])
+    assert(np.any(feasible1))
+    assert(np.all(feasible1 == feasible2))
+    assert(np.allclose(U1, U2, atol=1e-5))
+    for x, u, feasible in zip(X0, U1, feasible1):
+        if feasible:
+            assert(np.allclose(u, abstract.get_input(x, sys, ab, i, j),
+                               atol=1e-5))
+
+def test_explicit_control_law():
+    """explicit control law agrees with CompiledController"""
+    A = np.array([[1.0, 0.2], [0.0, 1.0]])
+    cont_props = {'a':pc.box2poly([[0.0, 1.0], [0.0, 1.0]])}
+    dom, ppp, sys = square_system(A=A, props=cont_props)
+    ab = abstract.discretize(ppp, sys, N=2, min_cell_volume=0.5)
+    
+    law = abstract.explicit_control_law(sys, ab)
+    controller = abstract.CompiledController(sys, ab)
+    
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmp_dir, 'law.npz')
+        law.save(fname)
+        law2 = abstract.ExplicitController.load(fname)
+    finally:
+        shutil.rmtree(tmp_dir)
+    assert(len(law2) == len(law))
+    
+    np.random.seed(0)
+    for i, j in ab.ts.transitions():
+        cell = ab.ppp[i]
+        l, u = cell.bounding_box
+        for k in xrange(5):
+            x = np.random.uniform(l.flatten(), u.flatten())
+            if not pc.is_inside(cell, x):
+                continue
+            u0 = controller.step(x, i, j)[0]
+            assert(np.allclose(law.control(x, i, j), u0, atol=1e-3))
+            assert(np.allclose(law2.control(x, i, j), u0, atol=1e-3))
+    
+    # abstraction without transition system
+    empty = abstract.AbstractPwa(ppp=ab.ppp, disc_params=ab.disc_params)
+    assert(len(abstract.explicit_control_law(sys, empty)) == 0)
+
 def define_partition(dom):
     p = dict()
     p['a'] = pc.box2poly([[0.0, 10.0], [15.0, 18.0]])
@@ -3,9 +3,15 @@
 Tests for abstract.prop2partition
 """
 
-from tulip.abstract import prop2part
+import os
+import shutil
+import tempfile
+
+from tulip.abstract import prop2part, prop2part_arrangement, add_grid
+from tulip.abstract import PackedPartition, find_discrete_states
 import polytope as pc
 import numpy as np
+from scipy.spatial import ConvexHull
 
 def prop2part_test():
     state_space = pc.Polytope.from_box(np.array([[0., 2.],[0., 2.]]))
@@ -58,3 +64,136 @@ def prop2part_test():
     # invalidate it
     mypartition.regions += [pc.Region([pc.Polytope(A[0], b[0])], {})]
     assert(not mypartition.preserves_predicates())
+
+def prop2part_arrangement_test():
+    state_space = pc.box2poly([[0., 4.], [0., 3.]])
+    cont_props_dict = {
+        'a':pc.box2poly([[0., 1.], [0., 1.]]),
+        'b':pc.box2poly([[0.5, 2.5], [0.5, 2.]]),
+        # triangle
+        'c':pc.Polytope(np.array([[1., 1.], [-1., 0.], [0., -1.]]),
+                        np.array([6., -2., -1.])),
+        # two boxes
+        'd':pc.Region([pc.box2poly([[3., 4.], [0., 1.]]),
+                       pc.box2poly([[3., 4.], [2., 3.]])])
+    }
+    ppp = prop2part_arrangement(state_space, cont_props_dict)
+    
+    # convex cells
+    assert all(len(r) == 1 for r in ppp.regions)
+    
+    # cells cover the domain, labels agree with the propositions
+    np.random.seed(0)
+    for x in np.random.uniform([0., 0.], [4., 3.], size=(200, 2)):
+        found = [r for r in ppp.regions if pc.is_inside(r, x)]
+        assert len(found) == 1
+        props = {p for p, s in cont_props_dict.iteritems()
+                 if pc.is_inside(s, x)}
+        assert found[0].props == props
+    
+    # cells are adjacent if they share a facet
+    n = len(ppp.regions)
+    for i in xrange(n):
+        for j in xrange(n):
+            adj = (i == j) or _facet_length(
+                ppp.regions[i][0], ppp.regions[j][0]) > 1e-2
+            assert ppp.adj[i, j] == adj
+    
+    # proposition preserving
+    assert ppp.preserves_predicates()
+
+def _facet_length(p, q, eps=1e-3):
+    """Return length of intersection of 2d polytopes."""
+    r = pc.Polytope(np.vstack([p.A, q.A]),
+                    np.hstack([p.b.flatten() + eps, q.b.flatten()]))
+    if not pc.is_fulldim(r):
+        return 0.
+    return ConvexHull(pc.extreme(r)).volume / eps
+
+def add_grid_test():
+    state_space = pc.box2poly([[0., 3.], [0., 2.]])
+    cont_props_dict = {
+        'a':pc.box2poly([[0., 1.], [0., 1.]]),
+        # not aligned with the grid
+        'b':pc.Polytope(np.array([[1., 1.], [-1., 0.], [0., -1.]]),
+                        np.array([4.3, -1.5, -0.2]))
+    }
+    ppp = prop2part(state_space, cont_props_dict)
+    grid = add_grid(ppp, num_grid_pnts=[6, 4])
+    
+    assert len(grid.regions) > 24
+    np.random.seed(0)
+    for x in np.random.uniform([0., 0.], [3., 2.], size=(100, 2)):
+        found = [r for r in grid.regions if pc.is_inside(r, x)]
+        assert len(found) == 1
+        # within one grid box
+        assert np.all(np.diff(found[0].bounding_box, axis=0) <= 0.5 + 1e-7)
+        props = {p for p, s in cont_props_dict.iteritems()
+                 if pc.is_inside(s, x)}
+        assert found[0].props == props
+    
+    adj = pc.find_adjacent_regions(grid)
+    assert np.all(grid.adj.todense() == adj.todense())
+    
+    # 3 dimensions
+    state_space = pc.box2poly([[0., 1.], [0., 1.], [0., 1.]])
+    ppp = prop2part(state_space,
+                    {'c':pc.box2poly([[0., 0.5], [0., 1.], [0., 1.]])})
+    grid = add_grid(ppp, grid_size=0.25)
+    assert len(grid.regions) == 64
+    assert grid.adj.sum() == pc.find_adjacent_regions(grid).sum()
+
+def packed_partition_test():
+    state_space = pc.box2poly([[0., 3.], [0., 2.]])
+    cont_props_dict = {
+        'a':pc.box2poly([[0., 1.], [0., 1.]]),
+        'b':pc.Polytope(np.array([[1., 1.], [-1., 0.], [0., -1.]]),
+                        np.array([4.3, -1.5, -0.2]))
+    }
+    ppp = add_grid(prop2part(state_space, cont_props_dict),
+                   num_grid_pnts=[6, 4])
+    packed = PackedPartition.from_partition(ppp)
+    n = len(ppp.regions)
+    assert len(packed) == n
+    assert packed.A.shape[0] == sum(p.A.shape[0] for r in ppp.regions
+                                    for p in r)
+    
+    # regions and propositions
+    holds = packed.props_matrix()
+    for i, region in enumerate(ppp.regions):
+        assert packed.reg2props(i) == region.props
+        assert set(np.array(packed.prop_names)[holds[i]]) == region.props
+        assert packed[i] == region
+        l, u = region.bounding_box
+        assert np.allclose(packed.lower[packed.region_ptr[i]], l.flatten())
+    
+    # point location on the arrays
+    np.random.seed(0)
+    x = np.random.uniform([0., 0.], [3., 2.], size=(50, 2))
+    assert np.all(find_discrete_states(x, packed) ==
+                  find_discrete_states(x, ppp))
+    
+    # adjacency
+    adj = ppp.adj.todense()
+    packed.adj = None
+    assert np.all(packed.compute_adjacency().todense() == adj)
+    
+    # export
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'packed_partition_test.npz')
+        packed.save(path)
+        loaded = PackedPartition.load(path)
+    finally:
+        shutil.rmtree(tmp_dir)
+    assert loaded.prop_names == packed.prop_names
+    assert np.all(loaded.adj.todense() == adj)
+    assert loaded.domain == state_space
+    assert loaded.prop_regions['b'] == cont_props_dict['b']
+    other = loaded.to_partition()
+    assert len(other.regions) == n
+    assert all(r == s for r, s in zip(other.regions, ppp.regions))
+    assert np.all(other.adj.todense() == adj)
+    
+    ax = packed.plot(plot_numbers=True)
+    assert ax is not None
@@ -0,0 +1,145 @@
+"""
+Tests for tulip.simulate module
+"""
+import numpy as np
+import polytope as pc
+from nose.tools import assert_raises
+
+from tulip import hybrid, abstract, simulate
+from tulip.transys import MealyMachine
+
+def pwa_system():
+    dom = pc.box2poly([[0.0, 4.0], [0.0, 2.0]])
+    U = pc.box2poly([[-0.5, 0.5], [-0.5, 0.5]])
+    W = pc.box2poly([[-0.1, 0.1], [-0.1, 0.1]])
+    subsystems = [
+        hybrid.LtiSysDyn(
+            0.9 * np.eye(2), np.eye(2), np.eye(2), np.array([[0.1], [0.0]]),
+            U, W, pc.box2poly([[0.0, 2.0], [0.0, 2.0]])),
+        hybrid.LtiSysDyn(
+            np.array([[1.0, 0.1], [0.0, 1.0]]), np.eye(2), 0.5 * np.eye(2),
+            None, U, W, pc.box2poly([[2.0, 4.0], [0.0, 2.0]]))
+    ]
+    return hybrid.PwaSysDyn(subsystems, dom)
+
+def simulate_pwa_test():
+    pwa = pwa_system()
+    np.random.seed(0)
+    X0 = np.random.uniform([0.5, 0.5], [3.5, 1.5], size=(50, 2))
+    inputs = np.random.uniform(-0.5, 0.5, size=(50, 5, 2))
+    ppp = abstract.prop2part(
+        pwa.domain, {'a':pc.box2poly([[0.0, 1.0], [0.0, 1.0]])})
+    
+    traces = simulate.simulate(pwa, X0, 5, inputs=inputs,
+                               partition=ppp, seed=1)
+    assert(len(traces) == 50)
+    assert(traces.x.shape == (50, 6, 2))
+    assert(traces.u.shape == (50, 5, 2))
+    
+    for i in xrange(50):
+        for t in xrange(5):
+            x = traces.x[i, t]
+            if not np.all(np.isfinite(x)):
+                assert(not traces.ok[i])
+                break
+            k = traces.subsys[i, t]
+            if k < 0:
+                # left the domain
+                assert(not traces.ok[i])
+                assert(np.all(np.isnan(traces.x[i, t + 1])))
+                break
+            s = pwa.list_subsys[k]
+            assert(pc.is_inside(s.domain, x))
+            d = traces.d[i, t]
+            assert(pc.is_inside(s.Wset, d))
+            x_next = (s.A.dot(x) + s.B.dot(inputs[i, t]) +
+                      s.E.dot(d) + s.K.flatten())
+            assert(np.allclose(traces.x[i, t + 1], x_next))
+            if traces.cell[i, t] >= 0:
+                assert(pc.is_inside(ppp[traces.cell[i, t]], x))
+    
+    # same seed, same disturbances
+    again = simulate.simulate(pwa, X0, 5, inputs=inputs, seed=1)
+    assert(np.allclose(again.d, traces.d))
+    
+    # feedback, no disturbance
+    u = lambda t, X, cells: -0.1 * X
+    traces = simulate.simulate(pwa, X0, 3, inputs=u, disturbance=False)
+    assert(np.all(traces.d == 0))
+    assert(np.allclose(traces.u[:, 0], -0.1 * X0))
+
+def simulate_switched_test():
+    pwa = pwa_system()
+    lti = hybrid.LtiSysDyn(np.eye(2), np.eye(2), domain=pwa.domain)
+    other = hybrid.PwaSysDyn([lti], pwa.domain)
+    sys = hybrid.SwitchedSysDyn(
+        disc_domain_size=(1, 2),
+        dynamics={('e', 'a'):pwa, ('e', 'b'):other},
+        env_labels=['e'], disc_sys_labels=['a', 'b'],
+        cts_ss=pwa.domain)
+    plant = simulate.Plant(sys)
+    assert(plant.modes == [('e', 'a'), ('e', 'b')])
+    
+    X0 = np.array([[1.0, 1.0], [3.0, 1.0]])
+    modes = np.array([1, 0, 1])
+    traces = simulate.simulate(plant, X0, 3, modes=modes,
+                               disturbance=False)
+    assert(np.all(traces.mode == modes))
+    # identity dynamics in mode 1
+    assert(np.allclose(traces.x[:, 1], X0))
+    assert(np.all(traces.subsys[:, 1] == [0, 1]))
+    
+    assert_raises(ValueError, plant.subsystems, X0, [2, 2])
+
+def sample_polytope_test():
+    p = pc.Polytope(np.array([[1.0, 1.0], [-1.0, 0.0], [0.0, -1.0]]),
+                    np.array([1.0, 0.0, 0.0]))
+    x = simulate.sample_polytope(p, 100, np.random.RandomState(0))
+    assert(x.shape == (100, 2))
+    assert(np.all(x.dot(p.A.T) <= p.b + 1e-12))
+    
+    thin = pc.box2poly([[0.0, 1.0], [0.0, 0.0]])
+    assert_raises(ValueError, simulate.sample_polytope, thin, 1)
+
+def simulate_closed_loop_test():
+    dom = pc.box2poly([[0.0, 2.0], [0.0, 2.0]])
+    U = pc.box2poly([[-0.5, 0.5], [-0.5, 0.5]])
+    sys = hybrid.LtiSysDyn(np.eye(2), np.eye(2), None, None, U, None, dom)
+    cont_props = {'a':pc.box2poly([[0.0, 1.0], [0.0, 1.0]])}
+    ppp, new2old = abstract.part2convex(abstract.prop2part(dom, cont_props))
+    ab = abstract.discretize(ppp, sys, N=2, min_cell_volume=0.5)
+    
+    # back and forth between two adjacent cells
+    i, j = [(i, j) for i, j in sorted(ab.ts.transitions())
+            if i != j and (j, i) in ab.ts.transitions()][0]
+    s_i, s_j = ab.ppp2ts[i], ab.ppp2ts[j]
+    mealy = MealyMachine()
+    mealy.add_outputs({'loc':set(ab.ppp2ts)})
+    mealy.states.add_from(['Sinit', 0, 1])
+    mealy.states.initial.add('Sinit')
+    mealy.transitions.add('Sinit', 0, loc=s_i)
+    mealy.transitions.add(0, 1, loc=s_j)
+    mealy.transitions.add(1, 0, loc=s_i)
+    
+    l, u = ab.ppp[i].bounding_box
+    np.random.seed(0)
+    X0 = np.random.uniform(l.flatten(), u.flatten(), size=(20, 2))
+    X0 = X0[[pc.is_inside(ab.ppp[i], x) for x in X0]]
+    # outside of the domain
+    X0 = np.vstack([X0, [[10.0, 10.0]]])
+    
+    traces = simulate.simulate_closed_loop(ab, mealy, X0, 3)
+    assert(traces.x.shape == (len(X0), 7, 2))
+    assert(not traces.ok[-1])
+    assert(np.all(np.isnan(traces.x[-1, 1:])))
+    assert(np.all(traces.ok[:-1]))
+    assert(np.all(traces.loc[:-1] == [i, j, i, j]))
+    for t in xrange(1, 4):
+        for x in traces.x[:-1, 2 * t]:
+            assert(pc.is_inside(ab.ppp[traces.loc[0, t]], x))
+    # inputs respect the input bound
+    assert(np.all(np.abs(traces.u[:-1]) <= 0.5 + 1e-5))
+    
+    # first input agrees with get_input
+    u0 = abstract.get_input(X0[0], sys, ab, i, j)
+    assert(np.allclose(traces.u[0, :2], u0, atol=1e-5))
@@ -42,16 +42,24 @@ from .discretization import (
     create_prog_map, 
     discretize_modeonlyswitched,
     multiproc_posttrans,
-    multiproc_postarea_transitions
+    multiproc_postarea_transitions,
+    AbstractPwa, AbstractSwitched
 )
 from .feasible import is_feasible, solve_feasible, is_feasible_alternative
+from .cache import FeasibilityCache, AbstractionCache
+from .spatial import RegionIndex, PointLocator
 
 from .prop2partition import (
-    prop2part, part2convex,
+    prop2part, part2convex, prop2part_arrangement,
     pwa_partition, add_grid,
     pwa_shrunk_partition,
-    PropPreservingPartition, PPP
+    PropPreservingPartition, PPP, PackedPartition
 )
 
-from .find_controller import get_input, find_discrete_state
+from .find_controller import (
+    get_input, get_input_batch,
+    find_discrete_state, find_discrete_states,
+    CompiledController
+)
+from .explicit import explicit_control_law, ExplicitController
     
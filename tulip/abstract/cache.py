@@ -0,0 +1,391 @@
+# Copyright (c) 2015 by California Institute of Technology
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the California Institute of Technology nor
+#    the names of its contributors may be used to endorse or promote
+#    products derived from this software without specific prior
+#    written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL CALTECH
+# OR THE CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+"""
+Memoization of reachability computations and abstractions.
+
+Results are keyed by a hash of the arguments:
+the H-representation of polytopes, the matrices and sets
+of the dynamics, and any scalar parameters.
+Keys depend on the exact floating point values,
+so equal keys mean identical computations.
+
+See Also
+========
+L{feasible.solve_feasible}, L{discretization.discretize}
+"""
+import logging
+logger = logging.getLogger(__name__)
+import os
+import hashlib
+import zipfile
+import collections
+import cPickle as pickle
+
+import numpy as np
+from scipy import sparse as sp
+import polytope as pc
+
+from tulip.hybrid import LtiSysDyn, PwaSysDyn, SwitchedSysDyn
+from .prop2partition import PropPreservingPartition, PackedPartition
+from .spatial import geometry
+from . import storage
+
+# change when the results of cached functions change
+_KEY_VERSION = '2'
+
+def hash_key(*args):
+    """Return hex digest identifying the arguments.
+
+    Accepts C{Polytope}, C{Region}, L{LtiSysDyn}, L{PwaSysDyn},
+    L{SwitchedSysDyn}, L{PropPreservingPartition},
+    L{PackedPartition}, numpy arrays, sparse matrices,
+    C{None}, numbers and strings,
+    and tuples, lists or dicts of them.
+
+    @raise TypeError: if an argument of any other type is given
+    @rtype: str
+    """
+    h = hashlib.sha1(_KEY_VERSION)
+    for x in args:
+        _update(h, x)
+    return h.hexdigest()
+
+def _update(h, x):
+    if x is None:
+        h.update('N')
+    elif isinstance(x, pc.Region):
+        h.update('R' + repr(sorted(x.props)) + str(len(x)))
+        for p in x:
+            _update(h, p)
+    elif isinstance(x, pc.Polytope):
+        # memoized, polytopes are hashed in many keys
+        h.update('P' + geometry(x).digest)
+    elif isinstance(x, LtiSysDyn):
+        h.update('L')
+        for y in (x.A, x.B, x.E, x.K, x.Uset, x.Wset, x.domain):
+            _update(h, y)
+    elif isinstance(x, PwaSysDyn):
+        h.update('W')
+        _update(h, x.list_subsys)
+        _update(h, x.domain)
+    elif isinstance(x, SwitchedSysDyn):
+        h.update('S')
+        _update(h, x.disc_domain_size)
+        _update(h, x.dynamics)
+    elif isinstance(x, (PropPreservingPartition, PackedPartition)):
+        h.update('D')
+        _update(h, x.domain)
+        _update(h, x.prop_regions)
+        _update(h, list(x.regions))
+        _update(h, None if x.adj is None else sp.csr_matrix(x.adj))
+    elif sp.issparse(x):
+        x = sp.csr_matrix(x, dtype=float, copy=True)
+        x.eliminate_zeros()
+        x.sort_indices()
+        h.update('M' + repr(x.shape))
+        _update(h, x.indptr)
+        _update(h, x.indices)
+        _update(h, x.data)
+    elif isinstance(x, dict):
+        h.update('K' + str(len(x)))
+        for k, v in sorted(x.iteritems()):
+            _update(h, k)
+            _update(h, v)
+    elif isinstance(x, np.ndarray):
+        x = np.ascontiguousarray(x)
+        h.update('A' + x.dtype.str + repr(x.shape))
+        h.update(x.tostring())
+    elif isinstance(x, (bool, int, long, float, str, unicode)):
+        h.update(type(x).__name__ + repr(x))
+    elif isinstance(x, (tuple, list)):
+        h.update('T' + str(len(x)))
+        for y in x:
+            _update(h, y)
+    else:
+        raise TypeError('cannot hash: ' + str(type(x)))
+
+class FeasibilityCache(object):
+    """Two-tier cache of results, keyed by L{hash_key}.
+
+    The memory tier holds the C{maxsize} most recently used results.
+    If C{cache_dir} is given, then results are also pickled there,
+    and the least recently used files are removed once they
+    occupy more than C{max_disk_bytes}.
+    The disk tier can be shared by processes and sessions.
+
+    Results are stored and returned as they are, not copied,
+    so they must not be modified.
+
+    When pickled, e.g., to be passed to worker processes,
+    only the settings are saved. Each process unpickles
+    its own memory tier, and they share the disk tier.
+
+    Counts of lookups are in the dict C{stats}:
+    memory hits, disk hits, misses and evictions.
+    """
+    def __init__(self, maxsize=1024, cache_dir=None,
+                 max_disk_bytes=2**28):
+        """Create empty memory tier.
+
+        @param maxsize: number of results kept in memory,
+            0 disables the memory tier
+        @type maxsize: int >= 0
+        @param cache_dir: directory of disk tier,
+            created if missing
+        @type cache_dir: str
+        @param max_disk_bytes: size of the disk tier
+        @type max_disk_bytes: int
+        """
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._mem = collections.OrderedDict()
+        self._disk_bytes = None
+        self.stats = dict.fromkeys(
+            ['hits', 'disk_hits', 'misses',
+             'evictions', 'disk_evictions'], 0)
+
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __len__(self):
+        return len(self._mem)
+
+    def __str__(self):
+        s = 'FeasibilityCache with ' + str(len(self)) + ' results in memory'
+        if self.cache_dir is not None:
+            s += ', on disk at: ' + str(self.cache_dir)
+        s += '\n' + ', '.join(
+            k + ': ' + str(v) for k, v in sorted(self.stats.iteritems()))
+        return s
+
+    def __reduce__(self):
+        return (_process_cache,
+                (self.maxsize, self.cache_dir, self.max_disk_bytes))
+
+    def get(self, key):
+        """Return result stored under C{key}, or C{None}."""
+        try:
+            value = self._mem.pop(key)
+        except KeyError:
+            value = self._disk_get(key)
+            if value is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['disk_hits'] += 1
+            self._mem_put(key, value)
+            return value
+        self._mem[key] = value
+        self.stats['hits'] += 1
+        return value
+
+    def put(self, key, value):
+        """Store C{value} under C{key}."""
+        self._mem_put(key, value)
+        self._disk_put(key, value)
+
+    def clear(self):
+        """Empty the memory tier and reset C{stats}.
+
+        The disk tier is not modified.
+        """
+        self._mem.clear()
+        for k in self.stats:
+            self.stats[k] = 0
+
+    def _mem_put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._mem.pop(key, None)
+        self._mem[key] = value
+        while len(self._mem) > self.maxsize:
+            self._mem.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def _disk_get(self, key):
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        # mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def _disk_put(self, key, value):
+        if self.cache_dir is None:
+            return
+        path = self._path(key)
+        tmp = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(size for t, size, p in self._disk_files())
+        else:
+            self._disk_bytes += os.path.getsize(path)
+        if self._disk_bytes > self.max_disk_bytes:
+            self._disk_evict()
+
+    def _disk_files(self):
+        """Return list of C{(mtime, size, path)} of disk tier files."""
+        return _dir_files(self.cache_dir, '.pkl')
+
+    def _disk_evict(self):
+        """Remove least recently used files, down to 3/4 of the limit."""
+        total, n = _evict(self.cache_dir, '.pkl', self.max_disk_bytes)
+        self.stats['disk_evictions'] += n
+        self._disk_bytes = total
+
+# caches unpickled in this process, by their settings
+_process_caches = dict()
+
+def _process_cache(maxsize, cache_dir, max_disk_bytes):
+    """Return the cache of this process with these settings."""
+    key = (maxsize, cache_dir, max_disk_bytes)
+    if key not in _process_caches:
+        _process_caches[key] = FeasibilityCache(*key)
+    return _process_caches[key]
+
+class AbstractionCache(object):
+    """Directory of abstractions, keyed by L{hash_key}.
+
+    Abstractions are saved with L{storage.save},
+    one file per key, and loaded memory-mapped.
+    The least recently used files are removed once they
+    occupy more than C{max_disk_bytes}.
+    The directory can be shared by processes and sessions.
+
+    Counts of lookups are in the dict C{stats}:
+    hits, misses and evictions.
+
+    See Also
+    ========
+    L{discretization.discretize}
+    """
+    def __init__(self, cache_dir, max_disk_bytes=2**30):
+        """Open cache directory, created if missing.
+
+        @type cache_dir: str
+        @param max_disk_bytes: size of the cache
+        @type max_disk_bytes: int
+        """
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.stats = dict.fromkeys(['hits', 'misses', 'evictions'], 0)
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __str__(self):
+        return (
+            'AbstractionCache at: ' + str(self.cache_dir) + '\n' +
+            ', '.join(k + ': ' + str(v)
+                      for k, v in sorted(self.stats.iteritems())))
+
+    def get(self, key):
+        """Return abstraction stored under C{key}, or C{None}."""
+        path = self._path(key)
+        try:
+            ab = storage.load(path)
+        except (IOError, OSError, EOFError, KeyError, ValueError,
+                zipfile.BadZipfile, pickle.UnpicklingError):
+            self.stats['misses'] += 1
+            return None
+        # mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.stats['hits'] += 1
+        logger.info('loaded abstraction from cache: ' + path)
+        return ab
+
+    def put(self, key, abstraction):
+        """Save C{abstraction} under C{key}."""
+        path = self._path(key)
+        tmp = path + '.' + str(os.getpid()) + '.tmp'
+        storage.save(abstraction, tmp)
+        os.rename(tmp, path)
+        total = sum(size for t, size, p in _dir_files(self.cache_dir, '.npz'))
+        if total > self.max_disk_bytes:
+            total, n = _evict(self.cache_dir, '.npz', self.max_disk_bytes)
+            self.stats['evictions'] += n
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+def _dir_files(cache_dir, suffix):
+    """Return list of C{(mtime, size, path)} of files ending in C{suffix}."""
+    files = []
+    for fname in os.listdir(cache_dir):
+        if not fname.endswith(suffix):
+            continue
+        path = os.path.join(cache_dir, fname)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, path))
+    return files
+
+def _evict(cache_dir, suffix, max_bytes):
+    """Remove least recently used files, down to 3/4 of C{max_bytes}.
+
+    @return: remaining size and number of files removed
+    @rtype: C{(int, int)}
+    """
+    files = sorted(_dir_files(cache_dir, suffix))
+    total = sum(size for t, size, p in files)
+    target = 3 * max_bytes // 4
+    n = 0
+    for t, size, path in files:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        n += 1
+    logger.debug('disk cache reduced to ' + str(total) + ' bytes')
+    return total, n
@@ -0,0 +1,161 @@
+# Copyright (c) 2015 by California Institute of Technology
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the California Institute of Technology nor
+#    the names of its contributors may be used to endorse or promote
+#    products derived from this software without specific prior
+#    written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL CALTECH
+# OR THE CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+"""
+Checkpoints of the partition refinement in L{discretize}.
+
+A checkpoint file is an append-only log:
+a header with the parameters and a snapshot of the state,
+followed by records of the changes made since.
+Each record is a length-prefixed pickle,
+so a record truncated by a crash is detected and ignored
+when the file is read.
+
+See Also
+========
+L{discretization.discretize}
+"""
+import logging
+logger = logging.getLogger(__name__)
+import os
+import struct
+import cPickle as pickle
+
+_MAGIC = 'TULIPCKP'
+_VERSION = 1
+_LEN = struct.Struct('<I')
+
+class CheckpointLog(object):
+    """Writer of a discretization checkpoint file.
+
+    Changes are collected with L{record}.
+    L{commit} marks the end of an iteration;
+    every C{every} iterations the changes collected
+    are appended to the file as a single record.
+    A record always ends at an iteration boundary,
+    so any prefix of records describes a consistent state.
+    """
+    def __init__(self, path, params, state, every=1):
+        """Create a new checkpoint file, replacing any existing one.
+
+        The header is written to a temporary file,
+        which is then renamed, so that C{path}
+        may be the file being resumed from.
+
+        @param path: name of checkpoint file
+        @param params: discretization parameters,
+            checked on resume
+        @type params: dict
+        @param state: snapshot of the refinement state
+        @type state: dict
+        @param every: number of iterations per record
+        @type every: int >= 1
+        """
+        if every < 1:
+            raise ValueError('every must be >= 1, got: ' + str(every))
+        self.path = path
+        self.every = every
+        self.ops = []
+        self._n_uncommitted = 0
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_MAGIC)
+            _write_record(f, (_VERSION, params, state))
+        os.rename(tmp, path)
+        self._f = open(path, 'ab')
+
+    def record(self, op):
+        """Add the change C{op} to the current iteration."""
+        self.ops.append(op)
+
+    def commit(self, iter_count):
+        """Mark the end of iteration C{iter_count}."""
+        self._n_uncommitted += 1
+        if self._n_uncommitted >= self.every:
+            self.flush(iter_count)
+
+    def flush(self, iter_count):
+        """Append the committed changes to the file."""
+        if self._n_uncommitted == 0:
+            return
+        _write_record(self._f, (iter_count, self.ops))
+        self._f.flush()
+        self.ops = []
+        self._n_uncommitted = 0
+
+    def close(self, iter_count):
+        self.flush(iter_count)
+        self._f.close()
+
+def load(path):
+    """Read checkpoint file.
+
+    @return: C{(params, state, records)}, where C{records}
+        is a list of C{(iter_count, ops)} in the order written.
+    @rtype: C{(dict, dict, list)}
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(_MAGIC))
+        if magic != _MAGIC:
+            raise ValueError('not a checkpoint file: ' + str(path))
+        header = _read_record(f)
+        if header is None:
+            raise ValueError('truncated checkpoint header: ' + str(path))
+        version, params, state = header
+        if version != _VERSION:
+            raise ValueError('unsupported checkpoint version: ' +
+                             str(version))
+        records = []
+        while True:
+            rec = _read_record(f)
+            if rec is None:
+                break
+            records.append(rec)
+    logger.info('read checkpoint ' + str(path) + ' with ' +
+                str(len(records)) + ' records')
+    return params, state, records
+
+def _write_record(f, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    f.write(_LEN.pack(len(data)) + data)
+
+def _read_record(f):
+    """Return next record, or C{None} at end of file."""
+    head = f.read(_LEN.size)
+    if len(head) < _LEN.size:
+        return None
+    (n,) = _LEN.unpack(head)
+    data = f.read(n)
+    if len(data) < n:
+        logger.warning('ignoring truncated checkpoint record')
+        return None
+    return pickle.loads(data)
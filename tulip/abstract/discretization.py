@@ -44,8 +44,16 @@ import logging
 logger = logging.getLogger(__name__)
 import math
 import os
+import time
 import warnings
 import pprint
+import heapq
+import collections
+import shutil
+import tempfile
+import traceback
+import Queue
+import cPickle as pickle
 from copy import deepcopy
 import multiprocessing as mp
 
@@ -63,7 +71,12 @@ from .prop2partition import (PropPreservingPartition,
                              prop2part
                              )
 
-from .feasible import is_feasible, solve_feasible
+from .feasible import is_feasible, solve_feasible, may_reach
+from .spatial import RegionIndex, geometry
+from .checkpoint import CheckpointLog
+from .checkpoint import load as load_checkpoint
+from .cache import AbstractionCache, hash_key
+from . import storage
 from .plot import plot_ts_on_partition
 
 # inline imports:
@@ -115,6 +128,26 @@ class AbstractSwitched(object):
         self.modes = modes
         self.ppp2modes = ppp2modes
     
+    @property
+    def ts(self):
+        """Common TS, rebuilt on first access after L{load}."""
+        if self._ts_loader is not None:
+            self._ts = self._ts_loader()
+            self._ts_loader = None
+        return self._ts
+    
+    @ts.setter
+    def ts(self, ts):
+        self._ts = ts
+        self._ts_loader = None
+    
+    def __setstate__(self, state):
+        # pickled before ts became a property
+        if 'ts' in state:
+            state['_ts'] = state.pop('ts')
+        state.setdefault('_ts_loader', None)
+        self.__dict__.update(state)
+    
     def __str__(self):
         s = 'Abstraction of switched system\n'
         s += str('common PPP:\n') + str(self.ppp)
@@ -160,6 +193,35 @@ class AbstractSwitched(object):
         ab = self.modes[mode]
         return ab.ppp2sys(region_idx)
     
+    def save(self, path):
+        """Write abstraction to file C{path}.
+        
+        The modes are saved too.
+        For the file format see L{storage}.
+        
+        @type path: C{str}
+        """
+        storage.save(self, path)
+    
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Read abstraction written by L{save}.
+        
+        Partitions are returned as L{PackedPartition}s.
+        
+        @param mmap: memory-map the arrays of the file,
+            instead of reading them
+        @type mmap: bool
+        
+        @rtype: L{AbstractSwitched}
+        """
+        ab = storage.load(path, mmap)
+        if not isinstance(ab, cls):
+            raise ValueError(
+                str(path) + ' contains ' + type(ab).__name__ +
+                ', not ' + cls.__name__)
+        return ab
+    
     def plot(self, show_ts=False, only_adjacent=False):
         """Plot mode partitions and merged partition, if one exists.
         
@@ -244,6 +306,13 @@ class AbstractPwa(object):
           to ensure consistency
 
           type: dict
+      
+      - stats: counters collected during discretization,
+          e.g., C{'n_checked'} pairs of cells,
+          of which C{'n_pruned'} were rejected
+          by L{may_reach} before computing reachable sets
+
+          type: dict
     
     If any of the above is not given,
     then it is initialized to None.
@@ -263,10 +332,12 @@ class AbstractPwa(object):
         self, ppp=None, ts=None, ppp2ts=None,
         pwa=None, pwa_ppp=None, ppp2pwa=None, ppp2sys=None,
         orig_ppp=None, ppp2orig=None,
-        disc_params=None
+        disc_params=None, stats=None
     ):
         if disc_params is None:
             disc_params = dict()
+        if stats is None:
+            stats = dict()
         
         self.ppp = ppp
         self.ts = ts
@@ -285,6 +356,7 @@ class AbstractPwa(object):
         # ppp2pwa -> ppp2pwa_sys
         
         self.disc_params = disc_params
+        self.stats = stats
     
     def __str__(self):
         s = str(self.ppp)
@@ -309,6 +381,57 @@ class AbstractPwa(object):
         
         return s
     
+    @property
+    def ts(self):
+        """Abstract TS, rebuilt on first access after L{load}."""
+        if self._ts_loader is not None:
+            self._ts = self._ts_loader()
+            self._ts_loader = None
+        return self._ts
+    
+    @ts.setter
+    def ts(self, ts):
+        self._ts = ts
+        self._ts_loader = None
+    
+    def __setstate__(self, state):
+        # pickled before ts became a property
+        if 'ts' in state:
+            state['_ts'] = state.pop('ts')
+        state.setdefault('_ts_loader', None)
+        state.setdefault('stats', dict())
+        self.__dict__.update(state)
+    
+    def save(self, path):
+        """Write abstraction to file C{path}.
+        
+        For the file format see L{storage}.
+        
+        @type path: C{str}
+        """
+        storage.save(self, path)
+    
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Read abstraction written by L{save}.
+        
+        Partitions are returned as L{PackedPartition}s,
+        whose regions are created only when indexed.
+        The C{ts} is rebuilt on first access.
+        
+        @param mmap: memory-map the arrays of the file,
+            instead of reading them
+        @type mmap: bool
+        
+        @rtype: L{AbstractPwa}
+        """
+        ab = storage.load(path, mmap)
+        if not isinstance(ab, cls):
+            raise ValueError(
+                str(path) + ' contains ' + type(ab).__name__ +
+                ', not ' + cls.__name__)
+        return ab
+    
     def ts2ppp(self, state):
         region_index = self.ppp2ts.index(state)
         region = self.ppp[region_index]
@@ -548,10 +671,24 @@ def discretize(
     trans_length=1, remove_trans=False, 
     abs_tol=1e-7,
     plotit=False, save_img=False, cont_props=None,
-    plot_every=1
+    plot_every=1, n_jobs=1,
+    checkpoint=None, checkpoint_every=1, resume_from=None,
+    cache_dir=None,
+    time_budget=None, max_cells=None, max_iterations=None,
+    priority=None, feasibility_cache=None
 ):
     """Refine the partition and establish transitions
     based on reachability analysis.
+    
+    The refinement can be bounded by C{time_budget},
+    C{max_iterations} and C{max_cells}.
+    When a budget runs out, the abstraction is returned
+    with the transitions found so far.
+    It is sound, because a transition is added only
+    if it has been checked for the whole cell,
+    but it is coarser and has fewer transitions
+    than the complete abstraction.
+    The pairs of cells left unchecked are listed in its C{stats}.
 
     Reference
     =========
@@ -599,13 +736,105 @@ def discretize(
     @param cont_props: continuous propositions to plot
     @type cont_props: list of C{Polytope}
     
+    @param n_jobs: number of worker processes that compute reachable
+        sets for the next pairs to be checked, ahead of time.
+        Results invalidated by splitting one of the two cells
+        are discarded, so the abstraction is the same as
+        the one computed serially (C{n_jobs=1}).
+    @type n_jobs: int >= 1
+    
+    @param checkpoint: file where the refinement state is saved
+        as it evolves. A new file is started,
+        with the current state as its header,
+        and changes are appended to it.
+        See L{checkpoint.CheckpointLog}.
+    @type checkpoint: str
+    
+    @param checkpoint_every: number of iterations between
+        writes to the checkpoint file
+    @type checkpoint_every: int >= 1
+    
+    @param resume_from: checkpoint file written by a previous call
+        with the same arguments, to continue from.
+        It may be the same as C{checkpoint}.
+    @type resume_from: str
+    
+    @param cache_dir: directory of abstractions computed before,
+        see L{AbstractionCache}. If C{part}, C{ssys} and the
+        parameters that affect the result are the same
+        as in a previous call, then the saved abstraction
+        is returned, with its partitions as L{PackedPartition}s.
+    @type cache_dir: str
+    
+    @param time_budget: seconds of wall-clock time after which
+        no more pairs are checked
+    @type time_budget: float
+    
+    @param max_cells: no cell is split after the partition
+        has this many cells. Pairs that would need a split
+        are recorded as not reachable.
+    @type max_cells: int
+    
+    @param max_iterations: number of pairs after which
+        no more pairs are checked, including pairs checked
+        before C{resume_from}
+    @type max_iterations: int
+    
+    @param priority: order in which the pairs are checked,
+        so that the most useful refinements come first:
+        
+          - C{None}: by cell index
+          - C{'volume'}: pairs from larger cells first
+          - C{'props'}: pairs of cells with different
+            propositions first
+          - a callable C{priority(si, sj)} that returns
+            a key of the pair C{si ---> sj}, smaller first
+    
+    @param feasibility_cache: memo of reachable sets,
+        passed to L{solve_feasible}, also by the workers.
+        Each worker has its own memory tier,
+        so give it a C{cache_dir} to share results.
+    @type feasibility_cache: L{FeasibilityCache}
+    
+    @return: abstraction, with the C{stats}:
+        
+          - C{'n_checked'}, C{'n_pruned'}: number of pairs checked,
+            of which rejected by L{may_reach}
+          - C{'stopped'}: C{None} if all pairs have been checked,
+            otherwise C{'time_budget'} or C{'max_iterations'}
+          - C{'unexplored'}: pairs C{(i, j)} of cells,
+            whose transition C{i ---> j} has not been checked
+          - C{'n_not_split'}: number of splits omitted
+            due to C{max_cells}
     @rtype: L{AbstractPwa}
     """
     if use_all_horizon:
         raise ValueError('discretize() with use_all_horizon=True is still '
                          'under development\nand currently unavailable.')
+    
+    if isinstance(priority, str):
+        if priority not in _PRIORITIES:
+            raise ValueError('unknown priority: ' + str(priority))
+        pair_priority = _PRIORITIES[priority]
+    else:
+        pair_priority = priority
+    
+    # callables cannot be hashed
+    if callable(priority):
+        cache_dir = None
+    if cache_dir is not None:
+        cache = AbstractionCache(cache_dir)
+        cache_key = hash_key(
+            'discretize', part, ssys, N, min_cell_volume,
+            closed_loop, conservative, max_num_poly,
+            use_all_horizon, trans_length, remove_trans, abs_tol,
+            max_cells, priority)
+        ab = cache.get(cache_key)
+        if ab is not None:
+            return ab
 
     start_time = os.times()[0]
+    start_wall = time.time()
     
     orig_ppp = part
     min_cell_volume = (min_cell_volume /np.finfo(np.double).eps
@@ -651,34 +880,113 @@ def discretize(
         else:
             rd = 0.
     
-    # Initialize matrix for pairs to check
-    IJ = part.adj.copy()
-    IJ = IJ.todense()
-    IJ = np.array(IJ)
-    logger.debug("\n Starting IJ: \n" + str(IJ) )
-    
-    # next line omitted in discretize_overlap
-    IJ = reachable_within(trans_length, IJ,
-                          np.array(part.adj.todense()) )
-    
     # Initialize output
+    #
+    # transitions and IJ follow the convention of the adjacency
+    # matrix of the transition system transposed:
+    # entry (j, i) stands for the transition i ---> j
     num_regions = len(part)
-    transitions = np.zeros(
-        [num_regions, num_regions],
-        dtype = int
-    )
-    sol = deepcopy(part.regions)
-    adj = part.adj.copy()
-    adj = adj.todense()
-    adj = np.array(adj)
+    ckpt_params = {
+        'N':N,
+        'min_cell_volume':min_cell_volume,
+        'closed_loop':closed_loop,
+        'conservative':conservative,
+        'max_num_poly':max_num_poly,
+        'use_all_horizon':use_all_horizon,
+        'trans_length':trans_length,
+        'remove_trans':remove_trans,
+        'abs_tol':abs_tol,
+        'num_regions':num_regions
+    }
+    # a checkpoint of other regions or dynamics must not be resumed
+    if checkpoint is not None or resume_from is not None:
+        ckpt_params['inputs'] = hash_key(part, ssys, orig_ppp)
+    iter_count = 0
     
-    # next 2 lines omitted in discretize_overlap
-    if ispwa:
-        subsys_list = list(ppp2pwa)
+    if resume_from is None:
+        transitions = _SparseRelation(num_regions)
+        sol = deepcopy(part.regions)
+        adj = _SparseRelation.from_matrix(part.adj)
+
+        # Initialize worklist of pairs to check
+        # next line omitted in discretize_overlap
+        IJ = _Worklist(num_regions)
+        for i in xrange(num_regions):
+            _sym_adj_change(IJ, adj, transitions, i, trans_length)
+
+        # next 2 lines omitted in discretize_overlap
+        if ispwa:
+            subsys_list = list(ppp2pwa)
+        else:
+            subsys_list = None
     else:
-        subsys_list = None
+        (sol, adj, transitions, IJ, orig, subsys_list,
+         iter_count) = _resume(resume_from, ckpt_params)
+        logger.info('resuming from ' + str(resume_from) +
+                    ' at iteration ' + str(iter_count))
+    
+    if pair_priority is not None:
+        # (j, i) stands for i ---> j
+        IJ.set_key(lambda j, i: (pair_priority(sol[i], sol[j]), j, i))
+    logger.debug("\n Starting IJ: \n" + str(IJ) )
     ss = ssys
     
+    # bounding boxes of cells, to find candidate neighbors
+    index = RegionIndex(sol)
+    
+    if checkpoint is not None:
+        state = {
+            'sol':sol,
+            'adj':list(adj),
+            'transitions':list(transitions),
+            'IJ':list(IJ),
+            'orig':orig,
+            'subsys_list':subsys_list,
+            'iter_count':iter_count
+        }
+        ckpt = CheckpointLog(checkpoint, ckpt_params, state,
+                             every=checkpoint_every)
+        adj.log_to(ckpt, 'adj')
+        transitions.log_to(ckpt, 'transitions')
+        IJ.log_to(ckpt, 'IJ')
+    else:
+        ckpt = None
+    
+    def subsys_of(i):
+        if ispwa:
+            return ssys.list_subsys[subsys_list[i]]
+        else:
+            return ssys
+    
+    def trans_set_of(i):
+        if conservative:
+            # Don't use trans_set
+            return None
+        else:
+            # Use original cell as trans_set
+            return orig_list[orig[i]]
+    
+    def feasible_args(i, j):
+        """Return arguments of solve_feasible for the pair i ---> j."""
+        return (sol[i], sol[j], subsys_of(i), N, closed_loop,
+                use_all_horizon, trans_set_of(i), max_num_poly,
+                feasibility_cache)
+    
+    def may_reach_pair(i, j):
+        """Return False if sol[i] \cap Pre(sol[j]) is surely empty."""
+        return may_reach(sol[i], sol[j], subsys_of(i), N,
+                         trans_set_of(i), abs_tol)
+    
+    if n_jobs > 1:
+        speculator = _Speculator(n_jobs, feasible_args, may_reach_pair)
+    else:
+        speculator = None
+    
+    n_checked = 0
+    n_pruned = 0
+    n_not_split = 0
+    stopped = None
+    
     # init graphics
     if plotit:
         try:
@@ -692,8 +1000,6 @@ def discretize(
         except:
             logger.error('failed to import matplotlib')
             plt = None
-        
-    iter_count = 0
     
     # List of how many "new" regions
     # have been created for each region
@@ -704,317 +1010,358 @@ def discretize(
     progress = list()
     
     # Do the abstraction
-    while np.sum(IJ) > 0:
-        ind = np.nonzero(IJ)
-        # i,j swapped in discretize_overlap
-        i = ind[1][0]
-        j = ind[0][0]
-        IJ[j, i] = 0
-        si = sol[i]
-        sj = sol[j]
-        
-        si_tmp = deepcopy(si)
-        sj_tmp = deepcopy(sj)
-        
-        #num_new_reg[i] += 1
-        #print(num_new_reg)
-        
-        if ispwa:
-            ss = ssys.list_subsys[subsys_list[i]]
-            if len(ss.E) > 0:
-                rd, xd = pc.cheby_ball(ss.Wset)
-            else:
-                rd = 0.
-        
-        if conservative:
-            # Don't use trans_set
-            trans_set = None
-        else:
-            # Use original cell as trans_set
-            trans_set = orig_list[orig[i]]
-        
-        S0 = solve_feasible(
-            si, sj, ss, N, closed_loop,
-            use_all_horizon, trans_set, max_num_poly
-        )
-        
-        msg = '\n Working with partition cells: ' + str(i) + ', ' + str(j)
-        logger.info(msg)
-        
-        msg = '\t' + str(i) +' (#polytopes = ' +str(len(si) ) +'), and:\n'
-        msg += '\t' + str(j) +' (#polytopes = ' +str(len(sj) ) +')\n'
-        
-        if ispwa:
-            msg += '\t with active subsystem: '
-            msg += str(subsys_list[i]) + '\n'
+    try:
+        while IJ:
+            if max_iterations is not None and iter_count >= max_iterations:
+                stopped = 'max_iterations'
+                break
+            if time_budget is not None and \
+               time.time() - start_wall > time_budget:
+                stopped = 'time_budget'
+                break
             
-        msg += '\t Computed reachable set S0 with volume: '
-        msg += str(S0.volume) + '\n'
-        
-        logger.debug(msg)
-        
-        #logger.debug('si \cap s0')
-        isect = si.intersect(S0)
-        vol1 = isect.volume
-        risect, xi = pc.cheby_ball(isect)
-        
-        #logger.debug('si \ s0')
-        diff = si.diff(S0)
-        vol2 = diff.volume
-        rdiff, xd = pc.cheby_ball(diff)
-        #logger.warning('\nVol2: %2f '%vol2)
-        # if pc.is_fulldim(pc.Region([isect]).intersect(diff)):
-        #     logging.getLogger('tulip.polytope').setLevel(logging.DEBUG)
-        #     diff = pc.mldivide(si, S0, save=True)
-        #
-        #     ax = S0.plot()
-        #     ax.axis([0.0, 1.0, 0.0, 2.0])
-        #     ax.figure.savefig('./img/s0.pdf')
-        #
-        #     ax = si.plot()
-        #     ax.axis([0.0, 1.0, 0.0, 2.0])
-        #     ax.figure.savefig('./img/si.pdf')
-        #
-        #     ax = isect.plot()
-        #     ax.axis([0.0, 1.0, 0.0, 2.0])
-        #     ax.figure.savefig('./img/isect.pdf')
-        #
-        #     ax = diff.plot()
-        #     ax.axis([0.0, 1.0, 0.0, 2.0])
-        #     ax.figure.savefig('./img/diff.pdf')
-        #
-        #     ax = isect.intersect(diff).plot()
-        #     ax.axis([0.0, 1.0, 0.0, 2.0])
-        #     ax.figure.savefig('./img/diff_cap_isect.pdf')
-        #
-        #     logger.error('Intersection \cap Difference != \emptyset')
-        #
-        #     assert(False)
-
-        if vol1 <= min_cell_volume:
-            logger.warning('\t too small: si \cap Pre(sj), ' +
-                           'so discard intersection')
-        if vol1 <= min_cell_volume and isect:
-            logger.warning('\t discarded non-empty intersection: ' +
-                           'consider reducing min_cell_volume')
-        if vol2 <= min_cell_volume:
-            logger.warning('\t too small: si \ Pre(sj), so not reached it')
-        
-        # We don't want our partitions to be smaller than the disturbance set
-        # Could be a problem since cheby radius is calculated for smallest
-        # convex polytope, so if we have a region we might throw away a good
-        # cell.
-        if (vol1 > min_cell_volume) and (risect > rd) and \
-           (vol2 > min_cell_volume) and (rdiff > rd):
-        
-            # Make sure new areas are Regions and add proposition lists
-            if len(isect) == 0:
-                isect = pc.Region([isect], si.props)
-            else:
-                isect.props = si.props.copy()
-        
-            if len(diff) == 0:
-                diff = pc.Region([diff], si.props)
-            else:
-                diff.props = si.props.copy()
-        
-            # replace si by intersection (single state)
-            isect_list = pc.separate(isect)
-            sol[i] = isect_list[0]
+            # i,j swapped in discretize_overlap
+            j, i = IJ.pop()
+            # cells are replaced when split, never modified,
+            # so si, sj remain as they are now
+            si = sol[i]
+            sj = sol[j]
+            
+            #num_new_reg[i] += 1
+            #print(num_new_reg)
             
-            # cut difference into connected pieces
-            difflist = pc.separate(diff)
+            if ispwa:
+                ss = ssys.list_subsys[subsys_list[i]]
+                if len(ss.E) > 0:
+                    rd, xd = geometry(ss.Wset).cheby_ball
+                else:
+                    rd = 0.
             
-            difflist += isect_list[1:]
-            n_isect = len(isect_list) -1
+            n_checked += 1
+            if not may_reach_pair(i, j):
+                # same outcome as any S0 disjoint from si
+                n_pruned += 1
+                S0 = pc.Polytope()
+            elif speculator is None:
+                S0 = solve_feasible(*feasible_args(i, j))
+            else:
+                S0 = speculator.result(IJ, j, i)
             
-            num_new = len(difflist)
+            msg = '\n Working with partition cells: ' + str(i) + ', ' + str(j)
+            logger.info(msg)
             
-            # add each piece, as a new state
-            for region in difflist:
-                sol.append(region)
+            if logger.getEffectiveLevel() <= logging.DEBUG:
+                msg = '\t' + str(i) +' (#polytopes = ' +str(len(si) ) +'), and:\n'
+                msg += '\t' + str(j) +' (#polytopes = ' +str(len(sj) ) +')\n'
                 
-                # keep track of PWA subsystems map to new states
                 if ispwa:
-                    subsys_list.append(subsys_list[i])
-            #n_cvol2ells = len(sol)
-            n_cells=len(sol)
-            new_idx = xrange(n_cells-1, n_cells-num_new-1, -1)
+                    msg += '\t with active subsystem: '
+                    msg += str(subsys_list[i]) + '\n'
+                    
+                msg += '\t Computed reachable set S0 with volume: '
+                msg += str(geometry(S0).volume) + '\n'
+                
+                logger.debug(msg)
             
-            """Update transition matrix"""
-            transitions = np.pad(transitions, (0,num_new), 'constant')
+            #logger.debug('si \cap s0')
+            isect = si.intersect(S0)
+            vol1 = geometry(isect).volume
+            risect, xi = geometry(isect).cheby_ball
             
-            transitions[i, :] = np.zeros(n_cells)
-            for r in new_idx:
-                #transitions[:, r] = transitions[:, i]
-                # All sets reachable from start are reachable from both part's
-                # except possibly the new part
-                transitions[i, r] = 0
-                transitions[j, r] = 0            
+            #logger.debug('si \ s0')
+            diff = si.diff(S0)
+            vol2 = geometry(diff).volume
+            rdiff, xd = geometry(diff).cheby_ball
+            #logger.warning('\nVol2: %2f '%vol2)
+            # if pc.is_fulldim(pc.Region([isect]).intersect(diff)):
+            #     logging.getLogger('tulip.polytope').setLevel(logging.DEBUG)
+            #     diff = pc.mldivide(si, S0, save=True)
+            #
+            #     ax = S0.plot()
+            #     ax.axis([0.0, 1.0, 0.0, 2.0])
+            #     ax.figure.savefig('./img/s0.pdf')
+            #
+            #     ax = si.plot()
+            #     ax.axis([0.0, 1.0, 0.0, 2.0])
+            #     ax.figure.savefig('./img/si.pdf')
+            #
+            #     ax = isect.plot()
+            #     ax.axis([0.0, 1.0, 0.0, 2.0])
+            #     ax.figure.savefig('./img/isect.pdf')
+            #
+            #     ax = diff.plot()
+            #     ax.axis([0.0, 1.0, 0.0, 2.0])
+            #     ax.figure.savefig('./img/diff.pdf')
+            #
+            #     ax = isect.intersect(diff).plot()
+            #     ax.axis([0.0, 1.0, 0.0, 2.0])
+            #     ax.figure.savefig('./img/diff_cap_isect.pdf')
+            #
+            #     logger.error('Intersection \cap Difference != \emptyset')
+            #
+            #     assert(False)
+
+            if vol1 <= min_cell_volume:
+                logger.warning('\t too small: si \cap Pre(sj), ' +
+                               'so discard intersection')
+            if vol1 <= min_cell_volume and isect:
+                logger.warning('\t discarded non-empty intersection: ' +
+                               'consider reducing min_cell_volume')
+            if vol2 <= min_cell_volume:
+                logger.warning('\t too small: si \ Pre(sj), so not reached it')
             
-            # sol[j] is reachable from intersection of sol[i] and S0
-            if i != j:
-                transitions[j, i] = 1
-                
-                # sol[j] is reachable from each piece os S0 \cap sol[i]
-                #for k in xrange(n_cells-n_isect-2, n_cells):
-                #    transitions[j, k] = 1
+            # We don't want our partitions to be smaller than the disturbance set
+            # Could be a problem since cheby radius is calculated for smallest
+            # convex polytope, so if we have a region we might throw away a good
+            # cell.
+            split = (vol1 > min_cell_volume) and (risect > rd) and \
+                    (vol2 > min_cell_volume) and (rdiff > rd)
+            if split and max_cells is not None and len(sol) >= max_cells:
+                logger.info('\t not split: partition has max_cells cells')
+                n_not_split += 1
+                split = False
             
-            """Update adjacency matrix"""
-            old_adj = np.nonzero(adj[i, :])[0]
+            if split:
             
-            # reset new adjacencies
-            adj[i, :] = np.zeros([n_cells -num_new])
-            adj[:, i] = np.zeros([n_cells -num_new])
-            adj[i, i] = 1
+                # Make sure new areas are Regions and add proposition lists
+                if len(isect) == 0:
+                    isect = pc.Region([isect], si.props)
+                else:
+                    isect.props = si.props.copy()
             
-            adj = np.pad(adj, (0, num_new), 'constant')
+                if len(diff) == 0:
+                    diff = pc.Region([diff], si.props)
+                else:
+                    diff.props = si.props.copy()
             
-            for r in new_idx:
-                adj[i, r] = 1
-                adj[r, i] = 1
-                adj[r, r] = 1
+                # replace si by intersection (single state)
+                isect_list = pc.separate(isect)
+                sol[i] = isect_list[0]
+                index.update(i, sol[i])
                 
-                if not conservative:
-                    orig = np.hstack([orig, orig[i]])
-            
-            # adjacencies between pieces of isect and diff
-            for r in new_idx:
-                for k in new_idx:
-                    if r is k:
-                        continue
+                # cut difference into connected pieces
+                difflist = pc.separate(diff)
+                
+                difflist += isect_list[1:]
+                n_isect = len(isect_list) -1
+                
+                num_new = len(difflist)
+                
+                # reachable sets computed ahead for sol[i] are stale
+                if speculator is not None:
+                    speculator.split(i)
+                
+                # add each piece, as a new state
+                for region in difflist:
+                    sol.append(region)
+                    index.insert(len(sol) - 1, region)
                     
-                    if pc.is_adjacent(sol[r], sol[k]):
-                        adj[r, k] = 1
-                        adj[k, r] = 1
-            
-            msg = ''
-            if logger.getEffectiveLevel() <= logging.DEBUG:
-                msg += '\t\n Adding states ' + str(i) + ' and '
+                    # keep track of PWA subsystems map to new states
+                    if ispwa:
+                        subsys_list.append(subsys_list[i])
+                
+                if ckpt is not None:
+                    ckpt.record(('split', i, sol[i], difflist))
+                #n_cvol2ells = len(sol)
+                n_cells=len(sol)
+                new_idx = xrange(n_cells-1, n_cells-num_new-1, -1)
+                
+                """Update transition matrix"""
+                transitions.grow(num_new)
+                
+                # All sets reachable from start are reachable from both part's
+                # except possibly the new part
+                transitions.clear_row(i)
+                
+                # sol[j] is reachable from intersection of sol[i] and S0
+                if i != j:
+                    transitions.add(j, i)
+                    
+                    # sol[j] is reachable from each piece os S0 \cap sol[i]
+                    #for k in xrange(n_cells-n_isect-2, n_cells):
+                    #    transitions.add(j, k)
+                
+                """Update adjacency matrix"""
+                old_adj = sorted(adj.row(i))
+                
+                # reset new adjacencies
+                adj.clear_row(i)
+                adj.clear_col(i)
+                adj.add(i, i)
+                
+                adj.grow(num_new)
+                
                 for r in new_idx:
-                    msg += str(r) + ' and '
-                msg += '\n'
-                logger.debug(msg)
-                        
-            for k in np.setdiff1d(old_adj, [i,n_cells-1]):
-                # Every "old" neighbor must be the neighbor
-                # of at least one of the new
-                if pc.is_adjacent(sol[i], sol[k]):
-                    adj[i, k] = 1
-                    adj[k, i] = 1
-                elif remove_trans and (trans_length == 1):
-                    # Actively remove transitions between non-neighbors
-                    transitions[i, k] = 0
-                    transitions[k, i] = 0
+                    adj.add(i, r)
+                    adj.add(r, i)
+                    adj.add(r, r)
+                    
+                    if not conservative:
+                        orig.append(orig[i])
+                
+                # cells whose bounding boxes meet those of the new cells
+                near = {r:set(index.query(sol[r])) for r in new_idx}
+                near[i] = set(index.query(sol[i]))
                 
+                # adjacencies between pieces of isect and diff
                 for r in new_idx:
-                    if pc.is_adjacent(sol[r], sol[k]):
-                        adj[r, k] = 1
-                        adj[k, r] = 1
+                    for k in new_idx:
+                        if r == k or k not in near[r]:
+                            continue
+                        
+                        if pc.is_adjacent(sol[r], sol[k]):
+                            adj.add(r, k)
+                            adj.add(k, r)
+                
+                msg = ''
+                if logger.getEffectiveLevel() <= logging.DEBUG:
+                    msg += '\t\n Adding states ' + str(i) + ' and '
+                    for r in new_idx:
+                        msg += str(r) + ' and '
+                    msg += '\n'
+                    logger.debug(msg)
+                            
+                for k in old_adj:
+                    if k == i:
+                        continue
+                    
+                    # Every "old" neighbor must be the neighbor
+                    # of at least one of the new
+                    if k in near[i] and pc.is_adjacent(sol[i], sol[k]):
+                        adj.add(i, k)
+                        adj.add(k, i)
                     elif remove_trans and (trans_length == 1):
                         # Actively remove transitions between non-neighbors
-                        transitions[r, k] = 0
-                        transitions[k, r] = 0
+                        transitions.remove(i, k)
+                        transitions.remove(k, i)
+                    
+                    for r in new_idx:
+                        if k in near[r] and pc.is_adjacent(sol[r], sol[k]):
+                            adj.add(r, k)
+                            adj.add(k, r)
+                        elif remove_trans and (trans_length == 1):
+                            # Actively remove transitions between non-neighbors
+                            transitions.remove(r, k)
+                            transitions.remove(k, r)
+                
+                """Update IJ worklist"""
+                IJ.grow(num_new)
+                _sym_adj_change(IJ, adj, transitions, i, trans_length)
+                
+                for r in new_idx:
+                    _sym_adj_change(IJ, adj, transitions, r, trans_length)
+                
+                if logger.getEffectiveLevel() <= logging.DEBUG:
+                    msg = '\n\n Updated adj: \n' + str(adj)
+                    msg += '\n\n Updated trans: \n' + str(transitions)
+                    msg += '\n\n Updated IJ: \n' + str(IJ)
+                    logger.debug(msg)
+                
+                logger.info('Divided region: ' + str(i) + '\n')
+            elif vol2 < abs_tol:
+                logger.info('Found: ' + str(i) + ' ---> ' + str(j) + '\n')
+                transitions.add(j, i)
+            else:
+                if logger.level <= logging.DEBUG:
+                    msg = '\t Unreachable: ' + str(i) + ' --X--> ' + str(j) + '\n'
+                    msg += '\t\t diff vol: ' + str(vol2) + '\n'
+                    msg += '\t\t intersect vol: ' + str(vol1) + '\n'
+                    logger.debug(msg)
+                else:
+                    logger.info('\t unreachable\n')
+                transitions.remove(j, i)
             
-            """Update IJ matrix"""
-            IJ = np.pad(IJ, (0,num_new), 'constant')
-            adj_k = reachable_within(trans_length, adj, adj)
-            sym_adj_change(IJ, adj_k, transitions, i)
+            # check to avoid overlapping Regions
+            if debug:
+                tmp_part = PropPreservingPartition(
+                    domain=part.domain,
+                    regions=sol, adj=adj.to_lil(),
+                    prop_regions=part.prop_regions
+                )
+                assert(tmp_part.is_partition() )
             
-            for r in new_idx:
-                sym_adj_change(IJ, adj_k, transitions, r)
+            n_cells = len(sol)
             
-            if logger.getEffectiveLevel() <= logging.DEBUG:
-                msg = '\n\n Updated adj: \n' + str(adj)
-                msg += '\n\n Updated trans: \n' + str(transitions)
-                msg += '\n\n Updated IJ: \n' + str(IJ)
-                logger.debug(msg)
+
+            progress_ratio = 1 - float(len(IJ) ) /n_cells**2
+            progress += [progress_ratio]
+            
+            msg = '\t total # polytopes: ' + str(n_cells) + '\n'
+            msg += '\t progress ratio: ' + str(progress_ratio) + '\n'
+            logger.info(msg)
+            
+            iter_count += 1
+            
+            if ckpt is not None:
+                ckpt.commit(iter_count)
+            
+            # no plotting ?
+            if not plotit:
+                continue
+            if plt is None or plot_partition is None:
+                continue
+            if iter_count % plot_every != 0:
+                continue
             
-            logger.info('Divided region: ' + str(i) + '\n')
-        elif vol2 < abs_tol:
-            logger.info('Found: ' + str(i) + ' ---> ' + str(j) + '\n')
-            transitions[j,i] = 1
-        else:
-            if logger.level <= logging.DEBUG:
-                msg = '\t Unreachable: ' + str(i) + ' --X--> ' + str(j) + '\n'
-                msg += '\t\t diff vol: ' + str(vol2) + '\n'
-                msg += '\t\t intersect vol: ' + str(vol1) + '\n'
-                logger.debug(msg)
-            else:
-                logger.info('\t unreachable\n')
-            transitions[j,i] = 0
-        
-        # check to avoid overlapping Regions
-        if debug:
             tmp_part = PropPreservingPartition(
                 domain=part.domain,
-                regions=sol, adj=sp.lil_matrix(adj),
+                regions=sol, adj=adj.to_lil(),
                 prop_regions=part.prop_regions
             )
-            assert(tmp_part.is_partition() )
-        
-        n_cells = len(sol)
-        
-
-        progress_ratio = 1 - float(np.sum(IJ) ) /n_cells**2
-        progress += [progress_ratio]
-        
-        msg = '\t total # polytopes: ' + str(n_cells) + '\n'
-        msg += '\t progress ratio: ' + str(progress_ratio) + '\n'
-        logger.info(msg)
-        
-        iter_count += 1
-        
-        # no plotting ?
-        if not plotit:
-            continue
-        if plt is None or plot_partition is None:
-            continue
-        if iter_count % plot_every != 0:
-            continue
-        
-        tmp_part = PropPreservingPartition(
-            domain=part.domain,
-            regions=sol, adj=sp.lil_matrix(adj),
-            prop_regions=part.prop_regions
-        )
-        
-        # plot pair under reachability check
-        ax2.clear()
-        si_tmp.plot(ax=ax2, color='green')
-        sj_tmp.plot(ax2, color='red', hatch='o', alpha=0.5)
-        plot_transition_arrow(si_tmp, sj_tmp, ax2)
-        
-        S0.plot(ax2, color='none', hatch='/', alpha=0.3)
-        fig.canvas.draw()
-        
-        # plot partition
-        ax1.clear()
-        plot_partition(tmp_part, transitions.T, ax=ax1, color_seed=23)
-        
-        # plot dynamics
-        ssys.plot(ax1, show_domain=False)
-        
-        # plot hatched continuous propositions
-        part.plot_props(ax1)
-        
-        fig.canvas.draw()
-        
-        # scale view based on domain,
-        # not only the current polytopes si, sj
-        l,u = part.domain.bounding_box
-        ax2.set_xlim(l[0,0], u[0,0])
-        ax2.set_ylim(l[1,0], u[1,0])
-        
-        if save_img:
-            fname = 'movie' +str(iter_count).zfill(3)
-            fname += '.' + file_extension
-            fig.savefig(fname, dpi=250)
-        plt.pause(1)
-
+            
+            # plot pair under reachability check
+            ax2.clear()
+            si.plot(ax=ax2, color='green')
+            sj.plot(ax2, color='red', hatch='o', alpha=0.5)
+            plot_transition_arrow(si, sj, ax2)
+            
+            S0.plot(ax2, color='none', hatch='/', alpha=0.3)
+            fig.canvas.draw()
+            
+            # plot partition
+            ax1.clear()
+            plot_partition(tmp_part, transitions.to_lil().T, ax=ax1,
+                           color_seed=23)
+            
+            # plot dynamics
+            ssys.plot(ax1, show_domain=False)
+            
+            # plot hatched continuous propositions
+            part.plot_props(ax1)
+            
+            fig.canvas.draw()
+            
+            # scale view based on domain,
+            # not only the current polytopes si, sj
+            l,u = part.domain.bounding_box
+            ax2.set_xlim(l[0,0], u[0,0])
+            ax2.set_ylim(l[1,0], u[1,0])
+            
+            if save_img:
+                fname = 'movie' +str(iter_count).zfill(3)
+                fname += '.' + file_extension
+                fig.savefig(fname, dpi=250)
+            plt.pause(1)
+    finally:
+        if speculator is not None:
+            speculator.close()
+
+    if ckpt is not None:
+        ckpt.close(iter_count)
+    
+    logger.info('pairs checked: ' + str(n_checked) +
+                ', pruned by bounding boxes: ' + str(n_pruned))
+    
+    # (j, i) stands for i ---> j
+    unexplored = [(i, j) for j, i in IJ]
+    if stopped is not None:
+        logger.warning(
+            'discretize stopped by ' + stopped + ', ' +
+            str(len(unexplored)) + ' pairs of cells not checked')
+    
     new_part = PropPreservingPartition(
         domain=part.domain,
-        regions=sol, adj=sp.lil_matrix(adj),
+        regions=sol, adj=adj.to_lil(),
         prop_regions=part.prop_regions
     )
     
@@ -1026,7 +1373,7 @@ def discretize(
     # Generate transition system and add transitions       
     ofts = trs.FTS()
     
-    adj = sp.lil_matrix(transitions.T)
+    adj = sp.lil_matrix(transitions.to_lil().T)
     n = adj.shape[0]
     ofts_states = range(n)
     
@@ -1066,7 +1413,7 @@ def discretize(
         ax.set_ylabel('progress ratio')
         ax.figure.savefig('progress.pdf')
     
-    return AbstractPwa(
+    ab = AbstractPwa(
         ppp=new_part,
         ts=ofts,
         ppp2ts=ofts_states,
@@ -1076,11 +1423,122 @@ def discretize(
         ppp2sys=subsys_list,
         orig_ppp=orig_ppp,
         ppp2orig=ppp2orig,
-        disc_params=param
+        disc_params=param,
+        stats={
+            'n_checked':n_checked,
+            'n_pruned':n_pruned,
+            'stopped':stopped,
+            'unexplored':unexplored,
+            'n_not_split':n_not_split
+        }
     )
+    # results within time or iterations are incomplete
+    if cache_dir is not None and stopped is None:
+        cache.put(cache_key, ab)
+    return ab
+
+def _resume(path, params):
+    """Return refinement state saved in checkpoint file.
+    
+    @param params: arguments of L{discretize},
+        compared to those saved in the checkpoint.
+        The partition and dynamics are compared
+        by their L{hash_key} in C{params['inputs']}.
+    
+    @raise ValueError: if C{params} differ from those saved
+    
+    @return: C{(sol, adj, transitions, IJ, orig,
+        subsys_list, iter_count)}
+    """
+    saved_params, state, records = load_checkpoint(path)
+    differ = [k for k in params if saved_params.get(k) != params[k]]
+    if differ:
+        raise ValueError(
+            'checkpoint ' + str(path) + ' was written with different '
+            'values of: ' + ', '.join(sorted(differ))
+        )
+    
+    sol = state['sol']
+    orig = state['orig']
+    subsys_list = state['subsys_list']
+    iter_count = state['iter_count']
+    
+    n = len(sol)
+    rels = {
+        'adj':_SparseRelation(n),
+        'transitions':_SparseRelation(n),
+        'IJ':_Worklist(n)
+    }
+    for name, rel in rels.iteritems():
+        for r, c in state[name]:
+            rel.add(r, c)
+    
+    for iter_count, ops in records:
+        for op in ops:
+            if op[0] == 'split':
+                _, i, si, difflist = op
+                sol[i] = si
+                sol.extend(difflist)
+                if subsys_list is not None:
+                    subsys_list.extend([subsys_list[i]] * len(difflist))
+                if not params['conservative']:
+                    orig.extend([orig[i]] * len(difflist))
+            else:
+                name, method = op[:2]
+                getattr(rels[name], method)(*op[2:])
+    return (sol, rels['adj'], rels['transitions'], rels['IJ'],
+            orig, subsys_list, iter_count)
+
+def _reachable_within(trans_length, adj, i, backward=False):
+    """Find cells reachable from cell C{i} within trans_length hops.
+    
+    Equals the support of row C{i} of the matrix power
+    C{adj**trans_length} (column C{i} if C{backward}),
+    computed without forming any matrix product.
+    
+    @type adj: L{_SparseRelation}
+    
+    @rtype: set of cell indices
+    """
+    if backward:
+        step = adj.col
+    else:
+        step = adj.row
+    
+    reached = set(step(i))
+    k = 1
+    while k < trans_length:
+        frontier = set()
+        for v in reached:
+            frontier.update(step(v))
+        reached = frontier
+        k += 1
+    return reached
+
+def _sym_adj_change(IJ, adj, transitions, i, trans_length=1):
+    """Reset the pairs to check in row and column C{i} of C{IJ}.
+    
+    A pair remains to be checked if its cells are within
+    C{trans_length} hops and no transition has been found yet.
+    """
+    horizontal = _reachable_within(trans_length, adj, i)
+    horizontal.difference_update(transitions.row(i))
+    
+    vertical = _reachable_within(trans_length, adj, i, backward=True)
+    vertical.difference_update(transitions.col(i))
+    
+    IJ.clear_row(i)
+    IJ.clear_col(i)
+    for k in horizontal:
+        IJ.add(i, k)
+    for k in vertical:
+        IJ.add(k, i)
 
 def reachable_within(trans_length, adj_k, adj):
     """Find cells reachable within trans_length hops.
+    
+    Dense version, see L{_reachable_within} for the one
+    used by L{discretize}.
     """
     if trans_length <= 1:
         return adj_k
@@ -1100,6 +1558,272 @@ def sym_adj_change(IJ, adj_k, transitions, i):
     IJ[i, :] = horizontal.astype(int)
     IJ[:, i] = vertical.astype(int)
 
+class _SparseRelation(object):
+    """Growable sparse 0-1 square matrix.
+    
+    Stores the nonzero entries both by row and by column,
+    so that rows and columns can be read and cleared
+    in time proportional to their number of nonzeros.
+    """
+    def __init__(self, n=0):
+        self._rows = [set() for k in xrange(n)]
+        self._cols = [set() for k in xrange(n)]
+        self._nnz = 0
+        self._log = None
+        self._name = None
+    
+    @classmethod
+    def from_matrix(cls, m):
+        """Return relation with the nonzero entries of matrix C{m}.
+        
+        @type m: scipy.sparse matrix or 2d array
+        """
+        rel = cls(m.shape[0])
+        if sp.issparse(m):
+            rows, cols = m.nonzero()
+        else:
+            rows, cols = np.nonzero(m)
+        for r, c in zip(rows, cols):
+            rel.add(int(r), int(c))
+        return rel
+    
+    def __len__(self):
+        """Return number of nonzero entries."""
+        return self._nnz
+    
+    def __nonzero__(self):
+        return self._nnz > 0
+    
+    def __contains__(self, pair):
+        r, c = pair
+        return c in self._rows[r]
+    
+    def __iter__(self):
+        for r, cols in enumerate(self._rows):
+            for c in sorted(cols):
+                yield (r, c)
+    
+    def __str__(self):
+        return str(self.to_lil().todense())
+    
+    @property
+    def shape(self):
+        n = len(self._rows)
+        return (n, n)
+    
+    def log_to(self, log, name):
+        """Record subsequent changes in C{log} under C{name}.
+        
+        @type log: L{CheckpointLog}
+        """
+        self._log = log
+        self._name = name
+    
+    def grow(self, k):
+        """Append C{k} empty rows and columns."""
+        self._rows.extend(set() for x in xrange(k))
+        self._cols.extend(set() for x in xrange(k))
+        if self._log is not None:
+            self._log.record((self._name, 'grow', k))
+    
+    def add(self, r, c):
+        if c in self._rows[r]:
+            return False
+        self._rows[r].add(c)
+        self._cols[c].add(r)
+        self._nnz += 1
+        if self._log is not None:
+            self._log.record((self._name, 'add', r, c))
+        return True
+    
+    def remove(self, r, c):
+        if c not in self._rows[r]:
+            return False
+        self._rows[r].remove(c)
+        self._cols[c].remove(r)
+        self._nnz -= 1
+        if self._log is not None:
+            self._log.record((self._name, 'remove', r, c))
+        return True
+    
+    def row(self, r):
+        """Return column indices of nonzeros in row C{r}."""
+        return self._rows[r]
+    
+    def col(self, c):
+        """Return row indices of nonzeros in column C{c}."""
+        return self._cols[c]
+    
+    def clear_row(self, r):
+        for c in list(self._rows[r]):
+            self.remove(r, c)
+    
+    def clear_col(self, c):
+        for r in list(self._cols[c]):
+            self.remove(r, c)
+    
+    def to_lil(self, dtype=int):
+        """Return as C{scipy.sparse.lil_matrix}."""
+        rows = np.fromiter(
+            (r for r, cols in enumerate(self._rows) for c in cols),
+            dtype=int, count=self._nnz)
+        cols = np.fromiter(
+            (c for cols in self._rows for c in cols),
+            dtype=int, count=self._nnz)
+        data = np.ones(self._nnz, dtype=dtype)
+        return sp.coo_matrix(
+            (data, (rows, cols)), shape=self.shape
+        ).tolil()
+
+class _Worklist(_SparseRelation):
+    """Pairs of cells that remain to be checked in L{discretize}.
+    
+    Pairs are popped in increasing order of their key,
+    by default C{(row, column)},
+    i.e., in the same order as C{np.nonzero} visits a dense matrix.
+    The key of a pair is computed when it is added.
+    Removed pairs are discarded lazily from the heap,
+    which is rebuilt when they outnumber the pairs.
+    """
+    def __init__(self, n=0):
+        super(_Worklist, self).__init__(n)
+        self._heap = []
+        self._key = None
+        # key of each pair when last added
+        self._keys = dict()
+    
+    def set_key(self, key):
+        """Order pairs by C{key(row, column)} from now on.
+        
+        @param key: callable, or C{None} for C{(row, column)}
+        """
+        self._key = key
+        self._keys = {pair:self._key_of(*pair) for pair in self}
+        self._rebuild_heap()
+    
+    def _rebuild_heap(self):
+        self._heap = [(k, pair) for pair, k in self._keys.iteritems()]
+        heapq.heapify(self._heap)
+    
+    def _key_of(self, r, c):
+        if self._key is None:
+            return (r, c)
+        return self._key(r, c)
+    
+    def add(self, r, c):
+        added = super(_Worklist, self).add(r, c)
+        if added:
+            k = self._key_of(r, c)
+            self._keys[(r, c)] = k
+            heapq.heappush(self._heap, (k, (r, c)))
+        return added
+    
+    def remove(self, r, c):
+        removed = super(_Worklist, self).remove(r, c)
+        if removed:
+            del self._keys[(r, c)]
+            if len(self._heap) > 2 * len(self._keys):
+                self._rebuild_heap()
+        return removed
+    
+    def _is_current(self, k, pair):
+        return pair in self._keys and self._keys[pair] == k
+    
+    def pop(self):
+        """Remove and return the least pair.
+        
+        @rtype: C{(row, column)}
+        """
+        while self._heap:
+            k, pair = heapq.heappop(self._heap)
+            if self._is_current(k, pair):
+                self.remove(*pair)
+                return pair
+        raise KeyError('pop from empty worklist')
+    
+    def peek(self, k):
+        """Return the C{k} least pairs, without removing them."""
+        entries = []
+        while self._heap and len(entries) < k:
+            entry = heapq.heappop(self._heap)
+            if self._is_current(*entry) and entry not in entries[-1:]:
+                entries.append(entry)
+        for entry in entries:
+            heapq.heappush(self._heap, entry)
+        return [pair for key, pair in entries]
+
+# keys of pairs si ---> sj, see the argument priority of discretize
+_PRIORITIES = {
+    'volume':lambda si, sj: -geometry(si).volume,
+    'props':lambda si, sj: si.props == sj.props
+}
+
+def _solve_feasible_star(args):
+    return solve_feasible(*args)
+
+class _Speculator(object):
+    """Compute reachable sets for the next pairs in a process pool.
+    
+    Each result is tagged with the versions of the two cells
+    it was computed for. A split of a cell increments its version,
+    so results that refer to the old cell are never used.
+    
+    @param feasible_args: callable that returns the arguments
+        of L{solve_feasible} for a pair of cell indices C{(i, j)}
+    @param may_reach: callable that returns C{False}
+        for pairs that need no reachable set
+    """
+    def __init__(self, n_jobs, feasible_args, may_reach=None):
+        self.n_jobs = n_jobs
+        self.feasible_args = feasible_args
+        self.may_reach = may_reach
+        self.version = collections.defaultdict(int)
+        self.pending = dict()
+        self.pool = mp.Pool(n_jobs)
+        self.n_used = 0
+        self.n_discarded = 0
+    
+    def result(self, IJ, j, i):
+        """Return reachable set for i ---> j, after the next ones start.
+        
+        @param IJ: worklist, to look ahead for pairs to submit
+        """
+        for pair in IJ.peek(2 * self.n_jobs):
+            if pair in self.pending:
+                continue
+            if self.may_reach is not None and \
+               not self.may_reach(pair[1], pair[0]):
+                continue
+            self._submit(*pair)
+        
+        tag = (self.version[i], self.version[j])
+        entry = self.pending.pop((j, i), None)
+        if entry is not None and entry[0] == tag:
+            self.n_used += 1
+            return entry[1].get()
+        return solve_feasible(*self.feasible_args(i, j))
+    
+    def split(self, i):
+        """Invalidate results involving cell C{i}."""
+        self.version[i] += 1
+        stale = [pair for pair in self.pending if i in pair]
+        for pair in stale:
+            del self.pending[pair]
+        self.n_discarded += len(stale)
+    
+    def close(self):
+        """Stop the workers, discarding the results not used."""
+        self.pool.terminate()
+        self.pool.join()
+        logger.info('speculative results used: ' + str(self.n_used) +
+                    ', discarded: ' + str(self.n_discarded))
+    
+    def _submit(self, j, i):
+        tag = (self.version[i], self.version[j])
+        args = self.feasible_args(i, j)
+        handle = self.pool.apply_async(_solve_feasible_star, (args,))
+        self.pending[(j, i)] = (tag, handle)
+
 # DEFUNCT until further notice
 def discretize_overlap(closed_loop=False, conservative=False):
     """default False.
@@ -1183,88 +1907,170 @@ def discretize_overlap(closed_loop=False, conservative=False):
 #     return new_part
 
 def multiproc_discretize(q, mode, ppp, cont_dyn, disc_params):
-    global logger
-    logger = mp.log_to_stderr()
-    
-    name = mp.current_process().name
-    print('Abstracting mode: ' + str(mode) + ', on: ' + str(name))
+    """Put C{(mode, abstraction)} in queue C{q}.
     
+    Deprecated: L{multiproc_discretize_switched} abstracts
+    the modes on its own pool of workers.
+    """
+    warnings.warn(
+        'multiproc_discretize is deprecated, '
+        'use multiproc_discretize_switched', DeprecationWarning)
     absys = discretize(ppp, cont_dyn, **disc_params)
-    
     q.put((mode, absys))
-    print('Worker: ' + str(name) + 'finished.')
 
 def multiproc_get_transitions(
     q, absys, mode, ssys, params
 ):
-    global logger
-    logger = mp.log_to_stderr()
-    
-    name = mp.current_process().name
-    print('Merged transitions for mode: ' + str(mode) + ', on: ' + str(name))
+    """Put C{(mode, transitions)} in queue C{q}.
     
+    Deprecated: L{get_transitions} checks the transitions
+    on a pool of workers if C{n_jobs > 1}.
+    """
+    warnings.warn(
+        'multiproc_get_transitions is deprecated, '
+        'use get_transitions with n_jobs > 1', DeprecationWarning)
     trans = get_transitions(absys, mode, ssys, **params)
-    
     q.put((mode, trans))
-    print('Worker: ' + str(name) + 'finished.')
 
 def multiproc_discretize_switched(
     ppp, hybrid_sys, disc_params=None,
-    plot=False, show_ts=False, only_adjacent=True
+    plot=False, show_ts=False, only_adjacent=True,
+    n_jobs=None, batches_per_job=4, tmp_dir=None,
+    feasibility_cache=None
 ):
     """Parallel implementation of discretize_switched.
     
-    Uses the multiprocessing package.
+    Uses a bounded pool of worker processes (see L{_TaskPool})
+    for three phases:
+    
+      1. the modes are abstracted with L{discretize},
+      2. their partitions are merged with
+         L{multiproc_merge_partitions},
+      3. the candidate transitions of each mode
+         over the merged partition are split into batches
+         of source cells, checked as in L{get_transitions}.
+    
+    Partitions and abstractions are passed to and from workers
+    as files written by L{storage.save}, which are memory-mapped
+    when loaded, instead of being pickled through pipes.
+    If a worker raises an exception or dies,
+    then the remaining workers are stopped
+    and C{RuntimeError} raised.
+    
+    For the other arguments see L{discretize_switched}.
+    The abstractions of the modes are returned with their
+    partitions as L{PackedPartition}s.
+    
+    Each mode is abstracted serially in a worker process,
+    so C{'n_jobs'} in C{disc_params} is ignored.
+    Checkpoints and caches of abstractions are supported
+    by L{discretize_switched}, not here.
+    
+    @param n_jobs: number of worker processes,
+        if C{None}, then C{multiprocessing.cpu_count()}
+    @type n_jobs: int >= 1
+    
+    @param batches_per_job: number of batches of transitions
+        per worker process, more batches balance the load better
+    @type batches_per_job: int >= 1
+    
+    @param tmp_dir: directory for the files shared with workers,
+        if C{None}, then a temporary directory,
+        removed before returning
+    @type tmp_dir: str
+    
+    @rtype: L{AbstractSwitched}
+    
+    @raise ValueError: if C{disc_params} of a mode contain
+        C{'checkpoint'}, C{'resume_from'} or C{'cache_dir'}
     """
     logger.info('parallel discretize_switched started')
     
+    if disc_params is None:
+        disc_params = {'N':1, 'trans_length':1}
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+    
     modes = hybrid_sys.modes
     mode_nums = hybrid_sys.disc_domain_size
     
-    q = mp.Queue()
-    
-    mode_args = dict()
     for mode in modes:
-        cont_dyn = hybrid_sys.dynamics[mode]
-        mode_args[mode] = (q, mode, ppp, cont_dyn, disc_params[mode])
-    
-    jobs = [mp.Process(target=multiproc_discretize, args=args)
-            for args in mode_args.itervalues()]
-    for job in jobs:
-        job.start()
-    
-    # flush before join:
-    #   http://stackoverflow.com/questions/19071529/
-    abstractions = dict()
-    for job in jobs:
-        mode, absys = q.get()
-        abstractions[mode] = absys
-    
-    for job in jobs:
-        job.join()
-    
-    # merge their domains
-    (merged_abstr, ap_labeling) = merge_partitions(abstractions)
-    n = len(merged_abstr.ppp)
-    logger.info('Merged partition has: ' + str(n) + ', states')
-    
-    # find feasible transitions over merged partition
-    for mode in modes:
-        cont_dyn = hybrid_sys.dynamics[mode]
-        params = disc_params[mode]
+        for k in ('checkpoint', 'resume_from', 'cache_dir'):
+            if disc_params[mode].get(k) is not None:
+                raise ValueError(
+                    k + ' is not supported by multiproc_discretize_switched,'
+                    ' use discretize_switched instead')
+    
+    remove_tmp = tmp_dir is None
+    if tmp_dir is None:
+        tmp_dir = tempfile.mkdtemp(prefix='tulip_')
+    elif not os.path.isdir(tmp_dir):
+        os.makedirs(tmp_dir)
+    
+    pool = _TaskPool(n_jobs)
+    try:
+        ppp_file = os.path.join(tmp_dir, 'ppp.npz')
+        if not isinstance(ppp, p2p.PackedPartition):
+            p2p.PackedPartition.from_partition(ppp).save(ppp_file)
+        else:
+            ppp.save(ppp_file)
+        
+        args = []
+        for k, mode in enumerate(modes):
+            params = dict(disc_params[mode])
+            # workers cannot start their own processes
+            params.pop('n_jobs', None)
+            if feasibility_cache is not None:
+                params.setdefault('feasibility_cache', feasibility_cache)
+            args.append(
+                (ppp_file, hybrid_sys.dynamics[mode], params,
+                 os.path.join(tmp_dir, 'mode' + str(k) + '.npz')))
+        files = pool.map(_discretize_to_file, args)
+        abstractions = {
+            mode:AbstractPwa.load(fname)
+            for mode, fname in zip(modes, files)
+        }
         
-        mode_args[mode] = (q, merged_abstr, mode, cont_dyn, params)
-    
-    jobs = [mp.Process(target=multiproc_get_transitions, args=args)
-            for args in mode_args.itervalues()]
-    
-    for job in jobs:
-        job.start()
-    
-    trans = dict()
-    for job in jobs:
-        mode, t = q.get()
-        trans[mode] = t
+        # merge their domains
+        (merged_abstr, ap_labeling) = multiproc_merge_partitions(
+            abstractions, pool=pool)
+        n = len(merged_abstr.ppp)
+        logger.info('Merged partition has: ' + str(n) + ', states')
+        
+        # find feasible transitions over merged partition
+        merged_file = os.path.join(tmp_dir, 'merged.npz')
+        merged_abstr.save(merged_file)
+        
+        n_batches = max(1, int(math.ceil(
+            float(batches_per_job * n_jobs) / len(modes))))
+        args = []
+        for mode in modes:
+            params = disc_params[mode]
+            IJ = _candidate_transitions(merged_abstr.ppp,
+                                        params['trans_length'])
+            (J, I) = IJ.nonzero()
+            for rows in np.array_split(np.unique(I), n_batches):
+                if len(rows) == 0:
+                    continue
+                batch = np.in1d(I, rows)
+                args.append((merged_file, mode, params['N'], True,
+                             zip(I[batch], J[batch]), feasibility_cache))
+        results = pool.map(_transitions_batch, args)
+        
+        trans = dict()
+        for mode in modes:
+            pairs = []
+            feasible = []
+            for a, r in zip(args, results):
+                if a[1] == mode:
+                    pairs += a[4]
+                    feasible += r
+            (I, J) = zip(*pairs) if pairs else ([], [])
+            trans[mode] = _transition_matrix(n, I, J, feasible)
+    finally:
+        pool.close()
+        if remove_tmp:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
     
     # merge the abstractions, creating a common TS
     merge_abstractions(merged_abstr, trans,
@@ -1275,9 +2081,134 @@ def multiproc_discretize_switched(
     
     return merged_abstr
 
+def _discretize_to_file(ppp_file, cont_dyn, params, fname):
+    """Abstract C{cont_dyn} over partition in C{ppp_file}.
+    
+    Task of L{multiproc_discretize_switched}.
+    
+    @return: C{fname}, where the abstraction is saved
+    """
+    ppp = p2p.PackedPartition.load(ppp_file).to_partition()
+    absys = discretize(ppp, cont_dyn, **params)
+    absys.save(fname)
+    return fname
+
+# merged abstractions loaded by this worker process
+_merged_files = dict()
+
+def _transitions_batch(fname, mode, N, closed_loop, pairs,
+                       feasibility_cache=None):
+    """Check candidate transitions C{pairs} in C{mode}.
+    
+    Task of L{get_transitions} and L{multiproc_discretize_switched}.
+    
+    @param fname: file of merged abstraction
+    @param pairs: candidate transitions C{(i, j)}
+    @param feasibility_cache: see L{solve_feasible}
+    @return: result of L{_merged_transition} for each pair
+    @rtype: list of C{(feasible, pruned)}
+    """
+    abstract_sys = _merged_files.get(fname)
+    if abstract_sys is None:
+        abstract_sys = AbstractSwitched.load(fname)
+        _merged_files.clear()
+        _merged_files[fname] = abstract_sys
+    return [_merged_transition(abstract_sys, mode, i, j, N, closed_loop,
+                               feasibility_cache)
+            for i, j in pairs]
+
+class _TaskPool(object):
+    """Bounded pool of worker processes that fail loudly.
+    
+    Unlike C{multiprocessing.Pool}, the death of a worker,
+    e.g., killed or crashed in a solver, raises C{RuntimeError}
+    in L{map}, instead of leaving its task pending forever.
+    Tasks are taken by workers when they become idle.
+    
+    Functions passed to L{map} must be defined at module level,
+    so that they can be pickled.
+    """
+    def __init__(self, n_jobs=None, poll=0.5):
+        """Start C{n_jobs} worker processes.
+        
+        @param poll: seconds between checks that workers are alive
+        """
+        if n_jobs is None:
+            n_jobs = mp.cpu_count()
+        self.poll = poll
+        self._tasks = mp.Queue()
+        self._results = mp.Queue()
+        self._workers = [
+            mp.Process(target=_task_worker,
+                       args=(self._tasks, self._results))
+            for k in xrange(n_jobs)
+        ]
+        for w in self._workers:
+            w.daemon = True
+            w.start()
+    
+    def map(self, func, args):
+        """Return C{[func(*a) for a in args]}, computed by the workers.
+        
+        @raise RuntimeError: if C{func} raises an exception,
+            with the traceback as message, or if a worker exits.
+            The pool is terminated in both cases.
+        """
+        args = list(args)
+        for k, a in enumerate(args):
+            self._tasks.put((k, func, a))
+        results = [None] * len(args)
+        remaining = len(args)
+        while remaining:
+            try:
+                (k, ok, value) = self._results.get(timeout=self.poll)
+            except Queue.Empty:
+                dead = [w for w in self._workers if not w.is_alive()]
+                if dead:
+                    self.terminate()
+                    raise RuntimeError(
+                        'worker process ' + dead[0].name +
+                        ' exited with code ' + str(dead[0].exitcode))
+                continue
+            if not ok:
+                self.terminate()
+                raise RuntimeError('task failed in worker process:\n' + value)
+            results[k] = value
+            remaining -= 1
+        return results
+    
+    def close(self):
+        """Stop the workers after their current tasks."""
+        for w in self._workers:
+            if w.is_alive():
+                self._tasks.put(None)
+        for w in self._workers:
+            w.join()
+    
+    def terminate(self):
+        """Stop the workers immediately."""
+        for w in self._workers:
+            if w.is_alive():
+                w.terminate()
+        for w in self._workers:
+            w.join()
+
+def _task_worker(tasks, results):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        (k, func, args) = task
+        try:
+            results.put((k, True, func(*args)))
+        except Exception:
+            results.put((k, False, traceback.format_exc()))
+
 def discretize_switched(
     ppp, hybrid_sys, disc_params=None,
-    plot=False, show_ts=False, only_adjacent=True
+    plot=False, show_ts=False, only_adjacent=True,
+    checkpoint_dir=None, resume_from=None, cache_dir=None,
+    n_jobs=1, feasibility_cache=None
 ):
     """Abstract switched dynamics over given partition.
     
@@ -1295,6 +2226,40 @@ def discretize_switched(
     
     @param show_ts, only_adjacent: options for L{AbstractPwa.plot}.
     
+    @param checkpoint_dir: directory where the abstraction of each mode
+        is saved when completed, together with the checkpoint file
+        of the mode being abstracted (see L{discretize}).
+    @type checkpoint_dir: str
+    
+    @param resume_from: C{checkpoint_dir} of a previous call
+        with the same arguments, to continue from.
+        Completed modes are loaded, the rest resumed
+        from their checkpoint file, if any.
+        It may be the same as C{checkpoint_dir}.
+    @type resume_from: str
+    
+    @param cache_dir: directory of abstractions computed before,
+        see L{AbstractionCache}. Both the merged abstraction
+        and the abstraction of each mode are cached,
+        so modes not changed since a previous call
+        are not abstracted again.
+        The merged partition is returned as
+        L{PropPreservingPartition} in either case,
+        the partitions of modes found in the cache
+        as L{PackedPartition}s, see L{discretize}.
+        Ignored if the C{'priority'} of any mode is callable.
+    @type cache_dir: str
+    
+    @param n_jobs: number of processes that merge the partitions
+        of the modes, see L{multiproc_merge_partitions},
+        and check transitions, see L{get_transitions}
+    @type n_jobs: int >= 1
+    
+    @param feasibility_cache: memo of reachable sets,
+        passed to L{discretize} for each mode,
+        unless in C{disc_params}, and to L{get_transitions}
+    @type feasibility_cache: L{FeasibilityCache}
+    
     @return: abstracted dynamics,
         some attributes are dict keyed by mode
     @rtype: L{AbstractSwitched}
@@ -1302,53 +2267,145 @@ def discretize_switched(
     if disc_params is None:
         disc_params = {'N':1, 'trans_length':1}
     
+    # callables cannot be hashed
+    if any(callable(params.get('priority'))
+           for params in disc_params.itervalues()):
+        cache_dir = None
+    if cache_dir is not None:
+        cache = AbstractionCache(cache_dir)
+        cache_key = hash_key(
+            'discretize_switched', ppp, hybrid_sys, disc_params)
+        merged_abstr = cache.get(cache_key)
+        if merged_abstr is not None:
+            merged_abstr.ppp = merged_abstr.ppp.to_partition()
+            if plot:
+                plot_mode_partitions(merged_abstr, show_ts, only_adjacent)
+            return merged_abstr
+    
     logger.info('discretizing hybrid system')
     
     modes = hybrid_sys.modes
     mode_nums = hybrid_sys.disc_domain_size
     
+    if checkpoint_dir is not None and not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    
     # discretize each abstraction separately
     abstractions = dict()
-    for mode in modes:
+    for k, mode in enumerate(modes):
         logger.debug(30*'-'+'\n')
         logger.info('Abstracting mode: ' + str(mode))
         
         cont_dyn = hybrid_sys.dynamics[mode]
+        params = dict(disc_params[mode])
+        
+        absys = None
+        if resume_from is not None:
+            fname = os.path.join(resume_from, 'mode' + str(k) + '.done')
+            if os.path.exists(fname):
+                absys = _load_mode_result(fname, mode)
+                logger.info('loaded abstraction of mode ' + str(mode))
+            
+            fname = os.path.join(resume_from, 'mode' + str(k) + '.ckpt')
+            if absys is None and os.path.exists(fname):
+                params['resume_from'] = fname
+        
+        if absys is None:
+            if checkpoint_dir is not None:
+                params['checkpoint'] = os.path.join(
+                    checkpoint_dir, 'mode' + str(k) + '.ckpt')
+            if cache_dir is not None:
+                params['cache_dir'] = cache_dir
+            if feasibility_cache is not None:
+                params.setdefault('feasibility_cache', feasibility_cache)
+            
+            absys = discretize(ppp, cont_dyn, **params)
+            loaded = False
+        else:
+            loaded = True
         
-        absys = discretize(
-            ppp, cont_dyn,
-            **disc_params[mode]
-        )
+        if checkpoint_dir is not None and not (
+            loaded and checkpoint_dir == resume_from
+        ):
+            _save_mode_result(
+                os.path.join(checkpoint_dir, 'mode' + str(k) + '.done'),
+                mode, absys
+            )
         logger.debug('Mode Abstraction:\n' + str(absys) +'\n')
         
         abstractions[mode] = absys
     
     # merge their domains
-    (merged_abstr, ap_labeling) = merge_partitions(abstractions)
+    if n_jobs > 1:
+        (merged_abstr, ap_labeling) = multiproc_merge_partitions(
+            abstractions, n_jobs)
+    else:
+        (merged_abstr, ap_labeling) = merge_partitions(abstractions)
     n = len(merged_abstr.ppp)
     logger.info('Merged partition has: ' + str(n) + ', states')
 
     # find feasible transitions over merged partition
+    # with one pool and one file for all modes
     trans = dict()
-    for mode in modes:
-        cont_dyn = hybrid_sys.dynamics[mode]
-        
-        params = disc_params[mode]
-        
-        trans[mode] = get_transitions(
-            merged_abstr, mode, cont_dyn,
-            N=params['N'], trans_length=params['trans_length']
-        )
+    pool = None
+    tmp_dir = None
+    merged_file = None
+    try:
+        if n_jobs > 1:
+            tmp_dir = tempfile.mkdtemp(prefix='tulip_')
+            merged_file = os.path.join(tmp_dir, 'merged.npz')
+            merged_abstr.save(merged_file)
+            pool = _TaskPool(n_jobs)
+        for mode in modes:
+            cont_dyn = hybrid_sys.dynamics[mode]
+            
+            params = disc_params[mode]
+            
+            trans[mode] = get_transitions(
+                merged_abstr, mode, cont_dyn,
+                N=params['N'], trans_length=params['trans_length'],
+                n_jobs=n_jobs, pool=pool, fname=merged_file,
+                feasibility_cache=feasibility_cache
+            )
+    finally:
+        if pool is not None:
+            pool.close()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
     # merge the abstractions, creating a common TS
     merge_abstractions(merged_abstr, trans,
                        abstractions, modes, mode_nums)
     
+    # results within time or iterations are incomplete
+    complete = all(
+        absys.stats.get('stopped') is None
+        for absys in abstractions.itervalues())
+    if cache_dir is not None and complete:
+        cache.put(cache_key, merged_abstr)
+    
     if plot:
         plot_mode_partitions(merged_abstr, show_ts, only_adjacent)
     
     return merged_abstr
         
+def _save_mode_result(fname, mode, absys):
+    """Pickle abstraction of C{mode}, replacing C{fname} atomically."""
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump((mode, absys), f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, fname)
+
+def _load_mode_result(fname, mode):
+    with open(fname, 'rb') as f:
+        (saved_mode, absys) = pickle.load(f)
+    if saved_mode != mode:
+        raise ValueError(
+            str(fname) + ' is the abstraction of mode ' +
+            str(saved_mode) + ', not ' + str(mode)
+        )
+    return absys
+
 def plot_mode_partitions(swab, show_ts, only_adjacent):
     """Save each mode's partition and final merged partition.
     """
@@ -1453,79 +2510,268 @@ def merge_abstractions(merged_abstr, trans, abstr, modes, mode_nums):
 def get_transitions(
     abstract_sys, mode, ssys, N=10,
     closed_loop=True,
-    trans_length=1
+    trans_length=1, n_jobs=1, chunk_size=256,
+    pool=None, fname=None, feasibility_cache=None
 ):
     """Find which transitions are feasible in given mode.
     
     Used for the candidate transitions of the merged partition.
-    
-    @rtype: scipy.sparse.lil_matrix
+    The candidates are the pairs of cells within C{trans_length}
+    steps in the adjacency graph of C{abstract_sys.ppp}.
+    
+    @param n_jobs: number of worker processes that check
+        chunks of candidates (see L{_TaskPool}).
+        The abstraction is passed to them in a file,
+        see L{AbstractSwitched.save}.
+    @type n_jobs: int >= 1
+    
+    @param chunk_size: number of candidates per task
+    @type chunk_size: int >= 1
+    
+    @param pool: workers to check the candidates,
+        instead of starting C{n_jobs} new ones.
+        Pass the same pool and C{fname} when calling
+        for each mode of the same abstraction.
+    @type pool: L{_TaskPool}
+    
+    @param fname: file where C{abstract_sys} has been saved,
+        if C{None}, then it is saved in a temporary file
+        before starting the workers
+    @type fname: str
+    
+    @param feasibility_cache: memo of reachable sets,
+        passed to L{solve_feasible}, also by the workers
+    @type feasibility_cache: L{FeasibilityCache}
+    
+    @return: entry C{(i, j)} is 1 if C{i ---> j} is feasible
+    @rtype: scipy.sparse.csr_matrix
     """
     logger.info('checking which transitions remain feasible after merging')
     part = abstract_sys.ppp
-    
-    # Initialize matrix for pairs to check
-    IJ = part.adj.copy()
-    if trans_length > 1:
-        k = 1
-        while k < trans_length:
-            IJ = np.dot(IJ, part.adj)
-            k += 1
-        IJ = (IJ > 0).astype(int)
-    
-    # Initialize output
     n = len(part)
-    transitions = sp.lil_matrix((n, n), dtype=int)
     
-    # Do the abstraction
-    n_checked = 0
-    n_found = 0
-    while np.sum(IJ) > 0:
-        n_checked += 1
-        
-        ind = np.nonzero(IJ)
-        i = ind[1][0]
-        j = ind[0][0]
-        IJ[j,i] = 0
-        
-        logger.debug('checking transition: ' + str(i) + ' -> ' + str(j))
-        
-        si = part[i]
-        sj = part[j]
-        
-        # Use original cell as trans_set
-        trans_set = abstract_sys.ppp2pwa(mode, i)[1]
-        active_subsystem = abstract_sys.ppp2sys(mode, i)[1]
-        
-        trans_feasible = is_feasible(
-            si, sj, active_subsystem, N,
-            closed_loop = closed_loop,
-            trans_set = trans_set
-        )
-                    
-        if trans_feasible:
-            transitions[i, j] = 1 
-            msg = '\t Feasible transition.'
-            n_found += 1
-        else:
-            transitions[i, j] = 0
-            msg = '\t Not feasible transition.'
-        logger.debug(msg)
+    # pairs to check
+    (J, I) = _candidate_transitions(part, trans_length).nonzero()
+    pairs = zip(I, J)
+    
+    if n_jobs == 1 and pool is None:
+        results = [
+            _merged_transition(abstract_sys, mode, i, j, N, closed_loop,
+                               feasibility_cache)
+            for i, j in pairs
+        ]
+    else:
+        own_pool = pool is None
+        tmp_dir = None
+        try:
+            if fname is None:
+                tmp_dir = tempfile.mkdtemp(prefix='tulip_')
+                fname = os.path.join(tmp_dir, 'merged.npz')
+                abstract_sys.save(fname)
+            if own_pool:
+                pool = _TaskPool(n_jobs)
+            args = [
+                (fname, mode, N, closed_loop, pairs[k:k + chunk_size],
+                 feasibility_cache)
+                for k in xrange(0, len(pairs), chunk_size)
+            ]
+            results = sum(pool.map(_transitions_batch, args), [])
+        finally:
+            if own_pool and pool is not None:
+                pool.close()
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+    
+    transitions = _transition_matrix(n, I, J, results)
+    
+    n_checked = len(pairs)
+    n_found = transitions.nnz
+    n_pruned = sum(pruned for feasible, pruned in results)
     logger.info('Checked: ' + str(n_checked))
+    logger.info('Pruned by bounding boxes: ' + str(n_pruned))
     logger.info('Found: ' + str(n_found))
-    logger.info('Survived merging: ' + str(float(n_found) / n_checked) + ' % ')
-            
+    if n_checked:
+        logger.info('Survived merging: ' +
+                    str(float(n_found) / n_checked) + ' % ')
     return transitions
 
-def multiproc_merge_partitions(abstractions):
-    """LOGTIME in #processors parallel merging.
+def _candidate_transitions(part, trans_length=1):
+    """Return matrix of pairs within C{trans_length} adjacency steps.
+    
+    Entry C{(j, i)} stands for the transition C{i ---> j}.
     
-    Assuming sufficient number of processors.
+    @rtype: scipy.sparse.csr_matrix
+    """
+    adj = sp.csr_matrix(part.adj, dtype=bool)
+    IJ = adj
+    for k in xrange(1, trans_length):
+        IJ = IJ.dot(adj)
+    IJ.eliminate_zeros()
+    return IJ
+
+def _transition_matrix(n, I, J, results):
+    """Return sparse matrix of feasible transitions.
+    
+    @param I, J: candidate transitions C{I[k] ---> J[k]}
+    @param results: C{(feasible, pruned)} of each candidate,
+        see L{_merged_transition}
+    @rtype: scipy.sparse.csr_matrix
+    """
+    feasible = np.array([f for f, p in results], dtype=bool)
+    feasible = feasible.reshape(len(I))
+    return sp.csr_matrix(
+        (np.ones(np.sum(feasible), dtype=int),
+         (np.asarray(I)[feasible], np.asarray(J)[feasible])),
+        shape=(n, n))
+
+def _merged_transition(abstract_sys, mode, i, j, N, closed_loop=True,
+                       feasibility_cache=None):
+    """Return whether C{i ---> j} is feasible in C{mode}.
+    
+    @type abstract_sys: L{AbstractSwitched}
+    @return: C{(feasible, pruned)}, where C{pruned}
+        if L{may_reach} rejected the pair
+    @rtype: C{(bool, bool)}
+    """
+    si = abstract_sys.ppp[i]
+    sj = abstract_sys.ppp[j]
+    
+    # Use original cell as trans_set
+    trans_set = abstract_sys.ppp2pwa(mode, i)[1]
+    active_subsystem = abstract_sys.ppp2sys(mode, i)[1]
+    
+    if pc.is_fulldim(si) and not may_reach(
+        si, sj, active_subsystem, N, trans_set
+    ):
+        return (False, True)
+    trans_feasible = is_feasible(
+        si, sj, active_subsystem, N,
+        closed_loop = closed_loop,
+        trans_set = trans_set,
+        feasibility_cache = feasibility_cache
+    )
+    return (trans_feasible, False)
 
-    UNDER DEVELOPMENT; function signature may change without notice.
-    Calling will result in NotImplementedError.
+def multiproc_merge_partitions(abstractions, n_jobs=None, pool=None):
+    """Merge multiple abstractions in a tree of pairwise merges.
+    
+    The partitions of the modes are merged in pairs,
+    then the results in pairs, and so on,
+    so C{log2(len(abstractions))} rounds of merges are needed.
+    The merges of each round are computed by a pool of processes,
+    see L{_TaskPool}.
+    
+    The regions, their order, C{ppp2modes}, adjacency
+    and labeling are the same as returned by L{merge_partitions}.
+    
+    @param abstractions: keyed by mode
+    @type abstractions: dict of L{AbstractPwa}
+    
+    @param n_jobs: number of worker processes,
+        if C{None}, then C{multiprocessing.cpu_count()},
+        if 1, then merges are computed in this process
+    @type n_jobs: int
+    
+    @param pool: workers to compute the merges,
+        instead of starting C{n_jobs} new ones
+    @type pool: L{_TaskPool}
+    
+    @return: (merged_abstraction, ap_labeling),
+        see L{merge_partitions}
     """
-    raise NotImplementedError
+    if len(abstractions) == 0:
+        warnings.warn('Abstractions empty, nothing to merge.')
+        return
+    
+    _check_mergeable(abstractions)
+    
+    # same order of modes as merge_partitions
+    init_mode = abstractions.keys()[0]
+    all_modes = set(abstractions)
+    remaining_modes = all_modes.difference(set([init_mode]))
+    modes = [init_mode] + list(remaining_modes)
+    
+    pieces = []
+    for mode in modes:
+        ab = abstractions[mode]
+        regions = list(ab.ppp)
+        if mode == init_mode:
+            labels = [reg.props for reg in regions]
+        else:
+            labels = [ab.ts.states[j]['ap'] for j in xrange(len(regions))]
+        rows = [(j,) for j in xrange(len(regions))]
+        pieces.append(([mode], regions, rows, labels))
+    
+    own_pool = pool is None and n_jobs != 1 and len(pieces) > 2
+    if own_pool:
+        pool = _TaskPool(n_jobs)
+    try:
+        while len(pieces) > 1:
+            pairs = zip(pieces[0::2], pieces[1::2])
+            logger.info('merging ' + str(len(pairs)) + ' pairs of partitions')
+            if pool is None:
+                merged = map(_merge_pieces, pairs)
+            else:
+                merged = pool.map(_merge_pieces, [(p,) for p in pairs])
+            if len(pieces) % 2:
+                merged.append(pieces[-1])
+            pieces = merged
+    finally:
+        if own_pool:
+            pool.close()
+    
+    (modes, new_list, rows, labels) = pieces[0]
+    if len(modes) == 1:
+        parents = {init_mode:range(len(new_list))}
+    else:
+        parents = {
+            mode:{i:row[k] for i, row in enumerate(rows)}
+            for k, mode in enumerate(modes)
+        }
+    ap_labeling = dict(enumerate(labels))
+    return _merged_abstraction(abstractions, init_mode,
+                               new_list, parents), ap_labeling
+
+def _merge_pieces(pair):
+    """Intersect the regions of two partial merges.
+    
+    Each partial merge is a tuple C{(modes, regions, rows, labels)},
+    where C{rows[i]} are the indices of the regions
+    of the partitions of C{modes} that contain C{regions[i]},
+    and C{labels[i]} its atomic propositions.
+    
+    Regions are ordered as in L{merge_partition_pair}.
+    """
+    (modes1, regions1, rows1, labels1), \
+        (modes2, regions2, rows2, labels2) = pair
+    
+    new_list = []
+    rows = []
+    labels = []
+    index = RegionIndex(regions2)
+    for i, reg in enumerate(regions1):
+        for j in index.query(reg):
+            isect = pc.intersect(reg, regions2[j])
+            rc, xc = pc.cheby_ball(isect)
+            
+            # no intersection ?
+            if rc < 1e-5:
+                continue
+            
+            # if Polytope, make it Region
+            if len(isect) == 0:
+                isect = pc.Region([isect])
+            isect.props = reg.props.copy()
+            
+            if labels1[i] != labels2[j]:
+                msg = 'Inconsistent AP labels between intersecting regions\n'
+                msg += 'of partitions of switched system.'
+                raise Exception(msg)
+            
+            new_list.append(isect)
+            rows.append(rows1[i] + rows2[j])
+            labels.append(labels1[i])
+    return (modes1 + modes2, new_list, rows, labels)
 
 def merge_partitions(abstractions):
     """Merge multiple abstractions.
@@ -1537,29 +2783,16 @@ def merge_partitions(abstractions):
         where:
             - merged_abstraction: L{AbstractSwitched}
             - ap_labeling: dict
+    
+    See Also
+    ========
+    L{multiproc_merge_partitions}
     """
     if len(abstractions) == 0:
         warnings.warn('Abstractions empty, nothing to merge.')
         return
     
-    # consistency check
-    for ab1 in abstractions.itervalues():
-        for ab2 in abstractions.itervalues():
-            p1 = ab1.ppp
-            p2 = ab2.ppp
-            
-            if p1.prop_regions != p2.prop_regions:
-                msg = 'merge: partitions have different sets '
-                msg += 'of continuous propositions'
-                raise Exception(msg)
-            
-            if not (p1.domain.A == p2.domain.A).all() or \
-            not (p1.domain.b == p2.domain.b).all():
-                raise Exception('merge: partitions have different domains')
-            
-            # check equality of original PPP partitions
-            if ab1.orig_ppp == ab2.orig_ppp:
-                logger.info('original partitions happen to be equal')
+    _check_mergeable(abstractions)
     
     init_mode = abstractions.keys()[0]
     all_modes = set(abstractions)
@@ -1587,36 +2820,88 @@ def merge_partitions(abstractions):
         prev_modes += [cur_mode]
     new_list = regions
     
-    # build adjacency based on spatial adjacencies of
-    # component abstractions.
-    # which justifies the assumed symmetry of part1.adj, part2.adj
-	# Basically, if two regions are either 1) part of the same region in one of
-	# the abstractions or 2) adjacent in one of the abstractions, then the two
-	# regions are adjacent in the switched dynamics.
+    abstraction = _merged_abstraction(abstractions, init_mode,
+                                      new_list, parents)
+    return (abstraction, ap_labeling)
+
+def _check_mergeable(abstractions):
+    """Raise Exception if partitions differ in propositions or domain."""
+    for ab1 in abstractions.itervalues():
+        for ab2 in abstractions.itervalues():
+            p1 = ab1.ppp
+            p2 = ab2.ppp
+            
+            if p1.prop_regions != p2.prop_regions:
+                msg = 'merge: partitions have different sets '
+                msg += 'of continuous propositions'
+                raise Exception(msg)
+            
+            if not (p1.domain.A == p2.domain.A).all() or \
+            not (p1.domain.b == p2.domain.b).all():
+                raise Exception('merge: partitions have different domains')
+            
+            # check equality of original PPP partitions
+            if ab1.orig_ppp == ab2.orig_ppp:
+                logger.info('original partitions happen to be equal')
+
+def _merged_abstraction(abstractions, init_mode, new_list, parents):
+    """Return L{AbstractSwitched} with merged partition C{new_list}.
+    
+    Two regions are adjacent in the merged partition,
+    if they are adjacent and their parents are
+    either the same or adjacent in some mode.
+    """
     n_reg = len(new_list)
+    index = RegionIndex(new_list)
     
-    adj = np.zeros([n_reg, n_reg], dtype=int)
+    # pairs (i, j), j < i, with intersecting bounding boxes
+    I = []
+    J = []
     for i, reg_i in enumerate(new_list):
-        for j, reg_j in enumerate(new_list[0:i]):
-            touching = False
-            for mode in abstractions:
-                pi = parents[mode][i]
-                pj = parents[mode][j]
-                
-                part = abstractions[mode].ppp
-                
-                if (part.adj[pi, pj] == 1) or (pi == pj):
-                    touching = True
-                    break
-            
-            if not touching:
-                continue
-            
-            if pc.is_adjacent(reg_i, reg_j):
-                adj[i,j] = 1
-                adj[j,i] = 1
-        adj[i,i] = 1
+        for j in index.query(reg_i):
+            if j >= i:
+                break
+            I.append(i)
+            J.append(j)
+    I = np.array(I, dtype=int)
+    J = np.array(J, dtype=int)
+    
+    # build adjacency based on spatial adjacencies of
+    # component abstractions.
+    # which justifies the assumed symmetry of part1.adj, part2.adj
+    # Basically, if two regions are either 1) part of the same region in one of
+    # the abstractions or 2) adjacent in one of the abstractions, then the two
+    # regions are adjacent in the switched dynamics.
+    touching = np.zeros(len(I), dtype=bool)
+    for mode, ab in abstractions.iteritems():
+        parent = np.array([parents[mode][i] for i in xrange(n_reg)],
+                          dtype=int)
+        pi = parent[I]
+        pj = parent[J]
+        
+        part_adj = sp.coo_matrix(ab.ppp.adj)
+        m = part_adj.shape[0]
+        ones = part_adj.data == 1
+        keys = part_adj.row[ones] * m + part_adj.col[ones]
+        touching |= (pi == pj) | np.in1d(pi * m + pj, keys)
+    
+    I = I[touching]
+    J = J[touching]
+    adjacent = np.array([
+        pc.is_adjacent(new_list[i], new_list[j])
+        for i, j in zip(I, J)
+    ], dtype=bool)
+    I = I[adjacent]
+    J = J[adjacent]
+    diag = np.arange(n_reg)
+    rows = np.hstack([I, J, diag])
+    cols = np.hstack([J, I, diag])
+    adj = sp.coo_matrix(
+        (np.ones(len(rows), dtype=int), (rows, cols)),
+        shape=(n_reg, n_reg)
+    ).tolil()
     
+    ab0 = abstractions[init_mode]
     ppp = PropPreservingPartition(
         domain=ab0.ppp.domain,
         regions=new_list,
@@ -1624,13 +2909,11 @@ def merge_partitions(abstractions):
         adj=adj
     )
     
-    abstraction = AbstractSwitched(
+    return AbstractSwitched(
         ppp=ppp,
         modes=abstractions,
         ppp2modes=parents,
     )
-    
-    return (abstraction, ap_labeling)
 
 def merge_partition_pair(
     old_regions, ab2,
@@ -1680,9 +2963,10 @@ def merge_partition_pair(
     new_list = []
     parents = {mode:dict() for mode in modes}
     ap_labeling = dict()
+    index = RegionIndex(part2.regions)
     
     for i in xrange(len(old_regions)):
-        for j in xrange(len(part2)):
+        for j in index.query(old_regions[i]):
             isect = pc.intersect(old_regions[i],
                                  part2[j])
             rc, xc = pc.cheby_ball(isect)
@@ -1701,7 +2985,7 @@ def merge_partition_pair(
             isect.props = old_regions[i].props.copy()
             
             new_list.append(isect)
-            idx = new_list.index(isect)
+            idx = len(new_list) - 1
             
             # keep track of parents
             for mode in prev_modes:
@@ -1794,9 +3078,18 @@ def get_postarea(ppp_region, sys_dyn, list_extp_d, N=1, abs_tol=1e-7):
         post_area_hull=pc.qhull(post_extp_n)
     return post_area_hull
 
-def get_postarea_transitions(ppp, sys_dyn, N=1, abs_tol=1e-7):
+def get_postarea_transitions(ppp, sys_dyn, N=1, abs_tol=1e-7,
+                             rows=None, index=None):
     """Find the possible transitions between states in a system
 
+    The vertices of all regions are propagated together
+    through C{N} steps of the dynamics without input,
+    for each vertex of the disturbance set,
+    using C{A^N} and C{A^(N-1) + ... + A + I}.
+    The convex hull of the images of a region is its post area.
+    Only regions whose bounding boxes meet that of
+    the post area are intersected with it.
+
     @param ppp: Partitioned State Space 
     @type ppp: L{PropPreservingPartition}
 
@@ -1806,35 +3099,105 @@ def get_postarea_transitions(ppp, sys_dyn, N=1, abs_tol=1e-7):
     @param N: Horizon length
     @type N: integer
 
-    Warning: Runs only when sys_dyn.Wset is none. The other condition 
-    has not been added in yet.
+    @param rows: indices of the regions whose post areas are found,
+        if C{None}, then all regions
+    @type rows: list of int
+
+    @param index: index of C{ppp.regions}, built if C{None}
+    @type index: L{RegionIndex}
+
+    @return: entry C{(k, j)} is 1 if the post area of region
+        C{rows[k]} intersects region C{j}, and C{(k, n)} is 1
+        if it leaves the domain, where C{n = len(ppp.regions)}
+    @rtype: C{scipy.sparse.csr_matrix} of shape C{(len(rows), n + 1)}
+
+    Note: before, this function returned a dense C{numpy} array
+    and propagated a single step, whatever the value of C{N}.
+    Callers that need the dense array can call C{toarray()}
+    on the result.
 
     Warning: Running this in parrallel with glpk as a solver is unstable. 
     Please use MOSEK in this case for accuracy
     """
-    list_extp_d=pc.extreme(sys_dyn.Wset)
-    transitions = np.zeros([len(ppp.regions),(len(ppp.regions)+1)], 
-        dtype = int)
-    
-    for i in range(0,len(ppp.regions)):
-            post_area=get_postarea(ppp.regions[i],sys_dyn,list_extp_d)
-            for k in range(0,len(ppp.regions)):
-                inters_region=pc.intersect(post_area,ppp.regions[k])
-                if (pc.is_empty(inters_region)== False):
-# and i!=k):
-                    trans=1
-                else:
-                    trans=0
-                transitions[i,k]=trans
-
-            inters=pc.mldivide(post_area,ppp.domain)
-            if pc.is_empty(inters)== False:
-                transend=1
-            else:
-                transend=0
-            transitions[i,len(ppp.regions)]=transend
-
-    return transitions
+    regions = ppp.regions
+    n = len(regions)
+    if rows is None:
+        rows = range(n)
+    dim = sys_dyn.A.shape[0]
+    
+    # stacked vertices of regions
+    vertices = [np.zeros([0, dim])]
+    ptr = [0]
+    for i in rows:
+        region = regions[i]
+        extp = [pc.extreme(poly) for poly in _polytopes(region)]
+        vertices.extend(extp)
+        ptr.append(ptr[-1] + sum(len(v) for v in extp))
+    vertices = np.vstack(vertices)
+    
+    # x[N] = A^N x[0] + (A^(N-1) + ... + I) (K + E d)
+    AN = np.linalg.matrix_power(sys_dyn.A, N)
+    S = sum(np.linalg.matrix_power(sys_dyn.A, k) for k in xrange(N))
+    D = _disturbance_vertices(sys_dyn)
+    offsets = np.dot(
+        S, sys_dyn.K + np.dot(sys_dyn.E, D.T)).T
+    post = (np.dot(vertices, AN.T)[np.newaxis, :, :] +
+            offsets[:, np.newaxis, :])
+    
+    outside = _outside_domain(post, ppp.domain, abs_tol)
+    
+    if index is None:
+        index = RegionIndex(regions)
+    I = []
+    J = []
+    for i in xrange(len(rows)):
+        points = post[:, ptr[i]:ptr[i + 1], :].reshape(-1, dim)
+        post_area = pc.qhull(points)
+        for k in index.query_box(points.min(axis=0), points.max(axis=0),
+                                 abs_tol=1e-5):
+            inters_region = pc.intersect(post_area, regions[k])
+            if not pc.is_empty(inters_region):
+                I.append(i)
+                J.append(k)
+        
+        if outside is None:
+            leaves = not pc.is_empty(pc.mldivide(post_area, ppp.domain))
+        else:
+            leaves = np.any(outside[:, ptr[i]:ptr[i + 1]])
+        if leaves:
+            I.append(i)
+            J.append(n)
+    
+    return sp.csr_matrix(
+        (np.ones(len(I), dtype=int), (I, J)),
+        shape=(len(rows), n + 1))
+
+def _polytopes(region):
+    if len(region) == 0:
+        return [region]
+    return region.list_poly
+
+def _disturbance_vertices(sys_dyn):
+    """Return vertices of C{Wset} as rows, or a zero disturbance."""
+    m = sys_dyn.E.shape[1]
+    W = sys_dyn.Wset
+    if W is None or pc.is_empty(W):
+        return np.zeros([1, m])
+    return pc.extreme(W)
+
+def _outside_domain(points, domain, abs_tol):
+    """Return which C{points} are not in C{domain}.
+    
+    @param points: array with coordinates in the last axis
+    @return: boolean array of the other axes,
+        or C{None} if C{domain} is not convex
+    """
+    if len(domain) > 1:
+        return None
+    if len(domain) == 1:
+        domain = domain.list_poly[0]
+    slack = np.dot(points, domain.A.T) - domain.b.flatten()
+    return np.any(slack > abs_tol, axis=-1)
 
 def create_afts(owner, ssd, cont_props, ref_grid, prog_map, trans):
     """Creates an Augmented Finite Transition System
@@ -1855,7 +3218,8 @@ def create_afts(owner, ssd, cont_props, ref_grid, prog_map, trans):
     @type prog_map: dict of set of tuples. 
 
     @param trans: A matrix showing the different transitions between states
-    @type trans: numpy array
+    @type trans: dict of C{scipy.sparse} matrices,
+        as returned by L{get_postarea_transitions}
     """
     cnt=0
     afts=trs.AFTS()
@@ -1868,9 +3232,8 @@ def create_afts(owner, ssd, cont_props, ref_grid, prog_map, trans):
     afts.sys_actions.add_from([str(s) for e,s in ssd.modes])
     for mode in ssd.modes:
         r,c=trans[mode].shape
-        trans[mode]=np.vstack((trans[mode],np.zeros((1,c))))
-        trans[mode][c-1][c-1]=1 
-        adj=sp.lil_matrix(trans[mode])
+        adj=sp.lil_matrix(sp.vstack((trans[mode],sp.lil_matrix((1,c)))))
+        adj[c-1,c-1]=1
         if cnt==0:
             afts_states = range(adj.shape[0]-1)
             afts_states = trs.prepend_with(afts_states, 's')
@@ -1895,7 +3258,7 @@ def create_afts(owner, ssd, cont_props, ref_grid, prog_map, trans):
 
 def discretize_modeonlyswitched(ssd, cont_props, owner, grid_size=-1.,
                                 visualize=False,eps=0, is_convex=True,
-                                N=1,abs_tol=1e-7):
+                                N=1,abs_tol=1e-7, n_jobs=1):
     """ Discretization function for Mode Only Switched systems
 
     Takes in the system dynamics as input, and outputs an object of 
@@ -1921,6 +3284,9 @@ def discretize_modeonlyswitched(ssd, cont_props, owner, grid_size=-1.,
     @param eps: used to expand the width of the equilibrium regions
     @type eps: 0<eps<1
 
+    @param n_jobs: number of worker processes for the post areas,
+        see L{multiproc_postarea_transitions}
+    @type n_jobs: int >= 1
 
     """
     cont_dyn={}
@@ -1945,10 +3311,14 @@ def discretize_modeonlyswitched(ssd, cont_props, owner, grid_size=-1.,
     print "PROG MAP DONE"
     modes= ssd.modes
     for mode in ssd.modes:
-        cont_dyn = ssd.dynamics[mode].list_subsys[0]
-#    cont_dyn = ssd.dynamics
-    	trans[mode] = get_postarea_transitions(ref_grid,cont_dyn)
-#    trans= multiproc_postarea_transitions(modes,ref_grid,cont_dyn,N=1,abs_tol=1e-7)
+        cont_dyn[mode] = ssd.dynamics[mode].list_subsys[0]
+    if n_jobs > 1:
+        trans = multiproc_postarea_transitions(
+            modes, ref_grid, cont_dyn, N, abs_tol, n_jobs)
+    else:
+        for mode in modes:
+            trans[mode] = get_postarea_transitions(
+                ref_grid, cont_dyn[mode], N, abs_tol)
 
     print "POSTAREA DONE"
     afts=create_afts(owner=owner,ssd=ssd,cont_props=cont_props,ref_grid=ref_grid,
@@ -1960,63 +3330,112 @@ def discretize_modeonlyswitched(ssd, cont_props, owner, grid_size=-1.,
     return abstMOS
     
 
-def multiproc_posttrans(q,mode,i,ref_grid,cont_dyn,N=1,abs_tol=1e-7):
-    """Accessorry function 2 to enable parallelization of posttrans
+def multiproc_posttrans(q, mode, i, ref_grid, cont_dyn, N=1, abs_tol=1e-7):
+    """Put C{(mode, i, transitions)} in queue C{q}.
     
-    Warning: Running in parrallel with glpk as a solver is unstable. 
-    Please use MOSEK in this case for accuracy
+    Deprecated: L{multiproc_postarea_transitions} computes
+    the transitions of all modes on one pool of workers.
+    The transitions are a C{scipy.sparse.csr_matrix},
+    see L{get_postarea_transitions}.
     """
-    global logger
-    logger = mp.log_to_stderr()
-    
-    name = mp.current_process().name
-    print('Discretization mode: ' + str(mode) + ', on: ' + str(name))
-    
-    trans = get_postarea_transitions(ref_grid, cont_dyn, N,abs_tol)
-    
-    q.put((mode,i, trans))
-    print('Worker: ' + str(name) + ' finished.')
-
-def multiproc_postarea_transitions(modes,ref_grid,cont_dyn,N=1,abs_tol=1e-7):
-    """Accessorry function 1 to enable parallelization of posttrans
-
-    Warning: Running in parrallel with glpk as a solver is unstable. 
-    Please use MOSEK in this case for accuracy
-
-    In development: If you have 8 processors and only 4 modes, try 
-    execution such that each mode is split between 2 processors
+    warnings.warn(
+        'multiproc_posttrans is deprecated, '
+        'use multiproc_postarea_transitions', DeprecationWarning)
+    trans = get_postarea_transitions(ref_grid, cont_dyn, N, abs_tol)
+    q.put((mode, i, trans))
+
+def multiproc_postarea_transitions(
+    modes, ref_grid, cont_dyn, N=1, abs_tol=1e-7,
+    n_jobs=None, chunk_size=256, tmp_dir=None
+):
+    """Parallel implementation of L{get_postarea_transitions}.
+    
+    Each task finds the post areas of a chunk of
+    C{chunk_size} regions in one mode,
+    on a bounded pool of worker processes (see L{_TaskPool}).
+    C{ref_grid} is written once to a file as a L{PackedPartition},
+    which each worker memory-maps and indexes once,
+    instead of receiving a pickled copy per task.
+    The blocks of each mode are stacked in the order of
+    their chunks, so the result does not depend on
+    which worker finished first.
+    If a task fails or a worker dies, then C{RuntimeError}
+    is raised, instead of waiting forever.
+    
+    @param cont_dyn: dynamics of each mode
+    @type cont_dyn: dict of L{LtiSysDyn}
+    
+    @param n_jobs: number of worker processes,
+        if C{None}, then C{multiprocessing.cpu_count()}
+    @type n_jobs: int >= 1
+    
+    @param chunk_size: number of regions per task
+    @type chunk_size: int >= 1
+    
+    @param tmp_dir: directory for the partition file,
+        if C{None}, then a temporary directory,
+        removed before returning
+    @type tmp_dir: str
+    
+    @return: transitions of each mode,
+        as returned by L{get_postarea_transitions}
+    @rtype: dict of C{scipy.sparse.csr_matrix}
     """
-    global logger
-    logger.info('parallel discretize started')
-    q=mp.Queue()
-    mode_args = dict()
-    p=mp.cpu_count()
-    m=len(modes)
-    div=math.floor(p/m)
-    l=len(ref_grid.regions)
-    if div == 0:
-        div = 1
-    for mode in modes:
-        for i in range(0,int(div)):
-            lo=int(math.floor(i*l/div))
-            hi=int(math.floor((i+1)*l/div))
-            split_poly=[ref_grid.regions[x] for x in range(lo,hi)]
-            new_ppp=p2p.PPP(domain=ref_grid.domain, regions=split_poly)
-            mode_args[mode]=(q,mode,i,new_ppp,cont_dyn[mode])
-
-    jobs=[mp.Process(target=multiproc_posttrans, args=args)
-            for args in mode_args.itervalues()]
-    for job in jobs:
-        job.start()
-
+    logger.info('parallel postarea transitions started')
+    n = len(ref_grid.regions)
+    
+    remove_tmp = tmp_dir is None
+    if tmp_dir is None:
+        tmp_dir = tempfile.mkdtemp(prefix='tulip_')
+    elif not os.path.isdir(tmp_dir):
+        os.makedirs(tmp_dir)
+    
+    pool = _TaskPool(n_jobs)
+    try:
+        fname = os.path.join(tmp_dir, 'ref_grid.npz')
+        if not isinstance(ref_grid, p2p.PackedPartition):
+            p2p.PackedPartition.from_partition(ref_grid).save(fname)
+        else:
+            ref_grid.save(fname)
+        
+        args = [
+            (fname, cont_dyn[mode], range(lo, min(lo + chunk_size, n)),
+             N, abs_tol)
+            for mode in modes
+            for lo in xrange(0, n, chunk_size)
+        ]
+        blocks = pool.map(_postarea_batch, args)
+    finally:
+        pool.close()
+        if remove_tmp:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    
+    n_chunks = len(args) // len(modes) if modes else 0
     transitions = dict()
-    temp_trans = dict()
-    for job in jobs:
-        mode, i, trans = q.get()
-        temp_trans[(mode,str(i))] = trans
-    for mode in modes:
-        trans[mode]=np.vstack(temp_trans[(mode,str(i))] for i in range(0,int(div)))
-    for job in jobs:
-        job.join()
-    
+    for k, mode in enumerate(modes):
+        mode_blocks = blocks[k * n_chunks:(k + 1) * n_chunks]
+        if mode_blocks:
+            transitions[mode] = sp.vstack(mode_blocks, format='csr')
+        else:
+            transitions[mode] = sp.csr_matrix((0, n + 1), dtype=int)
     return transitions
+
+# partitions loaded by this worker process, with their index
+_grid_files = dict()
+
+def _postarea_batch(fname, sys_dyn, rows, N, abs_tol):
+    """Find post area transitions of C{rows} in partition C{fname}.
+    
+    Task of L{multiproc_postarea_transitions}.
+    
+    @rtype: C{scipy.sparse.csr_matrix}
+    """
+    loaded = _grid_files.get(fname)
+    if loaded is None:
+        ppp = storage.load_partition(fname)
+        loaded = (ppp, RegionIndex(ppp.regions))
+        _grid_files.clear()
+        _grid_files[fname] = loaded
+    (ppp, index) = loaded
+    return get_postarea_transitions(ppp, sys_dyn, N, abs_tol,
+                                    rows=rows, index=index)
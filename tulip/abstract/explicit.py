@@ -0,0 +1,380 @@
+# Copyright (c) 2015 by California Institute of Technology
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the California Institute of Technology nor
+#    the names of its contributors may be used to endorse or promote
+#    products derived from this software without specific prior
+#    written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL CALTECH
+# OR THE CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+"""
+Explicit control laws for the transitions of an abstraction.
+
+For each transition C{start -> end}, the first input u(0)
+computed by L{find_controller.get_input} is a piecewise affine
+function of the continuous state over the start cell.
+It is computed offline by multi-parametric quadratic programming,
+exploring the critical regions of the QP of L{CompiledController}.
+
+The result is a L{ExplicitController}, stored in a few arrays.
+Evaluating it needs only point location and a matrix-vector product,
+no LP or QP solver.
+
+See Also
+========
+L{find_controller.get_input}, L{find_controller.CompiledController}
+"""
+from __future__ import absolute_import
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import polytope as pc
+from cvxopt import matrix, solvers
+
+from .find_controller import CompiledController
+
+def explicit_control_law(
+    ssys, abstraction,
+    R=[], r=[], Q=[], mid_weight=0.0,
+    transitions=None, max_regions=1000, abs_tol=1e-7
+):
+    """Compute the explicit control laws of C{abstraction}.
+    
+    Cost parameters are those of L{find_controller.get_input}.
+    
+    @param transitions: pairs C{(start, end)}.
+        If C{None}, then all transitions of C{abstraction.ts},
+        none if it is C{None}.
+    @type transitions: iterable of C{(int, int)}
+    
+    @param max_regions: number of critical regions
+        per transition and polytope, after which
+        the exploration stops with a warning
+    
+    @param abs_tol: tolerance of point location
+    
+    @rtype: L{ExplicitController}
+    """
+    if transitions is None:
+        if abstraction.ts is None:
+            transitions = []
+        else:
+            transitions = abstraction.ts.transitions()
+    controller = CompiledController(
+        ssys, abstraction, R, r, Q, mid_weight,
+        transitions=[]
+    )
+    m = ssys.B.shape[1]
+    
+    laws = dict()
+    for start, end in transitions:
+        controller.compile(start, end)
+        qps = controller._qps[(start, end)]
+        
+        P_start = abstraction.ppp.regions[start]
+        if len(P_start) > 0:
+            domains = list(P_start)
+        else:
+            domains = [P_start]
+        
+        crs = []
+        for target, qp in enumerate(qps):
+            for dom in domains:
+                for cr in _explore(qp, dom, m, max_regions, abs_tol):
+                    crs.append((target,) + cr)
+        laws[(start, end)] = crs
+        logger.info('transition ' + str(start) + ' -> ' + str(end) +
+                    ': ' + str(len(crs)) + ' critical regions')
+    return ExplicitController.from_laws(
+        laws, ssys.A.shape[1], m, abs_tol)
+
+class ExplicitController(object):
+    """Piecewise affine laws u(0) = K x + k for transitions.
+    
+    The critical regions of all transitions are stored
+    as arrays:
+    
+      - C{A, b}: stacked H-representations of critical regions,
+        region i has rows C{offsets[i]:offsets[i+1]}
+      - C{K, k}: gain and offset of u(0) in each region
+      - C{JQ, Jq, Jc}: cost of the QP in each region,
+        C{x' JQ x + Jq' x + Jc}, used to choose among
+        the polytopes of the end cell
+      - C{transitions}: pairs C{(start, end)},
+        transition t has regions C{ptr[t]:ptr[t+1]}
+    
+    Use L{explicit_control_law} to create instances.
+    Save with L{save} and read with L{load}.
+    """
+    _arrays = ('A', 'b', 'offsets', 'K', 'k', 'JQ', 'Jq', 'Jc',
+               'transitions', 'ptr')
+    
+    def __init__(self, abs_tol=1e-7, **arrays):
+        for name in self._arrays:
+            setattr(self, name, arrays[name])
+        self.abs_tol = abs_tol
+        self._index = {
+            (int(s), int(e)):t
+            for t, (s, e) in enumerate(self.transitions)
+        }
+    
+    def __len__(self):
+        """Number of critical regions."""
+        return len(self.offsets) - 1
+    
+    @classmethod
+    def from_laws(cls, laws, n, m, abs_tol=1e-7):
+        """Return controller from critical regions by transition.
+        
+        @param laws: maps C{(start, end)} to lists of
+            C{(target, poly, K, k, JQ, Jq, Jc)}
+        """
+        A = [np.zeros([0, n])]
+        b = [np.zeros(0)]
+        offsets = [0]
+        gains = []
+        costs = []
+        transitions = []
+        ptr = [0]
+        for key in sorted(laws):
+            for target, poly, K, k, JQ, Jq, Jc in laws[key]:
+                A.append(poly.A)
+                b.append(poly.b.flatten())
+                offsets.append(offsets[-1] + poly.A.shape[0])
+                gains.append((K, k))
+                costs.append((JQ, Jq, Jc))
+            transitions.append(key)
+            ptr.append(len(gains))
+        return cls(
+            abs_tol=abs_tol,
+            A=np.vstack(A),
+            b=np.hstack(b),
+            offsets=np.array(offsets, dtype=int),
+            K=np.array([K for K, k in gains]).reshape(-1, m, n),
+            k=np.array([k for K, k in gains]).reshape(-1, m),
+            JQ=np.array([c[0] for c in costs]).reshape(-1, n, n),
+            Jq=np.array([c[1] for c in costs]).reshape(-1, n),
+            Jc=np.array([c[2] for c in costs]).reshape(-1),
+            transitions=np.array(transitions, dtype=int).reshape(-1, 2),
+            ptr=np.array(ptr, dtype=int)
+        )
+    
+    def control(self, x, start, end):
+        """Return u(0) at state C{x} for transition C{start -> end}.
+        
+        @type x: numpy 1darray
+        @return: input, or C{None} if C{x} is in none
+            of the critical regions of the transition
+        @rtype: numpy 1darray
+        """
+        x = np.asarray(x, dtype=float).flatten()
+        t = self._index[(start, end)]
+        first, last = self.ptr[t], self.ptr[t+1]
+        if first == last:
+            return None
+        rows = slice(self.offsets[first], self.offsets[last])
+        test = self.A[rows].dot(x) - self.b[rows] < self.abs_tol
+        inside = np.logical_and.reduceat(
+            test, self.offsets[first:last] - self.offsets[first])
+        (found,) = np.nonzero(inside)
+        if len(found) == 0:
+            return None
+        found = found + first
+        if len(found) > 1:
+            # regions of different polytopes of the end cell
+            cost = (np.einsum('i,kij,j->k', x, self.JQ[found], x) +
+                    self.Jq[found].dot(x) + self.Jc[found])
+            i = found[np.argmin(cost)]
+        else:
+            i = found[0]
+        return self.K[i].dot(x) + self.k[i]
+    
+    def save(self, path):
+        """Write arrays to C{path} in numpy C{.npz} format."""
+        np.savez(path, **{name:getattr(self, name)
+                          for name in self._arrays})
+    
+    @classmethod
+    def load(cls, path, abs_tol=1e-7):
+        """Read controller written by L{save}."""
+        f = np.load(path)
+        try:
+            arrays = {name:f[name] for name in cls._arrays}
+        finally:
+            f.close()
+        return cls(abs_tol=abs_tol, **arrays)
+
+def _explore(qp, dom, m, max_regions, abs_tol):
+    """Return critical regions of C{qp} over polytope C{dom}.
+    
+    Starting from a point where the QP is feasible,
+    the QP is solved at a point outside the known regions,
+    the optimal active set gives the next critical region,
+    and points just beyond its facets are explored next.
+    
+    @return: list of C{(poly, K, k, JQ, Jq, Jc)}
+        for u(0) = K x + k
+    """
+    H = np.array(qp.P)
+    G = np.array(qp.G)
+    Hi = np.linalg.inv(H)
+    n = dom.A.shape[1]
+    
+    # Chebyshev center of the feasible set in (x, u)
+    feas = pc.Polytope(
+        np.vstack([
+            np.hstack([qp.Lx, G]),
+            np.hstack([dom.A, np.zeros([dom.A.shape[0], G.shape[1]])])
+        ]),
+        np.hstack([qp.M, dom.b.flatten()])
+    )
+    rc, xc = pc.cheby_ball(feas)
+    if xc is None or rc <= abs_tol:
+        return []
+    r_dom, x_dom = pc.cheby_ball(dom)
+    step = max(1e-5, 1e-4 * r_dom)
+    
+    regions = []
+    seeds = [np.asarray(xc, dtype=float).flatten()[:n]]
+    while seeds:
+        x = seeds.pop()
+        if any(pc.is_inside(cr[0], x) for cr in regions):
+            continue
+        if len(regions) >= max_regions:
+            logger.warning('reached ' + str(max_regions) +
+                           ' critical regions, stopping')
+            break
+        
+        cr = _critical_region(qp, H, Hi, G, x, dom)
+        if cr is None:
+            continue
+        poly, Kx, k0, lam = cr
+        
+        # u(0) and cost of QP
+        JQ = 0.5 * Kx.T.dot(H).dot(Kx) + qp.Fx.T.dot(Kx)
+        JQ = 0.5 * (JQ + JQ.T)
+        Jq = Kx.T.dot(H).dot(k0) + Kx.T.dot(qp.f0) + qp.Fx.T.dot(k0)
+        Jc = 0.5 * k0.dot(H).dot(k0) + qp.f0.dot(k0)
+        regions.append((poly, Kx[:m], k0[:m], JQ, Jq, Jc))
+        
+        # cross each facet not on the boundary of dom
+        vert = pc.extreme(poly)
+        if vert is None:
+            continue
+        for a, b in zip(poly.A, poly.b.flatten()):
+            on_facet = np.abs(vert.dot(a) - b) < 1e-6 * (1 + abs(b))
+            if not np.any(on_facet):
+                continue
+            # the facet may border several regions:
+            # also cross it near each of its vertices
+            facet = vert[on_facet]
+            center = facet.mean(axis=0)
+            points = [center] + [v + 0.01 * (center - v) for v in facet]
+            for p in points:
+                y = p + step * a / np.linalg.norm(a)
+                if pc.is_inside(dom, y):
+                    seeds.append(y)
+    return regions
+
+def _critical_region(qp, H, Hi, G, x, dom):
+    """Return critical region of C{qp} that contains C{x}.
+    
+    @return: C{(poly, Kx, k0, lam)}, with u = Kx x + k0,
+        or C{None} if the QP is infeasible at C{x}
+    """
+    q = qp.Fx.dot(x) + qp.f0
+    h = qp.M - qp.Lx.dot(x)
+    try:
+        sol = solvers.qp(qp.P, matrix(q), qp.G, matrix(h))
+    except (ValueError, ArithmeticError):
+        return None
+    if sol['status'] != 'optimal':
+        return None
+    u = np.array(sol['x']).flatten()
+    z = np.array(sol['z']).flatten()
+    slack = h - G.dot(u)
+    
+    # strongly active, then all active constraints
+    z_tol = 1e-6 * max(1., z.max())
+    by_dual = [i for i in np.argsort(-z) if z[i] > z_tol]
+    by_slack = [i for i in np.argsort(-z)
+                if slack[i] < 1e-6 * (1. + abs(h[i]))]
+    for active in (by_dual, by_slack):
+        active = _independent(G, active)
+        cr = _region_of(qp, Hi, G, active, dom)
+        if cr is None:
+            continue
+        poly = cr[0]
+        if pc.is_fulldim(poly) and pc.is_inside(poly, x, 1e-6):
+            return cr
+    return None
+
+def _independent(G, rows):
+    """Return a maximal linearly independent subset of C{rows} of C{G}."""
+    chosen = []
+    for i in rows:
+        trial = chosen + [i]
+        if np.linalg.matrix_rank(G[trial]) == len(trial):
+            chosen = trial
+    return chosen
+
+def _region_of(qp, Hi, G, active, dom):
+    """Return critical region and affine law of an active set."""
+    F = qp.Fx
+    f = qp.f0
+    S = -qp.Lx
+    W = qp.M
+    
+    if active:
+        GA = G[active]
+        Minv = np.linalg.inv(GA.dot(Hi).dot(GA.T))
+        lam_x = -Minv.dot(S[active] + GA.dot(Hi).dot(F))
+        lam_0 = -Minv.dot(W[active] + GA.dot(Hi).dot(f))
+        Kx = -Hi.dot(F + GA.T.dot(lam_x))
+        k0 = -Hi.dot(f + GA.T.dot(lam_0))
+    else:
+        lam_x = np.zeros([0, F.shape[1]])
+        lam_0 = np.zeros(0)
+        Kx = -Hi.dot(F)
+        k0 = -Hi.dot(f)
+    
+    inactive = [i for i in xrange(G.shape[0]) if i not in set(active)]
+    GI = G[inactive]
+    # lam >= 0, inactive constraints hold, x in dom
+    L = np.vstack([-lam_x, GI.dot(Kx) - S[inactive], dom.A])
+    M = np.hstack([lam_0, W[inactive] - GI.dot(k0), dom.b.flatten()])
+    
+    # rows that do not depend on x
+    norms = np.sqrt(np.sum(L * L, axis=1))
+    flat = norms < 1e-10
+    if np.any(M[flat] < -1e-8):
+        return None
+    L = L[~flat]
+    M = M[~flat]
+    
+    poly = pc.reduce(pc.Polytope(L, M))
+    return poly, Kx, k0, lam_0
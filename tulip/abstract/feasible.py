@@ -35,6 +35,7 @@ Check Linear Discrete-Time-Invariant System reachability between polytopes
     
 Primary functions:
     - L{solve_feasible}
+    - L{may_reach}
     - L{createLM}
     - L{get_max_extreme}
 
@@ -46,17 +47,29 @@ import logging
 logger = logging.getLogger(__name__)
 
 from collections import Iterable
+import weakref
 
 import numpy as np
 import polytope as pc
 from cvxopt import matrix, solvers
+
+from .cache import FeasibilityCache, hash_key
+from .spatial import bounding_box, geometry
 lp_solver = 'mosek'
 
+# results of solve_feasible, disabled if None,
+# e.g., set to FeasibilityCache() to enable
+cache = None
+
+# sets reached backwards by solve_closed_loop, always on
+_chains = FeasibilityCache(maxsize=1024)
+
 def is_feasible(
     from_region, to_region, sys, N,
     closed_loop=True,
     use_all_horizon=False,
-    trans_set=None
+    trans_set=None,
+    feasibility_cache=None
 ):
     """Return True if to_region is reachable from_region.
     
@@ -65,7 +78,7 @@ def is_feasible(
     S0 = solve_feasible(
         from_region, to_region, sys, N,
         closed_loop, use_all_horizon,
-        trans_set
+        trans_set, feasibility_cache=feasibility_cache
     )
     return from_region <= S0
 
@@ -139,9 +152,132 @@ def exists_input(x0, ssys, P1, P3, N):
         u = np.array(sol['x']).flatten()
         return u
 
+def may_reach(P1, P2, ssys, N, trans_set=None, abs_tol=1e-7):
+    """Return False if P2 is certainly not reachable from P1.
+    
+    A necessary condition for the existence of C{x(0)} in C{P1}
+    and inputs that lead to C{P2} within C{N} steps,
+    with intermediate states in C{trans_set}.
+    When it returns C{False}, the set computed by L{solve_feasible}
+    does not intersect C{P1}.
+    
+    The states reachable in k steps are over-approximated
+    using the bounding boxes of C{P1}, C{ssys.Uset} and C{ssys.Wset}:
+    
+      - by a box, clipped to the bounding box of C{trans_set}
+        at intermediate steps, and
+      - by bounds of their support function in the directions
+        of the facet normals of each polytope in C{P2}.
+    
+    Each costs a few small matrix products per step.
+    
+    @type P1: C{Polytope} or C{Region}
+    @type P2: C{Polytope} or C{Region}
+    @type ssys: L{LtiSysDyn}
+    @param N: horizon length
+    @param trans_set: set of intermediate states,
+        if C{None}, then C{P1}
+    @param abs_tol: margin added to the over-approximations
+    
+    @rtype: bool
+    """
+    if trans_set is None:
+        trans_set = P1
+    
+    boxes = [_box(x) for x in (P1, P2, trans_set, ssys.Uset)]
+    if any(box is None for box in boxes):
+        # empty or unbounded: nothing to prove
+        return True
+    (c0, r0), (c2, r2), (ct, rt), (cu, ru) = boxes
+    
+    A = ssys.A
+    B = ssys.B
+    m = B.shape[1]
+    cu = cu[:m]
+    ru = ru[:m]
+    
+    # affine terms: center and radius
+    c_aff = B.dot(cu) + ssys.K.flatten()
+    if np.all(ssys.E == 0):
+        E = None
+    else:
+        E = ssys.E
+        w_box = _box(ssys.Wset)
+        if w_box is None:
+            return True
+        cw, rw = w_box
+        c_aff = c_aff + E.dot(cw)
+    r_aff = np.abs(B).dot(ru)
+    if E is not None:
+        r_aff = r_aff + np.abs(E).dot(rw)
+    abs_A = np.abs(A)
+    
+    # facets of target polytopes: G x <= h
+    if len(P2) > 0:
+        targets = [(p.A, p.b.flatten()) for p in P2]
+    else:
+        targets = [(P2.A, P2.b.flatten())]
+    # per target: G A^k and lower bound of G x(k) due to inputs
+    facets = [[G, np.zeros(h.shape), h] for G, h in targets]
+    
+    c = c0
+    r = r0
+    for k in xrange(N):
+        c = A.dot(c) + c_aff
+        r = abs_A.dot(r) + r_aff
+        r = r + abs_tol + 1e-9 * np.abs(c)
+        
+        # overlaps target box ?
+        box_hit = np.all(np.abs(c - c2) <= r + r2)
+        
+        # lower bound of support function of reach set
+        # in direction -g, for each facet g x <= h
+        facet_hit = False
+        for f in facets:
+            GA, low, h = f
+            GB = GA.dot(B)
+            low = low + GA.dot(c_aff) - np.abs(GB).dot(ru)
+            if E is not None:
+                low = low - np.abs(GA.dot(E)).dot(rw)
+            GA = GA.dot(A)
+            f[0] = GA
+            f[1] = low
+            
+            lower = GA.dot(c0) - np.abs(GA).dot(r0) + low
+            margin = abs_tol * (1. + np.abs(h))
+            if np.all(lower <= h + margin):
+                facet_hit = True
+        
+        if box_hit and facet_hit:
+            return True
+        
+        # intermediate states remain in trans_set
+        lower = np.maximum(c - r, ct - rt)
+        upper = np.minimum(c + r, ct + rt)
+        if np.any(lower > upper):
+            return False
+        c = (lower + upper) / 2.
+        r = (upper - lower) / 2.
+    return False
+
+def _box(P):
+    """Return center and radius vectors of the bounding box of C{P}.
+    
+    @return: C{(center, radius)}, or C{None} if C{P}
+        is empty or unbounded
+    """
+    box = bounding_box(P)
+    if box is None:
+        return None
+    l, u = box
+    if not (np.all(np.isfinite(l)) and np.all(np.isfinite(u))):
+        return None
+    return (l + u) / 2., (u - l) / 2.
+
 def solve_feasible(
     P1, P2, ssys, N=1, closed_loop=True,
-    use_all_horizon=False, trans_set=None, max_num_poly=5
+    use_all_horizon=False, trans_set=None, max_num_poly=5,
+    feasibility_cache=None
 ):
     """Compute S0 \subseteq P1 from which P2 is N-reachable.
     
@@ -168,25 +304,55 @@ def solve_feasible(
         then force transitions to be in this set.
         Otherwise, P1 is used.
     
-    @return: the subset S0 of P1 from which P2 is reachable
+    @param feasibility_cache: where results are memoized,
+        keyed by the geometry of the sets, not their propositions.
+        If C{None}, then the module attribute C{cache},
+        unless it is C{None} too.
+    @type feasibility_cache: L{FeasibilityCache}
+    
+    @return: the subset S0 of P1 from which P2 is reachable,
+        shared with the cache, so it must not be modified
     @rtype: C{Polytope} or C{Region}
     """
     if use_all_horizon:
         raise ValueError('solve_feasible() with use_all_horizon=True is still '
                          'under development\nand currently unavailable.')
+    
+    if feasibility_cache is None:
+        feasibility_cache = cache
+    key = None
+    if feasibility_cache is not None:
+        # open loop reachability depends on max_num_poly
+        if closed_loop:
+            max_num_poly = None
+        key = hash_key('solve_feasible', _shape(P1), _shape(P2), ssys, N,
+                       closed_loop, _shape(trans_set), max_num_poly)
+        S0 = feasibility_cache.get(key)
+        if S0 is not None:
+            return S0
 
     if closed_loop:
-        return solve_closed_loop(
+        S0 = solve_closed_loop(
             P1, P2, ssys, N,
             use_all_horizon=use_all_horizon,
             trans_set=trans_set
         )
     else:
-        return solve_open_loop(
+        S0 = solve_open_loop(
             P1, P2, ssys, N,
             trans_set=trans_set,
             max_num_poly=max_num_poly
         )
+    
+    if key is not None:
+        feasibility_cache.put(key, S0)
+    return S0
+
+def _shape(P):
+    """Return key of the polytopes of C{P}, ignoring its propositions."""
+    if P is None:
+        return None
+    return geometry(P).digest
 
 def solve_closed_loop(
     P1, P2, ssys, N,
@@ -212,20 +378,33 @@ def solve_closed_loop(
         to be in trans_set.
         
         Otherwise, P1 is used.
+    
+    The sets reached backwards from P2 within trans_set
+    do not depend on P1, so they are memoized in a bounded memo
+    of this module, keyed by P2, ssys, trans_set and step.
+    Cells in the same trans_set share them.
+    Only the last step, into P1, is computed for each P1.
     """
     if use_all_horizon:
         raise ValueError('solve_closed_loop() with use_all_horizon=True '
                          'is still under development\nand currently '
                          'unavailable.')
 
-    p1 = P1.copy() # Initial set
-    p2 = P2.copy() # Terminal set
+    # not modified, so not copied
+    p1 = P1 # Initial set
+    p2 = P2 # Terminal set
     
     if trans_set is not None:
         Pinit = trans_set
     else:
         Pinit = p1
     
+    if trans_set is not None and N > 1:
+        chain_key = hash_key('solve_closed_loop', _shape(P2), ssys,
+                             _shape(trans_set))
+    else:
+        chain_key = None
+    
     # backwards in time
     s0 = pc.Region()
     reached = False
@@ -233,8 +412,17 @@ def solve_closed_loop(
         # first step from P1
         if i == 1:
             Pinit = p1
+            chain_key = None
         
-        p2 = solve_open_loop(Pinit, p2, ssys, 1, trans_set)
+        if chain_key is None:
+            p2 = solve_open_loop(Pinit, p2, ssys, 1, trans_set)
+        else:
+            key = hash_key(chain_key, N - i + 1)
+            pre = _chains.get(key)
+            if pre is None:
+                pre = solve_open_loop(Pinit, p2, ssys, 1, trans_set)
+                _chains.put(key, pre)
+            p2 = pre
         s0 = s0.union(p2, check_convex=True)
         s0 = pc.reduce(s0)
         
@@ -267,8 +455,8 @@ def solve_open_loop(
     P1, P2, ssys, N,
     trans_set=None, max_num_poly=5
 ):
-    r1 = P1.copy() # Initial set
-    r2 = P2.copy() # Terminal set
+    r1 = P1 # Initial set
+    r2 = P2 # Terminal set
     
     # use the max_num_poly largest volumes for reachability
     r1 = volumes_for_reachability(r1, max_num_poly)
@@ -296,9 +484,6 @@ def solve_open_loop(
 def poly_to_poly(p1, p2, ssys, N, trans_set=None):
     """Compute s0 for open-loop polytope to polytope N-reachability.
     """
-    p1 = p1.copy()
-    p2 = p2.copy()
-    
     if trans_set is None:
         trans_set = p1
     
@@ -321,7 +506,7 @@ def volumes_for_reachability(part, max_num_poly):
     
     vol_list = np.zeros(len(part) )
     for i in xrange(len(part) ):
-        vol_list[i] = part[i].volume
+        vol_list[i] = geometry(part[i]).volume
     
     ind = np.argsort(-vol_list)
     temp = []
@@ -353,6 +538,9 @@ def createLM(ssys, N, list_P, Pk=None, PN=None, disturbance_ind=None):
     
     The returned polytope describes the intersection of the polytopes
     for all possible inputs.
+    
+    The parts that depend only on C{ssys} and C{N}
+    are computed once, see L{compile_dynamics}.
 
     @param ssys: system dynamics
     @type ssys: L{LtiSysDyn}
@@ -369,140 +557,272 @@ def createLM(ssys, N, list_P, Pk=None, PN=None, disturbance_ind=None):
     """
     if not isinstance(list_P, Iterable):
         list_P = [list_P] +(N-1) *[Pk] +[PN]
-        
-    if disturbance_ind is None:
-        disturbance_ind = range(1,N+1)
     
-    A = ssys.A
-    B = ssys.B
-    E = ssys.E
-    K = ssys.K
-    
-    D = ssys.Wset
-    PU = ssys.Uset
+    return compile_dynamics(ssys, N).LM(list_P, disturbance_ind)
 
-    n = A.shape[1]  # State space dimension
-    m = B.shape[1]  # Input space dimension
-    p = E.shape[1]  # Disturbance space dimension
-    
-    # non-zero disturbance matrix E ?
-    if not np.all(E==0):
-        if not pc.is_fulldim(D):
-            E = np.zeros(K.shape)
-    
-    list_len = np.array([P.A.shape[0] for P in list_P])
-    sumlen = np.sum(list_len)
+# compiled dynamics, by system and horizon
+_compiled = weakref.WeakKeyDictionary()
 
-    LUn = np.shape(PU.A)[0]
+def compile_dynamics(ssys, N):
+    """Return L{CompiledDynamics} of C{ssys} for horizon C{N}.
     
-    Lk = np.zeros([sumlen, n+N*m])
-    LU = np.zeros([LUn*N, n+N*m])
+    The result is cached while C{ssys} exists.
+    It is recomputed if any of the attributes
+    C{A, B, E, K, Uset, Wset} of C{ssys} has been
+    assigned a different object since.
+    Changing these arrays in place is not detected.
     
-    Mk = np.zeros([sumlen, 1])
-    MU = np.tile(PU.b.reshape(PU.b.size, 1), (N, 1))
-  
-    Gk = np.zeros([sumlen, p*N])
-    GU = np.zeros([LUn*N, p*N])
+    @type ssys: L{LtiSysDyn}
+    @type N: int > 0
+    @rtype: L{CompiledDynamics}
+    """
+    try:
+        by_N = _compiled[ssys]
+    except KeyError:
+        by_N = dict()
+        _compiled[ssys] = by_N
+    except TypeError:
+        # not weakly referenceable
+        return CompiledDynamics(ssys, N)
+    
+    cd = by_N.get(N)
+    if cd is None or not cd.is_of(ssys):
+        cd = CompiledDynamics(ssys, N)
+        by_N[N] = cd
+    return cd
+
+class CompiledDynamics(object):
+    """Prediction matrices of C{ssys} over horizon C{N}.
     
-    K_hat = np.tile(K, (N, 1))
+    Holds the parts of the constraints in L{createLM}
+    that do not depend on the polytopes,
+    for each step k = 0, ..., N:
     
-    B_diag = B
-    E_diag = E
-    for i in xrange(N-1):
-        B_diag = _block_diag2(B_diag, B)
-        E_diag = _block_diag2(E_diag, E)
+      - C{A_n[k]} = A^k
+      - C{A_k[k]} = [A^(k-1) ... A I 0 ... 0]
+      - C{AB_line[k]} = [A_n[k], A_k[k] B_diag]
     
-    A_n = np.eye(n)
-    A_k = np.zeros([n, n*N])
+    and the input constraint rows C{LU, MU}
+    and disturbance rows of C{GU}.
     
-    sum_vert = 0
-    for i in xrange(N+1):
-        Li = list_P[i]
+    Use L{compile_dynamics} to obtain instances.
+    """
+    def __init__(self, ssys, N):
+        self._sig = _dynamics_signature(ssys)
         
-        if not isinstance(Li, pc.Polytope):
-            logger.warn('createLM: Li of type: ' +str(type(Li) ) )
+        A = ssys.A
+        B = ssys.B
+        E = ssys.E
+        K = ssys.K
         
-        ######### FOR M #########
-        idx = range(sum_vert, sum_vert + Li.A.shape[0])
-        Mk[idx, :] = Li.b.reshape(Li.b.size,1) - \
-                     Li.A.dot(A_k).dot(K_hat)
+        D = ssys.Wset
+        PU = ssys.Uset
         
-        ######### FOR G #########
-        if i in disturbance_ind:
-            idx = np.ix_(
-                range(sum_vert, sum_vert + Li.A.shape[0]),
-                range(Gk.shape[1])
-            )
-            Gk[idx] = Li.A.dot(A_k).dot(E_diag)
+        n = A.shape[1]  # State space dimension
+        m = B.shape[1]  # Input space dimension
+        p = E.shape[1]  # Disturbance space dimension
+        
+        # non-zero disturbance matrix E ?
+        if not np.all(E==0):
+            if not pc.is_fulldim(D):
+                E = np.zeros([n, p])
+        
+        self.N = N
+        self.n = n
+        self.m = m
+        self.p = p
+        self.D = D
+        
+        self.K_hat = np.tile(K, (N, 1))
+        self.B_diag = _block_diag(B, N)
+        self.E_diag = _block_diag(E, N)
+        
+        self.A_n = []
+        self.A_k = []
+        self.AB_line = []
+        
+        A_n = np.eye(n)
+        A_k = np.zeros([n, n*N])
+        for i in xrange(N+1):
+            self.A_n.append(A_n)
+            self.A_k.append(A_k)
+            self.AB_line.append(np.hstack([A_n, A_k.dot(self.B_diag)]))
+            
+            if i == N:
+                break
             
-            if (PU.A.shape[1] == m+n) and (i < N):
-                A_k_E_diag = A_k.dot(E_diag)
+            A_n = A.dot(A_n)
+            A_k = A.dot(A_k)
+            A_k[:, i*n:(i+1)*n] = np.eye(n)
+        
+        # input constraints
+        LUn = np.shape(PU.A)[0]
+        self.LUn = LUn
+        self.LU = np.zeros([LUn*N, n+N*m])
+        self.MU = np.tile(PU.b.reshape(PU.b.size, 1), (N, 1))
+        
+        # rows of GU for each k < N, if the input set
+        # depends on the state
+        self.GU_blocks = None
+        
+        if PU.A.shape[1] == m:
+            for i in xrange(N):
+                self.LU[i*LUn:(i+1)*LUn, n+m*i:n+m*(i+1)] = PU.A
+        elif PU.A.shape[1] == m+n:
+            self.GU_blocks = []
+            for i in xrange(N):
+                A_k_E_diag = self.A_k[i].dot(self.E_diag)
                 d_mult = np.vstack([np.zeros([m, p*N]), A_k_E_diag])
+                self.GU_blocks.append(PU.A.dot(d_mult))
                 
-                idx = np.ix_(range(LUn*i, LUn*(i+1)), range(p*N))
-                GU[idx] = PU.A.dot(d_mult)
+                uk_line = np.zeros([m, n + m*N])
+                uk_line[:, n+m*i:n+m*(i+1)] = np.eye(m)
+                
+                A_mult = np.vstack([uk_line, self.AB_line[i]])
+                
+                b_mult = np.zeros([m+n, 1])
+                b_mult[m:m+n, :] = self.A_k[i].dot(self.K_hat)
+                
+                self.LU[i*LUn:(i+1)*LUn, :] = PU.A.dot(A_mult)
+                self.MU[i*LUn:(i+1)*LUn, :] -= PU.A.dot(b_mult)
         
-        ######### FOR L #########
-        AB_line = np.hstack([A_n, A_k.dot(B_diag)])
+        self._DN_extreme = None
+        self._A_N = None
+    
+    def is_of(self, ssys):
+        """Return C{True} if compiled from the current matrices of C{ssys}.
+        """
+        sig = _dynamics_signature(ssys)
+        return all(a is b for a, b in zip(self._sig, sig))
+    
+    @property
+    def A_N(self):
+        """Stacked [A; A^2; ...; A^N]."""
+        self._stack_cost_matrices()
+        return self._A_N
+    
+    @property
+    def Ct(self):
+        """Map from inputs to stacked states x(1), ..., x(N)."""
+        self._stack_cost_matrices()
+        return self._Ct
+    
+    @property
+    def A_K_hat(self):
+        """Effect of affine term K on stacked states x(1), ..., x(N)."""
+        self._stack_cost_matrices()
+        return self._A_K_hat
+    
+    def _stack_cost_matrices(self):
+        if self._A_N is not None:
+            return
+        A_K = np.vstack(self.A_k[1:])
+        self._A_N = np.vstack(self.A_n[1:])
+        self._Ct = A_K.dot(self.B_diag)
+        self._A_K_hat = A_K.dot(self.K_hat)
+    
+    @property
+    def DN_extreme(self):
+        """Vertices of the disturbance set D^N, as columns."""
+        if self._DN_extreme is None:
+            self._DN_extreme = _product_extreme(self.D, self.N)
+        return self._DN_extreme
+    
+    def LM(self, list_P, disturbance_ind=None):
+        """Return C{L, M} of L{createLM} for polytopes C{list_P}.
         
-        idx = np.ix_(
-            range(sum_vert, sum_vert + Li.A.shape[0]),
-            range(0,Lk.shape[1])
-        )
-        Lk[idx] = Li.A.dot(AB_line)
+        @type list_P: list of N+1 C{Polytope}
+        """
+        N = self.N
+        n = self.n
+        m = self.m
+        p = self.p
+        LUn = self.LUn
         
-        if i >= N:
-            continue
+        if disturbance_ind is None:
+            disturbance_ind = range(1,N+1)
         
-        if PU.A.shape[1] == m:
-            idx = np.ix_(
-                range(i*LUn, (i+1)*LUn),
-                range(n + m*i, n + m*(i+1))
-            )
-            LU[idx] = PU.A
-        elif PU.A.shape[1] == m+n:
-            uk_line = np.zeros([m, n + m*N])
+        list_len = [P.A.shape[0] for P in list_P[:N+1]]
+        sumlen = sum(list_len)
+        
+        L = np.empty([sumlen + LUn*N, n+N*m])
+        M = np.empty([sumlen + LUn*N, 1])
+        Gk = np.zeros([sumlen, p*N])
+        
+        L[sumlen:, :] = self.LU
+        M[sumlen:, :] = self.MU
+        
+        sum_vert = 0
+        for i in xrange(N+1):
+            Li = list_P[i]
             
-            idx = np.ix_(range(m), range(n+m*i, n+m*(i+1)))
-            uk_line[idx] = np.eye(m)
+            if not isinstance(Li, pc.Polytope):
+                logger.warn('createLM: Li of type: ' +str(type(Li) ) )
             
-            A_mult = np.vstack([uk_line, AB_line])
+            rows = slice(sum_vert, sum_vert + list_len[i])
+            LiA_k = Li.A.dot(self.A_k[i])
             
-            b_mult = np.zeros([m+n, 1])
-            b_mult[range(m, m+n), :] = A_k.dot(K_hat)
+            ######### FOR M #########
+            M[rows, :] = Li.b.reshape(Li.b.size,1) - \
+                         LiA_k.dot(self.K_hat)
             
-            idx = np.ix_(
-                range(i*LUn, (i+1)*LUn),
-                range(n+m*N)
-            )
-            LU[idx] = PU.A.dot(A_mult)
+            ######### FOR G #########
+            if i in disturbance_ind:
+                Gk[rows, :] = LiA_k.dot(self.E_diag)
             
-            MU[range(i*LUn, (i+1)*LUn), :] -= PU.A.dot(b_mult)
+            ######### FOR L #########
+            L[rows, :] = Li.A.dot(self.AB_line[i])
+            
+            sum_vert += list_len[i]
         
-        ####### Iterate #########
-        sum_vert += Li.A.shape[0]
-        A_n = A.dot(A_n)
-        A_k = A.dot(A_k)
+        # Get disturbance sets
+        if not np.all(Gk==0):
+            GU = np.zeros([LUn*N, p*N])
+            if self.GU_blocks is not None:
+                for i in xrange(N):
+                    if i in disturbance_ind:
+                        GU[i*LUn:(i+1)*LUn, :] = self.GU_blocks[i]
+            G = np.vstack([Gk, GU])
+            D_hat = np.amax(np.dot(G, self.DN_extreme), axis=1)
+            M -= D_hat.reshape(D_hat.size, 1)
         
-        idx = np.ix_(range(n), range(i*n, (i+1)*n))
-        A_k[idx] = np.eye(n)
-                
-    # Get disturbance sets
-    if not np.all(Gk==0):  
-        G = np.vstack([Gk, GU])
-        D_hat = get_max_extreme(G, D, N)
-    else:
-        D_hat = np.zeros([sumlen + LUn*N, 1])
+        if logger.getEffectiveLevel() <= logging.DEBUG:
+            msg = 'Computed S0 polytope: L x <= M, where:\n\t L = \n'
+            msg += str(L) +'\n\t M = \n' + str(M) +'\n'
+            logger.debug(msg)
+        
+        return L, M
+
+def _dynamics_signature(ssys):
+    return (ssys.A, ssys.B, ssys.E, ssys.K, ssys.Uset, ssys.Wset)
+
+def _block_diag(A, N):
+    """Return block diagonal matrix with C{N} copies of C{A}."""
+    if len(A.shape) == 1:  # Cast 1d array into matrix
+        A = np.array([A])
+    r, c = A.shape
+    C = np.zeros((r*N, c*N))
+    for i in xrange(N):
+        C[i*r:(i+1)*r, i*c:(i+1)*c] = A
+    return C
 
-    # Put together matrices L, M
-    L = np.vstack([Lk, LU])
-    M = np.vstack([Mk, MU]) - D_hat
+def _product_extreme(D, N):
+    """Return vertices of D^N as columns.
     
-    msg = 'Computed S0 polytope: L x <= M, where:\n\t L = \n'
-    msg += str(L) +'\n\t M = \n' + str(M) +'\n'
-    logger.debug(msg)
+    Column i is made of the vertices of C{D}
+    indexed by the digits of i in base
+    equal to the number of vertices, least significant first.
+    """
+    D_extreme = pc.extreme(D)
+    nv = D_extreme.shape[0]
+    dim = D_extreme.shape[1]
+    DN_extreme = np.zeros([dim*N, nv**N])
     
-    return L,M
+    cols = np.arange(nv**N)
+    for j in xrange(N):
+        digit = (cols // nv**j) % nv
+        DN_extreme[j*dim:(j+1)*dim, :] = D_extreme[digit, :].T
+    return DN_extreme
 
 def get_max_extreme(G,D,N):
     """Calculate the array d_hat such that::
@@ -529,17 +849,7 @@ def get_max_extreme(G,D,N):
     @return: d_hat: Array describing the maximum possible
         effect from the disturbance
     """
-    D_extreme = pc.extreme(D)
-    nv = D_extreme.shape[0]
-    dim = D_extreme.shape[1]
-    DN_extreme = np.zeros([dim*N, nv**N])
-    
-    for i in xrange(nv**N):
-        # Last N digits are indices we want!
-        ind = np.base_repr(i, base=nv, padding=N)
-        for j in xrange(N):
-            DN_extreme[range(j*dim,(j+1)*dim),i] = D_extreme[int(ind[-j-1]),:]
-
+    DN_extreme = _product_extreme(D, N)
     d_hat = np.amax(np.dot(G,DN_extreme), axis=1)     
     return d_hat.reshape(d_hat.size,1)
 
@@ -35,6 +35,11 @@ Algorithms related to controller synthesis for discretized dynamics.
     
 Primary functions:
     - L{get_input}
+    - L{get_input_batch}
+    - L{find_discrete_states}
+
+Classes:
+    - L{CompiledController}
     
 Helper functions:
     - L{get_input_helper}
@@ -47,12 +52,15 @@ L{discretize}
 from __future__ import absolute_import
 
 import logging
+import multiprocessing as mp
+
 import numpy as np
 from cvxopt import matrix, solvers
 
 import polytope as pc
 
-from .feasible import solve_feasible, createLM, _block_diag2
+from .feasible import solve_feasible, createLM, compile_dynamics
+from .spatial import PointLocator, geometry
 
 
 logger = logging.getLogger(__name__)
@@ -173,44 +181,102 @@ def get_input(
     #    if closed loop discretization has been used.
     #@type closed_loop: bool
     
-    part = abstraction.ppp
-    regions = part.regions
-    
-    ofts = abstraction.ts
-    original_regions = abstraction.orig_ppp
-    orig = abstraction._ppp2orig
+    regions = abstraction.ppp.regions
     
     params = abstraction.disc_params
     N = params['N']
-    conservative = params['conservative']
     closed_loop = params['closed_loop']
     
+    R, r, Q, mid_weight = _cost_matrices(
+        N, x0.size, ssys.B.shape[1], R, r, Q, mid_weight)
+    _check_transition(abstraction, start, end)
+    
+    P_end = regions[end]
+    
+    n = ssys.A.shape[1]
+    m = ssys.B.shape[1]
+    
+    P1 = _transition_set(abstraction, start)
+    
+    if len(P_end) > 0:
+        low_cost = np.inf
+        low_u = np.zeros([N,m])
+        
+        # for each polytope in target region
+        for P3 in P_end:
+            R3, r3 = _target_cost(R, r, P3, mid_weight, N, n)
+            try:
+                u, cost = get_input_helper(
+                    x0, ssys, P1, P3, N, R3, r3, Q,
+                    closed_loop=closed_loop
+                )
+            except:
+                continue
+            
+            if cost < low_cost:
+                low_u = u
+                low_cost = cost
+        
+        if low_cost == np.inf:
+            raise Exception("get_input: Did not find any trajectory")
+    else:
+        P3 = P_end
+        R3, r3 = _target_cost(R, r, P3, mid_weight, N, n)
+        low_u, cost = get_input_helper(
+            x0, ssys, P1, P3, N, R3, r3, Q,
+            closed_loop=closed_loop
+        )
+        
+    if test_result:
+        good = is_seq_inside(x0, low_u, ssys, P1, P3)
+        if not good:
+            print("Calculated sequence not good")
+    return low_u
+
+def _cost_matrices(N, n, m, R, r, Q, mid_weight):
+    """Return C{R, r, Q, mid_weight} of L{get_input}, with defaults."""
     if (len(R) == 0) and (len(Q) == 0) and \
     (len(r) == 0) and (mid_weight == 0):
         # Default behavior
-        Q = np.eye(N*ssys.B.shape[1])
-        R = np.zeros([N*x0.size, N*x0.size])
-        r = np.zeros([N*x0.size,1])
         mid_weight = 3
     if len(R) == 0:
-        R = np.zeros([N*x0.size, N*x0.size])
+        R = np.zeros([N*n, N*n])
     if len(Q) == 0:
-        Q = np.eye(N*ssys.B.shape[1])    
+        Q = np.eye(N*m)
     if len(r) == 0:
-        r = np.zeros([N*x0.size,1])
+        r = np.zeros([N*n, 1])
+    R = np.array(R, dtype=float)
+    r = np.array(r, dtype=float).reshape(N*n, 1)
     
-    if (R.shape[0] != R.shape[1]) or (R.shape[0] != N*x0.size):
+    if (R.shape[0] != R.shape[1]) or (R.shape[0] != N*n):
         raise Exception("get_input: "
             "R must be square and have side N * dim(state space)")
     
-    if (Q.shape[0] != Q.shape[1]) or (Q.shape[0] != N*ssys.B.shape[1]):
+    if (Q.shape[0] != Q.shape[1]) or (Q.shape[0] != N*m):
         raise Exception("get_input: "
             "Q must be square and have side N * dim(input space)")
+    return R, r, Q, mid_weight
+
+def _target_cost(R, r, P3, mid_weight, N, n):
+    """Return C{R, r} plus the cost C{mid_weight *|xc-x(N)|_2}.
+    
+    C{xc} is the Chebyshev center of C{P3}.
+    """
+    if mid_weight <= 0:
+        return R, r
+    rc, xc = geometry(P3).cheby_ball
+    idx = range((N-1)*n, N*n)
+    R = R.copy()
+    r = r.copy()
+    R[np.ix_(idx, idx)] += mid_weight*np.eye(n)
+    r[idx, :] += -mid_weight*xc.reshape(n, 1)
+    return R, r
+
+def _check_transition(abstraction, start, end):
+    """Raise C{Exception} if C{abstraction.ts} lacks C{start -> end}."""
+    ofts = abstraction.ts
     if ofts is not None:
-        start_state = start
-        end_state = end
-        
-        if end_state not in ofts.states.post(start_state):
+        if end not in ofts.states.post(start):
             raise Exception('get_input: '
                 'no transition from state s' +str(start) +
                 ' to state s' +str(end)
@@ -218,32 +284,28 @@ def get_input(
     else:
         print("get_input: "
             "Warning, no transition matrix found, assuming feasible")
+
+def _transition_set(abstraction, start):
+    """Return convex set where the plant stays while leaving C{start}.
+    
+    See note 3 of L{get_input}.
+    """
+    P_start = abstraction.ppp.regions[start]
+    original_regions = abstraction.orig_ppp
+    orig = abstraction._ppp2orig
+    conservative = abstraction.disc_params['conservative']
     
     if (not conservative) & (orig is None):
         print("List of original proposition preserving "
             "partitions not given, reverting to conservative mode")
         conservative = True
-       
-    P_start = regions[start]
-    P_end = regions[end]
-    
-    n = ssys.A.shape[1]
-    m = ssys.B.shape[1]
-    
-    idx = range((N-1)*n, N*n)
     
     if conservative:
         # Take convex hull or P_start as constraint
         if len(P_start) > 0:
             if len(P_start) > 1:
                 # Take convex hull
-                vert = pc.extreme(P_start[0])
-                for i in range(1, len(P_start)):
-                    vert = np.hstack([
-                        vert,
-                        pc.extreme(P_start[i])
-                    ])
-                P1 = pc.qhull(vert)
+                P1 = geometry(P_start).hull
             else:
                 P1 = P_start[0]
         else:
@@ -259,61 +321,7 @@ def get_input(
                 print P1
                 raise Exception("conservative = False flag requires "
                                 "original regions to be convex")
-    
-    if len(P_end) > 0:
-        low_cost = np.inf
-        low_u = np.zeros([N,m])
-        
-        # for each polytope in target region
-        for P3 in P_end:
-            if mid_weight > 0:
-                rc, xc = pc.cheby_ball(P3)
-                R[
-                    np.ix_(
-                        range(n*(N-1), n*N),
-                        range(n*(N-1), n*N)
-                    )
-                ] += mid_weight*np.eye(n)
-                
-                r[idx, :] += -mid_weight*xc
-            
-            try:
-                u, cost = get_input_helper(
-                    x0, ssys, P1, P3, N, R, r, Q,
-                    closed_loop=closed_loop
-                )
-                r[idx, :] += mid_weight*xc
-            except:
-                r[idx, :] += mid_weight*xc
-                continue
-            
-            if cost < low_cost:
-                low_u = u
-                low_cost = cost
-        
-        if low_cost == np.inf:
-            raise Exception("get_input: Did not find any trajectory")
-    else:
-        P3 = P_end
-        if mid_weight > 0:
-            rc, xc = pc.cheby_ball(P3)
-            R[
-                np.ix_(
-                    range(n*(N-1), n*N),
-                    range(n*(N-1), n*N)
-                )
-            ] += mid_weight*np.eye(n)
-            r[idx, :] += -mid_weight*xc
-        low_u, cost = get_input_helper(
-            x0, ssys, P1, P3, N, R, r, Q,
-            closed_loop=closed_loop
-        )
-        
-    if test_result:
-        good = is_seq_inside(x0, low_u, ssys, P1, P3)
-        if not good:
-            print("Calculated sequence not good")
-    return low_u
+    return P1
 
 def get_input_helper(
     x0, ssys, P1, P3, N, R, r, Q,
@@ -331,6 +339,44 @@ def get_input_helper(
     n = ssys.A.shape[1]
     m = ssys.B.shape[1]
     
+    Lx, Lu, M = _input_constraints(ssys, P1, P3, N, closed_loop)
+    M = M - Lx.dot(x0).reshape(Lx.shape[0],1)
+        
+    # Constraints
+    G = matrix(Lu)
+    h = matrix(M)
+
+    cd = compile_dynamics(ssys, N)
+    Ct = cd.Ct
+    P = matrix(Q + Ct.T.dot(R).dot(Ct) )
+    q = matrix(
+        np.dot(
+            np.dot(x0.reshape(1, x0.size), cd.A_N.T) +
+            cd.A_K_hat.T, R.dot(Ct)
+        ) +
+        r.T.dot(Ct)
+    ).T 
+    
+    sol = solvers.qp(P, q, G, h)
+    
+    if sol['status'] != "optimal":
+        raise Exception("getInputHelper: "
+            "QP solver finished with status " +
+            str(sol['status'])
+        )
+    u = np.array(sol['x']).flatten()
+    cost = sol['primal objective']
+    
+    return u.reshape(N, m), cost
+
+def _input_constraints(ssys, P1, P3, N, closed_loop=True):
+    """Return C{Lx, Lu, M} such that the constraints
+    of L{get_input_helper} are::
+    
+        Lx x(0) + Lu [u(0)' ... u(N-1)']' <= M
+    """
+    n = ssys.A.shape[1]
+    
     list_P = []
     if closed_loop:
         temp_part = P3
@@ -357,63 +403,276 @@ def get_input_helper(
     # Separate L matrix
     Lx = L[:,range(n)]
     Lu = L[:,range(n,L.shape[1])] 
+    return Lx, Lu, M
+
+class CompiledController(object):
+    """Precompiled L{get_input} for the transitions of an abstraction.
     
-    M = M - Lx.dot(x0).reshape(Lx.shape[0],1)
+    For each transition C{start -> end}, and each polytope
+    of region C{end}, the constraints and cost of the QP
+    solved by L{get_input_helper} are computed once::
+    
+        min 1/2 u'P u + (Fx x + f0)'u
+        s.t. Lu u <= M - Lx x
+    
+    so that L{step} only forms the right-hand sides for the
+    current state C{x} and solves the QPs.
+    Each QP is warm-started from its previous solution.
+    
+    Cost parameters are those of L{get_input}.
+    
+    Example::
+    
+        controller = CompiledController(ssys, abstraction)
+        u = controller.step(x, start, end)
+    """
+    def __init__(
+        self, ssys, abstraction,
+        R=[], r=[], Q=[], mid_weight=0.0,
+        transitions=None
+    ):
+        """Compile the QPs of C{transitions}.
         
-    # Constraints
-    G = matrix(Lu)
-    h = matrix(M)
-
-    B_diag = ssys.B
-    for i in xrange(N-1):
-        B_diag = _block_diag2(B_diag,ssys.B)
-    K_hat = np.tile(ssys.K, (N,1))
-
-    A_it = ssys.A.copy()
-    A_row = np.zeros([n, n*N])
-    A_K = np.zeros([n*N, n*N])
-    A_N = np.zeros([n*N, n])
-
-    for i in xrange(N):
-        A_row = ssys.A.dot(A_row)
-        A_row[np.ix_(
-            range(n),
-            range(i*n, (i+1)*n)
-        )] = np.eye(n)
-
-        A_N[np.ix_(
-            range(i*n, (i+1)*n),
-            range(n)
-        )] = A_it
+        @param transitions: pairs C{(start, end)} to compile now.
+            If C{None}, then all transitions of C{abstraction.ts}.
+            Other transitions are compiled by the first L{step}
+            that needs them.
+        @type transitions: iterable of C{(int, int)}
+        """
+        self.ssys = ssys
+        self.abstraction = abstraction
         
-        A_K[np.ix_(
-            range(i*n,(i+1)*n),
-            range(A_K.shape[1])
-        )] = A_row
+        params = abstraction.disc_params
+        self.N = params['N']
+        self.closed_loop = params['closed_loop']
         
-        A_it = ssys.A.dot(A_it)
+        n = ssys.A.shape[1]
+        m = ssys.B.shape[1]
+        self.R, self.r, self.Q, self.mid_weight = _cost_matrices(
+            self.N, n, m, R, r, Q, mid_weight)
         
-    Ct = A_K.dot(B_diag)
-    P = matrix(Q + Ct.T.dot(R).dot(Ct) )
-    q = matrix(
-        np.dot(
-            np.dot(x0.reshape(1, x0.size), A_N.T) +
-            A_K.dot(K_hat).T, R.dot(Ct)
-        ) +
-        r.T.dot(Ct)
-    ).T 
+        self._qps = dict()
+        if transitions is None:
+            if abstraction.ts is None:
+                transitions = []
+            else:
+                transitions = abstraction.ts.transitions()
+        for start, end in transitions:
+            self.compile(start, end)
     
-    sol = solvers.qp(P, q, G, h)
+    def compile(self, start, end):
+        """Compute the QPs for transition C{start -> end}.
+        
+        @return: number of polytopes of region C{end}
+            with a feasible QP
+        """
+        _check_transition(self.abstraction, start, end)
+        
+        ssys = self.ssys
+        N = self.N
+        n = ssys.A.shape[1]
+        
+        P1 = _transition_set(self.abstraction, start)
+        P_end = self.abstraction.ppp.regions[end]
+        if len(P_end) > 0:
+            targets = list(P_end)
+        else:
+            targets = [P_end]
+        
+        cd = compile_dynamics(ssys, N)
+        Ct = cd.Ct
+        
+        qps = []
+        for P3 in targets:
+            R3, r3 = _target_cost(
+                self.R, self.r, P3, self.mid_weight, N, n)
+            try:
+                Lx, Lu, M = _input_constraints(
+                    ssys, P1, P3, N, self.closed_loop)
+            except:
+                continue
+            
+            CtR = Ct.T.dot(R3.T)
+            qps.append(_CompiledQP(
+                P=matrix(self.Q + Ct.T.dot(R3).dot(Ct)),
+                Fx=CtR.dot(cd.A_N),
+                f0=(CtR.dot(cd.A_K_hat) + Ct.T.dot(r3)).flatten(),
+                G=matrix(Lu),
+                Lx=Lx,
+                M=M.flatten()
+            ))
+        self._qps[(start, end)] = qps
+        return len(qps)
+    
+    def step(self, x, start, end):
+        """Return input sequence from C{x} for C{start -> end}.
+        
+        Same as L{get_input} with the compiled parameters.
+        
+        @param x: current continuous state
+        @type x: numpy 1darray
+        
+        @return: array whose row k is the input u(k)
+        @rtype: (N x m) numpy 2darray
+        """
+        try:
+            qps = self._qps[(start, end)]
+        except KeyError:
+            self.compile(start, end)
+            qps = self._qps[(start, end)]
+        
+        x = np.asarray(x, dtype=float).flatten()
+        low_u = _best_input(qps, x)
+        if low_u is None:
+            raise Exception("get_input: Did not find any trajectory")
+        return low_u.reshape(self.N, self.ssys.B.shape[1])
     
-    if sol['status'] != "optimal":
-        raise Exception("getInputHelper: "
-            "QP solver finished with status " +
-            str(sol['status'])
-        )
-    u = np.array(sol['x']).flatten()
-    cost = sol['primal objective']
+    def step_batch(self, X, start, end):
+        """Return input sequences from the rows of C{X}.
+        
+        Same as L{step} for each row,
+        except that infeasible states are marked in the mask
+        returned, as in L{get_input_batch}.
+        
+        @rtype: C{(numpy 3darray of shape (n_samples, N, m),
+            numpy 1darray of bool)}
+        """
+        try:
+            qps = self._qps[(start, end)]
+        except KeyError:
+            self.compile(start, end)
+            qps = self._qps[(start, end)]
+        
+        m = self.ssys.B.shape[1]
+        X = np.asarray(X, dtype=float).reshape((-1, self.ssys.A.shape[1]))
+        U, feasible = _input_batch(qps, X, self.N*m)
+        return U.reshape(len(X), self.N, m), feasible
+
+def _best_input(qps, x):
+    """Return solution of least cost among C{qps} at C{x}, or C{None}."""
+    low_cost = np.inf
+    low_u = None
+    for qp in qps:
+        sol = qp.solve(x)
+        if sol is None:
+            continue
+        u, cost = sol
+        if cost < low_cost:
+            low_u = u
+            low_cost = cost
+    return low_u
+
+class _CompiledQP(object):
+    """QP of L{CompiledController} for one target polytope."""
+    def __init__(self, P, Fx, f0, G, Lx, M):
+        self.P = P
+        self.Fx = Fx
+        self.f0 = f0
+        self.G = G
+        self.Lx = Lx
+        self.M = M
+        self.x = None
+    
+    def solve(self, x0):
+        """Return C{(u, cost)} for state C{x0}, or C{None}."""
+        h = self.M - self.Lx.dot(x0)
+        q = self.Fx.dot(x0) + self.f0
+        
+        q = matrix(q)
+        h = matrix(h)
+        sol = None
+        if self.x is not None:
+            # slacks are initialized by the solver
+            try:
+                sol = solvers.qp(self.P, q, self.G, h,
+                                 initvals={'x':matrix(self.x)})
+            except (ValueError, ArithmeticError):
+                sol = None
+        if sol is None:
+            try:
+                sol = solvers.qp(self.P, q, self.G, h)
+            except (ValueError, ArithmeticError):
+                return None
+        if sol['status'] != "optimal":
+            return None
+        u = np.array(sol['x']).flatten()
+        self.x = u
+        return u, sol['primal objective']
+
+def get_input_batch(
+    X0, ssys, abstraction,
+    start, end,
+    R=[], r=[], Q=[], mid_weight=0.0,
+    n_jobs=1
+):
+    """Compute control inputs from many initial states.
     
-    return u.reshape(N, m), cost
+    Same as calling L{get_input} for each row of C{X0},
+    except that states from which no input is found
+    are marked in the returned mask, instead of raising
+    an C{Exception}.
+    
+    The QPs of the transition are compiled once,
+    as in L{CompiledController}, and each solve is warm-started
+    from the solution for the previous state.
+    
+    @param X0: initial continuous states, one per row
+    @type X0: numpy 2darray of shape C{(n_samples, n)}
+    
+    @param n_jobs: number of worker processes,
+        each solving a share of the samples
+    @type n_jobs: int >= 1
+    
+    For the other parameters see L{get_input}.
+    
+    @return: C{(U, feasible)} where C{U[i, k]} is the input u(k)
+        from state C{X0[i]}, and C{feasible[i]} is C{False}
+        if no input was found from C{X0[i]}, in which case
+        C{U[i]} is zero
+    @rtype: C{(numpy 3darray of shape (n_samples, N, m),
+        numpy 1darray of bool)}
+    """
+    controller = CompiledController(
+        ssys, abstraction, R, r, Q, mid_weight,
+        transitions=[(start, end)]
+    )
+    qps = controller._qps[(start, end)]
+    
+    X0 = np.asarray(X0, dtype=float)
+    X0 = X0.reshape((-1, ssys.A.shape[1]))
+    N = controller.N
+    m = ssys.B.shape[1]
+    
+    if n_jobs > 1 and len(X0) > 1:
+        chunks = np.array_split(X0, min(len(X0), 4 * n_jobs))
+        pool = mp.Pool(n_jobs)
+        try:
+            results = pool.map(_input_batch_star,
+                               [(qps, chunk, N*m) for chunk in chunks])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_input_batch(qps, X0, N*m)]
+    
+    U = np.vstack([u for u, feasible in results])
+    feasible = np.hstack([feasible for u, feasible in results])
+    return U.reshape(len(X0), N, m), feasible
+
+def _input_batch(qps, X0, size):
+    """Return inputs and feasibility mask for rows of C{X0}."""
+    U = np.zeros([len(X0), size])
+    feasible = np.zeros(len(X0), dtype=bool)
+    for i, x in enumerate(X0):
+        u = _best_input(qps, x)
+        if u is None:
+            continue
+        U[i] = u
+        feasible[i] = True
+    return U, feasible
+
+def _input_batch_star(args):
+    return _input_batch(*args)
 
 def is_seq_inside(x0, u_seq, ssys, P0, P1):
     """Checks if the plant remains inside P0 for time t = 1, ... N-1
@@ -486,3 +745,25 @@ def find_discrete_state(x0, part):
         if pc.is_inside(region, x0):
              return i
     return None
+
+def find_discrete_states(x, part):
+    """Return indices of the discrete states of many continuous states.
+    
+    Vectorized version of L{find_discrete_state}.
+    
+    @param x: continuous states, one per row
+    @type x: numpy 2darray of shape C{(n_states, dim)}
+    
+    @param part: state space partition.
+        A L{PointLocator} of it can be reused across calls.
+    @type part: L{PropPreservingPartition}, L{PackedPartition}
+        or L{PointLocator}
+    
+    @return: for each row of C{x}, the index of the first
+        discrete state in C{part} that contains it,
+        or -1 if none does
+    @rtype: numpy 1darray of int
+    """
+    if not isinstance(part, PointLocator):
+        part = PointLocator(part)
+    return part.locate(x)
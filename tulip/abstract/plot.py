@@ -97,6 +97,14 @@ def plot_ts_on_partition(ppp, ts, ppp2ts, edge_label, only_adjacent, ax):
     arr_size = (u[0,0]-l[0,0])/50.0
     
     ts2ppp = {v:k for k,v in enumerate(ppp2ts)}
+    # each region once, so that its Chebyshev ball is computed once,
+    # also when the regions of ppp are created on access
+    regions = dict()
+    def region(i):
+        if i not in regions:
+            regions[i] = ppp.regions[i]
+        return regions[i]
+    
     for from_state, to_state, label in ts.transitions.find(with_attr_dict=edge_label):
         i = ts2ppp[from_state]
         j = ts2ppp[to_state]
@@ -105,7 +113,7 @@ def plot_ts_on_partition(ppp, ts, ppp2ts, edge_label, only_adjacent, ax):
             if ppp.adj[i, j] == 0:
                 continue
         
-        plot_transition_arrow(ppp.regions[i], ppp.regions[j], ax, arr_size)
+        plot_transition_arrow(region(i), region(j), ax, arr_size)
 
 def project_strategy_on_partition(ppp, mealy):
     """Return an FTS with the PPP (spatial) transitions used by Mealy strategy.
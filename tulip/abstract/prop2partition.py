@@ -41,14 +41,23 @@ logger = logging.getLogger(__name__)
 
 import warnings
 import copy
+import itertools
 
 import numpy as np
 from scipy import sparse as sp
+from cvxopt import matrix, solvers
 import polytope as pc
 from polytope.plot import plot_partition
 
 
 from tulip import transys as trs
+from .spatial import RegionIndex, bounding_box
+
+try:
+    import cvxopt.glpk
+    _lp_solver = 'glpk'
+except ImportError:
+    _lp_solver = None
 
 
 # inline imports:
@@ -65,7 +74,8 @@ def prop2part(state_space, cont_props_dict):
     See Also
     ========
     L{PropPreservingPartition},
-    C{polytope.Polytope}
+    C{polytope.Polytope},
+    L{prop2part_arrangement} for many propositions
     
     @param state_space: problem domain
     @type state_space: C{polytope.Polytope}
@@ -181,6 +191,259 @@ def part2convex(ppp):
     
     return (cvxpart, new2old)
     
+def prop2part_arrangement(state_space, cont_props_dict, abs_tol=1e-7):
+    """Return partition into convex cells of the proposition facets.
+    
+    The result is a refinement of C{part2convex(prop2part(...))}:
+    each Region is a single convex polytope, labeled with
+    the propositions that hold in it.
+    
+    The cells are enumerated once, by cutting the domain
+    with the hyperplanes of the facets of the propositions.
+    Each cell records on which side of each hyperplane it lies,
+    i.e., its sign vector.
+    For each proposition polytope, the facets are visited in turn,
+    and a cell is cut by a facet only if the earlier facets
+    do not already decide whether the polytope contains it.
+    So a cell is labeled with a proposition as soon as
+    its sign vector agrees with all the facets of the proposition.
+    
+    Cells adjacent across a hyperplane have opposite signs for it.
+    Adjacency is updated when a cell is cut:
+    the two pieces are adjacent, and each neighbor of the cell
+    is adjacent to the pieces that its common facet meets.
+    So no pairwise adjacency test is needed afterwards.
+    Cells that touch only at lower-dimensional faces,
+    e.g., at a vertex, are not adjacent.
+    
+    Unlike L{prop2part}, no Region is copied or intersected,
+    which makes partitions of domains with many propositions,
+    e.g., large maps, practical.
+    
+    See Also
+    ========
+    L{prop2part}, L{part2convex}
+    
+    @param state_space: problem domain
+    @type state_space: C{polytope.Polytope} or C{polytope.Region}
+    
+    @param cont_props_dict: propositions
+    @type cont_props_dict: dict of C{polytope.Polytope}
+        or C{polytope.Region}
+    
+    @param abs_tol: a cell is cut only if both pieces
+        extend further than C{abs_tol} from the hyperplane
+    
+    @return: state space partition induced by propositions,
+        into convex polytopes
+    @rtype: L{PropPreservingPartition}
+    """
+    hyperplanes = _Hyperplanes(abs_tol)
+    
+    # facets of proposition polytopes
+    pieces = []
+    for prop in sorted(cont_props_dict):
+        region = cont_props_dict[prop]
+        polys = list(region) if len(region) > 0 else [region]
+        for p in polys:
+            if not pc.is_fulldim(p):
+                continue
+            p = pc.reduce(p)
+            facets = [hyperplanes.add(a, b)
+                      for a, b in zip(p.A, p.b.flatten())]
+            box = bounding_box(p)
+            pieces.append((prop, facets, box))
+    
+    domains = list(state_space) if len(state_space) > 0 else [state_space]
+    domains = [p for p in domains if pc.is_fulldim(p)]
+    cells = [_Cell(p.A, p.b.flatten(), bounding_box(p)) for p in domains]
+    for i, j in itertools.combinations(xrange(len(cells)), 2):
+        if pc.is_adjacent(domains[i], domains[j]):
+            cells[i].neighbors.add(j)
+            cells[j].neighbors.add(i)
+    
+    for prop, facets, (l, u) in pieces:
+        lower = np.array([c.lower for c in cells])
+        upper = np.array([c.upper for c in cells])
+        # cells whose bounding box meets that of the polytope
+        meet = np.all((lower <= u + abs_tol) & (upper >= l - abs_tol),
+                      axis=1)
+        stack = [(i, 0) for i in np.flatnonzero(meet)]
+        while stack:
+            i, k = stack.pop()
+            if k == len(facets):
+                cells[i].props.add(prop)
+                continue
+            h, side = facets[k]
+            sign = _side(cells, i, hyperplanes, h, abs_tol)
+            if sign == 0:
+                j = _cut(cells, i, hyperplanes, h, abs_tol)
+                stack.append((j, k))
+                sign = cells[i].signs[h]
+            if sign == side:
+                stack.append((i, k + 1))
+    
+    n = len(cells)
+    adj = sp.lil_matrix((n, n), dtype=np.int8)
+    regions = []
+    for i, cell in enumerate(cells):
+        poly = pc.reduce(pc.Polytope(cell.A, cell.b))
+        regions.append(pc.Region([poly], cell.props))
+        adj[i, i] = 1
+        for j in cell.neighbors:
+            adj[i, j] = 1
+    logger.info('prop2part_arrangement: ' + str(n) + ' cells, ' +
+                str(len(hyperplanes)) + ' hyperplanes')
+    
+    return PropPreservingPartition(
+        domain=copy.deepcopy(state_space),
+        regions=regions,
+        adj=adj,
+        prop_regions=copy.deepcopy(cont_props_dict),
+        check=False
+    )
+
+class _Hyperplanes(object):
+    """Hyperplanes C{a'x = b} without duplicates, normalized.
+    
+    Parallel facets with the same offset,
+    possibly of opposite orientation, share a hyperplane.
+    """
+    def __init__(self, abs_tol):
+        self.abs_tol = abs_tol
+        self.a = []
+        self.b = []
+        self._index = dict()
+    
+    def __len__(self):
+        return len(self.a)
+    
+    def add(self, a, b):
+        """Return C{(h, side)} for the facet C{a'x <= b}.
+        
+        C{h} indexes the hyperplane, and C{side} is -1 if
+        the facet is the half-space C{a_h'x <= b_h}, 1 otherwise.
+        """
+        a = np.asarray(a, dtype=float).flatten()
+        norm = np.linalg.norm(a)
+        a = a / norm
+        b = float(b) / norm
+        # orientation: first nonzero coordinate positive
+        side = -1
+        if a[np.flatnonzero(np.abs(a) > self.abs_tol)[0]] < 0:
+            a, b, side = -a, -b, 1
+        key = tuple(np.round(np.hstack([a, b]) / (10 * self.abs_tol)))
+        try:
+            h = self._index[key]
+        except KeyError:
+            h = len(self.a)
+            self.a.append(a)
+            self.b.append(b)
+            self._index[key] = h
+        return h, side
+
+class _Cell(object):
+    """Convex cell C{A x <= b} of L{prop2part_arrangement}.
+    
+      - C{signs}: maps hyperplane to the side of the cell
+      - C{lower, upper}: box that contains the cell
+      - C{neighbors}: indices of adjacent cells
+    """
+    __slots__ = ('A', 'b', 'signs', 'props', 'lower', 'upper', 'neighbors')
+    
+    def __init__(self, A, b, box):
+        self.A = A
+        self.b = b
+        self.signs = dict()
+        self.props = set()
+        self.lower, self.upper = box
+        self.neighbors = set()
+    
+    def copy(self):
+        other = _Cell(self.A, self.b, (self.lower.copy(), self.upper.copy()))
+        other.signs = self.signs.copy()
+        other.props = self.props.copy()
+        return other
+
+def _side(cells, i, hyperplanes, h, abs_tol):
+    """Return side of hyperplane C{h} where cell C{i} lies, 0 if both."""
+    cell = cells[i]
+    try:
+        return cell.signs[h]
+    except KeyError:
+        pass
+    a = hyperplanes.a[h]
+    b = hyperplanes.b[h]
+    extent = _extent(cell.A, cell.b, a)
+    if extent is None:
+        raise Exception('prop2part_arrangement: empty cell')
+    lo, hi = extent
+    if hi <= b + abs_tol:
+        sign = -1
+    elif lo >= b - abs_tol:
+        sign = 1
+    else:
+        return 0
+    cell.signs[h] = sign
+    return sign
+
+def _cut(cells, i, hyperplanes, h, abs_tol):
+    """Cut cell C{i} by hyperplane C{h}, return index of new cell.
+    
+    Cell C{i} keeps the side C{a'x <= b}.
+    """
+    a = hyperplanes.a[h]
+    b = hyperplanes.b[h]
+    cell = cells[i]
+    other = cell.copy()
+    j = len(cells)
+    cells.append(other)
+    
+    # neighbors touch the pieces that their common facet meets
+    neighbors = cell.neighbors
+    cell.neighbors = set([j])
+    other.neighbors = set([i])
+    for k in neighbors:
+        near = cells[k]
+        extent = _extent(np.vstack([cell.A, near.A]),
+                         np.hstack([cell.b, near.b]), a)
+        near.neighbors.discard(i)
+        if extent is None:
+            continue
+        lo, hi = extent
+        if lo < b - abs_tol:
+            cell.neighbors.add(k)
+            near.neighbors.add(i)
+        if hi > b + abs_tol:
+            other.neighbors.add(k)
+            near.neighbors.add(j)
+    
+    cell.A = np.vstack([cell.A, a])
+    cell.b = np.hstack([cell.b, b])
+    cell.signs[h] = -1
+    other.A = np.vstack([other.A, -a])
+    other.b = np.hstack([other.b, -b])
+    other.signs[h] = 1
+    
+    # axis-aligned cuts tighten the bounding boxes
+    axis = np.argmax(np.abs(a))
+    if np.abs(a[axis]) > 1 - abs_tol:
+        cell.upper[axis] = min(cell.upper[axis], b / a[axis])
+        other.lower[axis] = max(other.lower[axis], b / a[axis])
+    return j
+
+def _extent(A, b, a):
+    """Return min and max of C{a'x} over C{A x <= b}, or C{None}."""
+    G = matrix(A)
+    h = matrix(b)
+    bounds = []
+    for c in (a, -a):
+        sol = solvers.lp(matrix(c), G, h, solver=_lp_solver)
+        if sol['status'] != 'optimal':
+            return None
+        bounds.append(sol['primal objective'])
+    return bounds[0], -bounds[1]
+
 def pwa_partition(pwa_sys, ppp, abs_tol=1e-5):
     """This function takes:
     
@@ -225,8 +488,10 @@ def pwa_partition(pwa_sys, ppp, abs_tol=1e-5):
     new_list = []
     subsys_list = []
     parents = []
+    index = RegionIndex(ppp.regions)
     for i, subsys in enumerate(pwa_sys.list_subsys):
-        for j, region in enumerate(ppp.regions):
+        for j in index.query(subsys.domain):
+            region = ppp.regions[j]
             isect = region.intersect(subsys.domain)
             
             if pc.is_fulldim(isect):
@@ -256,9 +521,13 @@ def pwa_partition(pwa_sys, ppp, abs_tol=1e-5):
     # compute spatial adjacency matrix
     n = len(new_list)
     adj = sp.lil_matrix((n, n), dtype=np.int8)
+    index = RegionIndex(new_list)
     for i, ri in enumerate(new_list):
         pi = parents[i]
-        for j, rj in enumerate(new_list[0:i]):
+        for j in index.query(ri):
+            if j >= i:
+                break
+            rj = new_list[j]
             pj = parents[j]
             
             if (ppp.adj[pi, pj] == 1) or (pi == pj):
@@ -307,9 +576,11 @@ def pwa_shrunk_partition(pwa_sys, ppp, eps, abs_tol=1e-5):
     new_list = []
     subsys_list = []
     parents = []
+    index = RegionIndex(ppp.regions)
     for i, subsys in enumerate(pwa_sys.list_subsys):
         dom = shrinkPoly(subsys.domain, eps)
-        for j, region in enumerate(ppp.regions):
+        for j in index.query(dom):
+            region = ppp.regions[j]
             isect = pc.reduce(region.intersect(dom))
             
             if pc.is_fulldim(isect):
@@ -339,9 +610,13 @@ def pwa_shrunk_partition(pwa_sys, ppp, eps, abs_tol=1e-5):
     # compute spatial adjacency matrix
     n = len(new_list)
     adj = sp.lil_matrix((n, n), dtype=np.int8)
+    index = RegionIndex(new_list)
     for i, ri in enumerate(new_list):
         pi = parents[i]
-        for j, rj in enumerate(new_list[0:i]):
+        for j in index.query(ri, 2*eps + 1e-5):
+            if j >= i:
+                break
+            rj = new_list[j]
             pj = parents[j]
             
             if (ppp.adj[pi, pj] == 1) or (pi == pj):
@@ -418,7 +693,7 @@ def add_grid(ppp, grid_size=None, num_grid_pnts=None, abs_tol=1e-10):
                          grid points parameters must be given.")
  
     dim=len(ppp.domain.A[0])
-    domain_bb = ppp.domain.bounding_box
+    domain_bb = bounding_box(ppp.domain)
     size_list=list()
     if grid_size!=None:
         if isinstance( grid_size, list ):
@@ -459,38 +734,46 @@ def add_grid(ppp, grid_size=None, num_grid_pnts=None, abs_tol=1e-10):
             raise Exception("add_grid: "
                 "num_grid_pnts isn't given in a correct format.")
     
-    j=0
-    list_grid=dict()
-    
-    while j<dim:
-        list_grid[j] = compute_interval(
-            float(domain_bb[0][j]),
-            float(domain_bb[1][j]),
-            size_list[j],
+    # grid intervals of each dimension
+    edges = [
+        np.array(compute_interval(
+            float(domain_bb[0][i]),
+            float(domain_bb[1][i]),
+            size_list[i],
             abs_tol
-        )
-        if j>0:
-            if j==1:
-                re_list=list_grid[j-1]
-                re_list=product_interval(re_list, list_grid[j])
+        ), dtype=float)
+        for i in xrange(dim)
+    ]
+    shape = tuple(len(e) for e in edges)
+    
+    # only the grid boxes that meet the bounding box of a region
+    cells = []
+    for j, region in enumerate(ppp.regions):
+        bbox = bounding_box(region)
+        if bbox is None:
+            continue
+        l, u = bbox
+        ranges = [
+            np.flatnonzero((e[:, 0] <= u[i] + abs_tol) &
+                           (e[:, 1] >= l[i] - abs_tol))
+            for i, e in enumerate(edges)
+        ]
+        idx = np.array(list(itertools.product(*ranges)), dtype=int)
+        if idx.size == 0:
+            continue
+        idx = idx.reshape(-1, dim)
+        lower = np.column_stack([edges[i][idx[:, i], 0] for i in xrange(dim)])
+        upper = np.column_stack([edges[i][idx[:, i], 1] for i in xrange(dim)])
+        inside, outside = _boxes_vs_region(region, lower, upper, abs_tol)
+        box_ids = np.ravel_multi_index(idx.T, shape)
+        for k in np.flatnonzero(~outside):
+            box = np.column_stack([lower[k], upper[k]])
+            if inside[k]:
+                isect = pc.box2poly(box)
+                rc = np.min(upper[k] - lower[k]) / 2.
             else:
-                re_list=product_interval(re_list, list_grid[j])
-        j+=1
-        
-    new_list = []
-    parent = []
-    for i in xrange(len(re_list)):
-        temp_list=list()
-        j=0
-        while j<dim*2:
-            temp_list.append([re_list[i][j],re_list[i][j+1]])
-            j=j+2
-        for j in xrange(len(ppp.regions)):
-            tmp = pc.box2poly(temp_list)
-            isect = tmp.intersect(ppp.regions[j], abs_tol)
-            
-            #if pc.is_fulldim(isect):
-            rc, xc = pc.cheby_ball(isect)
+                isect = pc.box2poly(box).intersect(region, abs_tol)
+                rc, xc = pc.cheby_ball(isect)
             if rc > abs_tol/2:
                 if rc < abs_tol:
                     print("Warning: "
@@ -498,27 +781,75 @@ def add_grid(ppp, grid_size=None, num_grid_pnts=None, abs_tol=1e-10):
                         ", this may cause numerical problems")
                 if len(isect) == 0:
                     isect = pc.Region([isect], [])
-                isect.props = ppp.regions[j].props.copy()
-                new_list.append(isect)
-                parent.append(j)   
+                isect.props = region.props.copy()
+                cells.append((box_ids[k], j, inside[k], isect))
     
+    # in order of grid boxes, then of regions
+    cells.sort(key=lambda c: c[:2])
+    new_list = [isect for box_id, j, full, isect in cells]
+    parent = [j for box_id, j, full, isect in cells]
+    
+    # neighbors are in the same or adjacent grid boxes
+    by_box = dict()
+    for i, (box_id, j, full, isect) in enumerate(cells):
+        by_box.setdefault(box_id, []).append(i)
+    offsets = np.array(list(itertools.product([-1, 0, 1], repeat=dim)))
     adj = sp.lil_matrix((len(new_list), len(new_list)), dtype=np.int8)
-    for i in xrange(len(new_list)):
+    for i, (box_id, pi, full_i, isect_i) in enumerate(cells):
         adj[i,i] = 1
-        for j in xrange(i+1, len(new_list)):
-            if (ppp.adj[parent[i], parent[j]] == 1) or \
-                    (parent[i] == parent[j]):
-                if pc.is_adjacent(new_list[i], new_list[j]):
+        near = np.array(np.unravel_index(box_id, shape)) + offsets
+        near = near[np.all((near >= 0) & (near < shape), axis=1)]
+        for other in np.ravel_multi_index(near.T, shape):
+            for j in by_box.get(other, []):
+                if j <= i:
+                    continue
+                box_j, pj, full_j, isect_j = cells[j]
+                if full_i and full_j and box_j != box_id:
+                    # whole grid boxes that touch
+                    adjacent = True
+                elif (ppp.adj[pi, pj] == 1) or (pi == pj):
+                    adjacent = pc.is_adjacent(isect_i, isect_j)
+                else:
+                    adjacent = False
+                if adjacent:
                     adj[i,j] = 1
                     adj[j,i] = 1
-            
+    
+    # cells are subsets of the regions of ppp by construction
     return PropPreservingPartition(
         domain = ppp.domain,
         regions = new_list,
         adj = adj,
-        prop_regions = ppp.prop_regions
+        prop_regions = ppp.prop_regions,
+        check = False
     )
 
+def _boxes_vs_region(region, lower, upper, abs_tol):
+    """Compare boxes C{[lower[k], upper[k]]} to C{region}.
+    
+    @return: C{(inside, outside)} boolean arrays:
+        box contained in a polytope of C{region}, and
+        box meeting C{region} in a set of Chebyshev radius
+        less than C{abs_tol / 2}
+    @rtype: 2-tuple of 1d arrays
+    """
+    polys = list(region) if len(region) > 0 else [region]
+    inside = np.zeros(len(lower), dtype=bool)
+    outside = np.ones(len(lower), dtype=bool)
+    for p in polys:
+        norm = np.sqrt(np.sum(p.A * p.A, axis=1))
+        A = p.A / norm[:, np.newaxis]
+        b = p.b.flatten() / norm
+        Ap = np.maximum(A, 0)
+        An = np.minimum(A, 0)
+        # min and max of each row over each box
+        lo = lower.dot(Ap.T) + upper.dot(An.T)
+        hi = upper.dot(Ap.T) + lower.dot(An.T)
+        inside |= np.all(hi <= b + abs_tol, axis=1)
+        # within a slab of width abs_tol / 2 of a facet, or beyond
+        outside &= np.any(lo >= b - abs_tol / 2., axis=1)
+    return inside, outside & ~inside
+
 #### Helper functions ####
 def compute_interval(low_domain, high_domain, size, abs_tol=1e-7):
     """Helper implementing intervals computation for each dimension.
@@ -747,6 +1078,467 @@ class PPP(PropPreservingPartition):
     def __init__(self, **args):
         PropPreservingPartition.__init__(self, **args)
 
+class PackedPartition(object):
+    """Proposition preserving partition stored in a few arrays.
+    
+    Instead of one C{Region} per cell, holding C{Polytope}s
+    with their own arrays, the polytopes of all cells are stacked:
+    
+      - C{A, b}: H-representations of all polytopes,
+        polytope k has rows C{poly_ptr[k]:poly_ptr[k+1]}
+      - C{region_ptr}: region i has polytopes
+        C{region_ptr[i]:region_ptr[i+1]}
+      - C{lower, upper}: bounding box of each polytope
+      - C{props}: bitset of the propositions of each region,
+        bit j is C{prop_names[j]}, see L{props_matrix}
+      - C{adj}: sparse adjacency matrix, as in
+        L{PropPreservingPartition}
+    
+    C{Region}s are created only when indexed, e.g., C{packed[i]},
+    so a C{PackedPartition} can be used where a
+    L{PropPreservingPartition} is iterated over.
+    L{PointLocator} and L{find_discrete_states} use the
+    stacked arrays directly.
+    
+    Example::
+    
+        packed = PackedPartition.from_partition(ppp)
+        packed.save('part.npz')
+        ppp = PackedPartition.load('part.npz').to_partition()
+    
+    See Also
+    ========
+    L{PropPreservingPartition}
+    """
+    _arrays = ('A', 'b', 'poly_ptr', 'region_ptr',
+               'lower', 'upper', 'props')
+    
+    def __init__(self, domain=None, prop_regions=None, adj=None,
+                 prop_names=None, **arrays):
+        for name in self._arrays:
+            setattr(self, name, arrays[name])
+        self.domain = domain
+        self.prop_regions = prop_regions
+        if prop_names is None:
+            prop_names = sorted(prop_regions) if prop_regions else []
+        self.prop_names = list(prop_names)
+        self.adj = adj
+    
+    @classmethod
+    def from_partition(cls, ppp):
+        """Pack the regions of C{ppp}.
+        
+        @type ppp: L{PropPreservingPartition}
+        """
+        prop_regions = ppp.prop_regions
+        if prop_regions:
+            prop_names = sorted(prop_regions)
+        else:
+            prop_names = sorted(set().union(
+                *[r.props for r in ppp.regions]))
+        A, b, poly_ptr, region_ptr = _pack(ppp.regions)
+        lower, upper = _poly_boxes(A, b, poly_ptr)
+        
+        bit = {p:j for j, p in enumerate(prop_names)}
+        holds = np.zeros([len(ppp.regions), len(prop_names)], dtype=bool)
+        for i, region in enumerate(ppp.regions):
+            holds[i, [bit[p] for p in region.props]] = True
+        
+        adj = ppp.adj
+        if adj is not None:
+            adj = sp.csr_matrix(adj)
+        return cls(
+            domain=ppp.domain, prop_regions=prop_regions,
+            adj=adj, prop_names=prop_names,
+            A=A, b=b, poly_ptr=poly_ptr, region_ptr=region_ptr,
+            lower=lower, upper=upper,
+            props=np.packbits(holds, axis=1)
+        )
+    
+    def __len__(self):
+        """Number of regions."""
+        return len(self.region_ptr) - 1
+    
+    def __getitem__(self, i):
+        """Return region C{i} as a C{Region}."""
+        if i < 0:
+            i += len(self)
+        polys = [
+            pc.Polytope(self.A[first:last], self.b[first:last])
+            for first, last in self._poly_rows(i)
+        ]
+        return pc.Region(polys, self.reg2props(i))
+    
+    def __iter__(self):
+        return (self[i] for i in xrange(len(self)))
+    
+    @property
+    def regions(self):
+        """Regions, created on access."""
+        return _LazyRegions(self)
+    
+    def _poly_rows(self, i):
+        """Return row ranges of the polytopes of region C{i}."""
+        first, last = self.region_ptr[i], self.region_ptr[i + 1]
+        return zip(self.poly_ptr[first:last], self.poly_ptr[first+1:last+1])
+    
+    def props_matrix(self):
+        """Return C{M} with C{M[i, j]} if C{prop_names[j]} holds in region i.
+        
+        @rtype: 2d array of bool
+        """
+        n = len(self.prop_names)
+        return np.unpackbits(self.props, axis=1)[:, :n].astype(bool)
+    
+    def reg2props(self, i):
+        """Return set of propositions that hold in region C{i}."""
+        holds = np.unpackbits(self.props[i])
+        return {p for p, h in zip(self.prop_names, holds) if h}
+    
+    def region_boxes(self):
+        """Return bounding boxes of regions.
+        
+        @return: C{(lower, upper)}, one row per region
+        """
+        first = self.region_ptr[:-1]
+        if len(self.lower) == 0:
+            return self.lower, self.upper
+        # regions without polytopes have empty boxes
+        empty = first == self.region_ptr[1:]
+        idx = np.minimum(first, len(self.lower) - 1)
+        lower = np.minimum.reduceat(self.lower, idx, axis=0)
+        upper = np.maximum.reduceat(self.upper, idx, axis=0)
+        lower[empty] = np.inf
+        upper[empty] = -np.inf
+        return lower, upper
+    
+    def compute_adjacency(self, abs_tol=pc.polytope.ABS_TOL):
+        """Set and return C{adj}, as C{pc.find_adjacent_regions}.
+        
+        Only pairs of polytopes with overlapping bounding boxes
+        are tested, found by sweeping along the first axis,
+        and pairs of boxes need no LP.
+        """
+        n = len(self)
+        owner = np.repeat(np.arange(n), np.diff(self.region_ptr))
+        box = _is_box(self.A, self.poly_ptr)
+        pairs = []
+        # sweep along the first axis, in chunks of sorted boxes
+        lower, upper = self.lower, self.upper
+        order = np.argsort(lower[:, 0], kind='mergesort')
+        sorted_lower = lower[order, 0]
+        width = np.max(upper[:, 0] - lower[:, 0]) if len(order) else 0.
+        chunk = 256
+        for start in xrange(0, len(order), chunk):
+            ks = order[start:start + chunk]
+            first = np.searchsorted(
+                sorted_lower, lower[ks, 0].min() - width - abs_tol, 'left')
+            last = np.searchsorted(
+                sorted_lower, upper[ks, 0].max() + abs_tol, 'right')
+            ms = order[first:last]
+            meet = np.all(
+                (lower[ks, np.newaxis] <= upper[np.newaxis, ms] + abs_tol) &
+                (upper[ks, np.newaxis] >= lower[np.newaxis, ms] - abs_tol),
+                axis=2)
+            k, m = np.nonzero(meet)
+            k, m = ks[k], ms[m]
+            keep = owner[k] < owner[m]
+            k, m = k[keep], m[keep]
+            # boxes that meet are adjacent
+            both = box[k] & box[m]
+            pairs.append(np.column_stack([owner[k[both]], owner[m[both]]]))
+            for k, m in zip(k[~both], m[~both]):
+                rows = [slice(*self._rows(k)), slice(*self._rows(m))]
+                enlarged = pc.Polytope(
+                    np.vstack([self.A[r] for r in rows]),
+                    np.hstack([self.b[r] for r in rows]) + abs_tol)
+                if pc.is_fulldim(enlarged, abs_tol=abs_tol / 10):
+                    pairs.append(np.array([[owner[k], owner[m]]]))
+        pairs = np.vstack(pairs + [np.zeros([0, 2], dtype=int)])
+        i = np.hstack([pairs[:, 0], pairs[:, 1], np.arange(n)])
+        j = np.hstack([pairs[:, 1], pairs[:, 0], np.arange(n)])
+        adj = sp.coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)),
+                            shape=(n, n)).tocsr()
+        # duplicate pairs are summed
+        adj.data[:] = 1
+        self.adj = adj
+        return self.adj
+    
+    def _rows(self, k):
+        return self.poly_ptr[k], self.poly_ptr[k + 1]
+    
+    def to_partition(self):
+        """Return L{PropPreservingPartition} with the same regions."""
+        adj = self.adj
+        if adj is not None:
+            adj = sp.lil_matrix(adj)
+        return PropPreservingPartition(
+            domain=self.domain,
+            regions=list(self),
+            adj=adj,
+            prop_regions=self.prop_regions,
+            check=False
+        )
+    
+    def plot(
+        self, trans=None, ppp2trans=None, only_adjacent=False,
+        ax=None, plot_numbers=True, color_seed=None
+    ):
+        """Plot 2-dimensional regions as one collection of polygons.
+        
+        The arguments are those of L{PropPreservingPartition.plot}.
+        
+        @param trans: transitions to plot as arrows, either
+            a transition system, whose states are mapped to
+            regions by C{ppp2trans}, or a matrix with
+            C{trans[i, j]} nonzero for a transition from
+            region C{i} to region C{j}
+        """
+        try:
+            from tulip.graphics import newax
+            from matplotlib.collections import PolyCollection
+        except:
+            logger.error('failed to import graphics')
+            return
+        if self.A.shape[1] != 2:
+            raise ValueError('PackedPartition.plot: dimension must be 2')
+        
+        if ax is None:
+            ax, fig = newax()
+        
+        box = _is_box(self.A, self.poly_ptr)
+        owner = np.repeat(np.arange(len(self)), np.diff(self.region_ptr))
+        polygons = []
+        for k in xrange(len(self.lower)):
+            l, u = self.lower[k], self.upper[k]
+            if box[k]:
+                polygons.append(np.array(
+                    [[l[0], l[1]], [u[0], l[1]], [u[0], u[1]], [l[0], u[1]]]))
+                continue
+            first, last = self._rows(k)
+            vert = pc.extreme(pc.Polytope(self.A[first:last],
+                                          self.b[first:last]))
+            if vert is None:
+                continue
+            # counterclockwise around the centroid
+            c = vert.mean(axis=0)
+            angle = np.arctan2(vert[:, 1] - c[1], vert[:, 0] - c[0])
+            polygons.append(vert[np.argsort(angle)])
+        
+        rng = np.random.RandomState(color_seed)
+        colors = rng.rand(len(self), 3)
+        ax.add_collection(PolyCollection(
+            polygons, facecolors=colors[owner], edgecolors='k'))
+        
+        lower, upper = self.region_boxes()
+        ok = np.all(np.isfinite(lower), axis=1)
+        ax.set_xlim(lower[ok, 0].min(), upper[ok, 0].max())
+        ax.set_ylim(lower[ok, 1].min(), upper[ok, 1].max())
+        if plot_numbers:
+            for i in np.flatnonzero(ok):
+                c = (lower[i] + upper[i]) / 2.
+                ax.text(c[0], c[1], str(i))
+        if trans is not None:
+            self._plot_transitions(trans, ppp2trans, only_adjacent, ax)
+        return ax
+    
+    def _plot_transitions(self, trans, ppp2trans, only_adjacent, ax):
+        from polytope.plot import plot_transition_arrow
+        
+        if hasattr(trans, 'transitions'):
+            if ppp2trans is None:
+                ppp2trans = range(len(self))
+            trans2ppp = {s:i for i, s in enumerate(ppp2trans)}
+            edges = [(trans2ppp[u], trans2ppp[v])
+                     for u, v in trans.transitions()]
+        else:
+            edges = zip(*sp.coo_matrix(trans).nonzero())
+        
+        lower, upper = self.region_boxes()
+        ok = np.all(np.isfinite(lower), axis=1)
+        arr_size = (upper[ok, 0].max() - lower[ok, 0].min()) / 50.0
+        # each region once, as regions are created on access
+        regions = dict()
+        def region(i):
+            if i not in regions:
+                regions[i] = self[i]
+            return regions[i]
+        
+        for i, j in edges:
+            if i == j:
+                continue
+            if only_adjacent and self.adj[i, j] == 0:
+                continue
+            plot_transition_arrow(region(i), region(j), ax, arr_size)
+    
+    def save(self, path):
+        """Write partition to C{path} in numpy C{.npz} format.
+        
+        The domain and the propositions are saved packed too.
+        Adjacency is saved in compressed sparse rows.
+        """
+        np.savez(path, **self.to_arrays())
+    
+    @classmethod
+    def load(cls, path):
+        """Read partition written by L{save}."""
+        f = np.load(path)
+        try:
+            packed = cls.from_arrays(f)
+        finally:
+            f.close()
+        return packed
+    
+    def to_arrays(self, prefix=''):
+        """Return C{dict} of the arrays that L{save} writes.
+        
+        @param prefix: prepended to the name of each array,
+            to store several partitions in one file
+        @type prefix: C{str}
+        """
+        arrays = {name:getattr(self, name) for name in self._arrays}
+        arrays['prop_names'] = np.array(self.prop_names, dtype=str)
+        if self.domain is not None:
+            for name, x in zip(('A', 'b', 'poly_ptr', 'region_ptr'),
+                               _pack([self.domain])):
+                arrays['domain_' + name] = x
+        if self.prop_regions:
+            for name, x in zip(
+                ('A', 'b', 'poly_ptr', 'region_ptr'),
+                _pack([self.prop_regions[p] for p in self.prop_names])
+            ):
+                arrays['prop_' + name] = x
+        if self.adj is not None:
+            adj = sp.csr_matrix(self.adj)
+            arrays['adj_data'] = adj.data
+            arrays['adj_indices'] = adj.indices
+            arrays['adj_indptr'] = adj.indptr
+        return {prefix + name:x for name, x in arrays.iteritems()}
+    
+    @classmethod
+    def from_arrays(cls, f, prefix=''):
+        """Create partition from arrays returned by L{to_arrays}.
+        
+        The arrays are used as they are, so memory-mapped
+        arrays are not read until needed.
+        
+        @param f: C{dict} or C{NpzFile}
+        @param prefix: as passed to L{to_arrays}
+        """
+        names = set(f.files if hasattr(f, 'files') else f)
+        get = lambda name: f[prefix + name]
+        arrays = {name:get(name) for name in cls._arrays}
+        prop_names = [str(p) for p in get('prop_names')]
+        domain = None
+        if prefix + 'domain_A' in names:
+            (domain,) = _unpack(
+                *[get('domain_' + name)
+                  for name in ('A', 'b', 'poly_ptr', 'region_ptr')])
+        prop_regions = None
+        if prefix + 'prop_A' in names:
+            props = _unpack(
+                *[get('prop_' + name)
+                  for name in ('A', 'b', 'poly_ptr', 'region_ptr')])
+            prop_regions = dict(zip(prop_names, props))
+        adj = None
+        if prefix + 'adj_data' in names:
+            n = len(arrays['region_ptr']) - 1
+            adj = sp.csr_matrix(
+                (get('adj_data'), get('adj_indices'), get('adj_indptr')),
+                shape=(n, n))
+        return cls(domain=domain, prop_regions=prop_regions, adj=adj,
+                   prop_names=prop_names, **arrays)
+
+class _LazyRegions(object):
+    """Sequence of the regions of a L{PackedPartition}."""
+    def __init__(self, packed):
+        self._packed = packed
+    
+    def __len__(self):
+        return len(self._packed)
+    
+    def __getitem__(self, i):
+        return self._packed[i]
+    
+    def __iter__(self):
+        return iter(self._packed)
+
+def _pack(regions):
+    """Return stacked C{A, b, poly_ptr, region_ptr} of C{regions}.
+    
+    @type regions: list of C{Polytope} or C{Region}
+    """
+    A = []
+    b = []
+    poly_ptr = [0]
+    region_ptr = [0]
+    for region in regions:
+        polys = list(region) if len(region) > 0 else [region]
+        for p in polys:
+            A.append(p.A)
+            b.append(p.b.flatten())
+            poly_ptr.append(poly_ptr[-1] + p.A.shape[0])
+        region_ptr.append(len(poly_ptr) - 1)
+    if A:
+        A = np.vstack(A).astype(float)
+        b = np.hstack(b).astype(float)
+    else:
+        A = np.zeros([0, 0])
+        b = np.zeros(0)
+    return (A, b, np.array(poly_ptr, dtype=int),
+            np.array(region_ptr, dtype=int))
+
+def _unpack(A, b, poly_ptr, region_ptr):
+    """Return C{Polytope}s or C{Region}s packed by L{_pack}."""
+    regions = []
+    for i in xrange(len(region_ptr) - 1):
+        polys = [
+            pc.Polytope(A[poly_ptr[k]:poly_ptr[k+1]],
+                        b[poly_ptr[k]:poly_ptr[k+1]])
+            for k in xrange(region_ptr[i], region_ptr[i+1])
+        ]
+        if len(polys) == 1:
+            regions.append(polys[0])
+        else:
+            regions.append(pc.Region(polys))
+    return regions
+
+def _is_box(A, poly_ptr):
+    """Return for each polytope if its rows are axis-aligned."""
+    if len(poly_ptr) < 2:
+        return np.zeros(0, dtype=bool)
+    aligned = np.sum(A != 0, axis=1) == 1
+    count = np.add.reduceat(aligned.astype(int), poly_ptr[:-1])
+    return count == np.diff(poly_ptr)
+
+def _poly_boxes(A, b, poly_ptr):
+    """Return bounding boxes of stacked polytopes.
+    
+    Boxes of axis-aligned polytopes are read from C{b},
+    the others are computed with LPs.
+    """
+    n_polys = len(poly_ptr) - 1
+    dim = A.shape[1]
+    lower = np.empty([n_polys, dim])
+    lower.fill(-np.inf)
+    upper = np.empty([n_polys, dim])
+    upper.fill(np.inf)
+    box = _is_box(A, poly_ptr)
+    for k in xrange(n_polys):
+        first, last = poly_ptr[k], poly_ptr[k + 1]
+        if not box[k]:
+            bbox = bounding_box(pc.Polytope(A[first:last], b[first:last]))
+            if bbox is not None:
+                lower[k], upper[k] = bbox
+            continue
+        for a, c in zip(A[first:last], b[first:last]):
+            (i,) = np.flatnonzero(a)
+            if a[i] > 0:
+                upper[k, i] = min(upper[k, i], c / a[i])
+            else:
+                lower[k, i] = max(lower[k, i], c / a[i])
+    return lower, upper
+
 def ppp2ts(part):
     """Derive transition system from proposition preserving partition.
     
@@ -0,0 +1,609 @@
+# Copyright (c) 2015 by California Institute of Technology
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the California Institute of Technology nor
+#    the names of its contributors may be used to endorse or promote
+#    products derived from this software without specific prior
+#    written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL CALTECH
+# OR THE CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+"""
+Spatial index of the regions of a partition.
+
+A L{RegionIndex} stores the bounding boxes of regions
+in a tree, so that the regions that may intersect
+or be adjacent to a given one are found without
+comparing it to every region of the partition.
+Such candidates are then checked with C{polytope} functions,
+e.g., C{pc.is_adjacent}.
+
+A L{PointLocator} finds the regions that contain
+many points, using a grid of bounding boxes.
+
+See Also
+========
+L{prop2partition.PropPreservingPartition}
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import hashlib
+import itertools
+import weakref
+
+import numpy as np
+import polytope as pc
+
+def bounding_box(region):
+    """Return lower and upper corners of the bounding box of C{region}.
+
+    Unlike C{pc.bounding_box}, it handles 1-dimensional
+    polytopes and returns 1d arrays.
+    The result is memoized, see L{geometry}.
+
+    @type region: C{Polytope} or C{Region}
+    @return: C{(lower, upper)},
+        or C{None} if C{region} is not full-dimensional
+    """
+    return geometry(region).bounding_box
+
+def _bounding_box(region):
+    if not pc.is_fulldim(region):
+        return None
+    if region.dim == 1:
+        # polytope.bounding_box does not handle 1d arrays
+        polys = list(region) if len(region) > 0 else [region]
+        l = min(_interval(p)[0] for p in polys)
+        u = max(_interval(p)[1] for p in polys)
+    else:
+        l, u = region.bounding_box
+    l = np.asarray(l, dtype=float).flatten()
+    u = np.asarray(u, dtype=float).flatten()
+    return l, u
+
+def _interval(p):
+    """Return bounds of 1-dimensional C{Polytope}."""
+    a = p.A.flatten()
+    b = p.b.flatten()
+    with np.errstate(divide='ignore'):
+        bounds = b / a
+    l = np.max(bounds[a < 0]) if np.any(a < 0) else -np.inf
+    u = np.min(bounds[a > 0]) if np.any(a > 0) else np.inf
+    return l, u
+
+def geometry(region):
+    """Return the L{RegionGeometry} of C{region}.
+
+    It is kept in the attribute C{_geometry} of C{region},
+    so it is shared by all functions that are passed C{region}
+    and it is dropped together with C{region},
+    e.g., when a cell is split into new regions.
+    It is computed again if C{region} has been assigned
+    other polytopes, or polytopes other arrays, since.
+    Changing these arrays in place is not detected.
+
+    @type region: C{Polytope} or C{Region}
+    @rtype: L{RegionGeometry}
+    """
+    g = region.__dict__.get('_geometry')
+    if g is None or not g.is_of(region):
+        g = RegionGeometry(region)
+        region._geometry = g
+    return g
+
+class RegionGeometry(object):
+    """Geometric properties of a region, each computed once.
+
+    Since the properties are stored here, not in C{region},
+    copies of C{region} that share its polytopes
+    do not share them.
+    They are not pickled, so they are computed again
+    after a region is loaded.
+
+    See Also
+    ========
+    L{geometry}
+    """
+    def __init__(self, region):
+        self._signature = _signature(region)
+        self._region = weakref.ref(region)
+        self._values = dict()
+
+    def is_of(self, region):
+        """Return C{True} if C{region} has not changed since."""
+        sig = self._signature
+        if sig is None:
+            return False
+        other = _signature(region)
+        return len(sig) == len(other) and all(
+            x is y for x, y in zip(sig, other))
+
+    def __getstate__(self):
+        return {'_signature':None, '_region':None, '_values':dict()}
+
+    def _get(self, name, f):
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
+        region = self._region()
+        if region is None:
+            raise ValueError('region no longer exists')
+        value = f(region)
+        self._values[name] = value
+        return value
+
+    @property
+    def bounding_box(self):
+        """See L{spatial.bounding_box}."""
+        return self._get('bounding_box', _bounding_box)
+
+    @property
+    def is_fulldim(self):
+        """See C{pc.is_fulldim}."""
+        return self._get('is_fulldim', pc.is_fulldim)
+
+    @property
+    def volume(self):
+        """See C{pc.volume}.
+
+        The estimate is random, so memoizing it
+        also makes it the same in each use.
+        """
+        return self._get('volume', pc.volume)
+
+    @property
+    def cheby_ball(self):
+        """Chebyshev radius and center, see C{pc.cheby_ball}."""
+        return self._get('cheby_ball', pc.cheby_ball)
+
+    @property
+    def extreme(self):
+        """Vertices of all polytopes, one per row."""
+        return self._get('extreme', _extreme)
+
+    @property
+    def hull(self):
+        """Convex hull, as C{Polytope}."""
+        return self._get('hull', lambda r: pc.qhull(self.extreme))
+
+    @property
+    def reduced(self):
+        """Minimal representation, see C{pc.reduce}."""
+        return self._get('reduced', pc.reduce)
+
+    @property
+    def digest(self):
+        """Digest of the H-representation, as C{str}."""
+        return self._get('digest', _digest)
+
+def _polytopes(region):
+    if isinstance(region, pc.Region):
+        return region.list_poly
+    return [region]
+
+def _signature(region):
+    """Return the objects that a L{RegionGeometry} depends on."""
+    if not isinstance(region, pc.Region):
+        return [region.A, region.b]
+    sig = []
+    for p in region.list_poly:
+        sig.extend([p, p.A, p.b])
+    return sig
+
+def _extreme(region):
+    vert = [pc.extreme(p) for p in _polytopes(region)]
+    vert = [v for v in vert if v is not None]
+    if not vert:
+        return None
+    return np.vstack(vert)
+
+def _digest(region):
+    h = hashlib.sha1()
+    for p in _polytopes(region):
+        for x in (p.A, p.b):
+            x = np.ascontiguousarray(x, dtype=float)
+            h.update(repr(x.shape))
+            h.update(x.tostring())
+    return h.hexdigest()
+
+class _Node(object):
+    """Node of L{RegionIndex}.
+
+    Leaves have C{items}, a list of C{(key, lower, upper)},
+    other nodes have C{children}.
+    """
+    __slots__ = ('lower', 'upper', 'items', 'children', 'parent')
+
+    def __init__(self, parent=None):
+        self.lower = None
+        self.upper = None
+        self.items = None
+        self.children = None
+        self.parent = parent
+
+    def boxes(self):
+        if self.items is not None:
+            return [(l, u) for key, l, u in self.items]
+        return [(c.lower, c.upper) for c in self.children]
+
+    def refit(self):
+        boxes = self.boxes()
+        if not boxes:
+            self.lower = None
+            self.upper = None
+            return
+        self.lower = np.min([l for l, u in boxes], axis=0)
+        self.upper = np.max([u for l, u in boxes], axis=0)
+
+class RegionIndex(object):
+    """Bounding box tree of regions, keyed by index.
+
+    Leaves hold up to C{leaf_size} bounding boxes.
+    A full leaf is split at the median of the box centers
+    along the axis with the largest spread.
+    When built from a list of regions, the tree is balanced,
+    so L{query} visits O(log n) nodes
+    besides those that overlap the query box.
+
+    Regions that are not full-dimensional are
+    recorded but never returned by L{query}.
+
+    Example: update the index when region C{i} is split::
+
+        index = RegionIndex(regions)
+        ...
+        regions[i] = piece
+        index.update(i, piece)
+        regions.append(other_piece)
+        index.insert(len(regions) - 1, other_piece)
+    """
+    def __init__(self, regions=None, leaf_size=8):
+        """Index C{regions[i]} under key C{i}.
+
+        @type regions: list of C{Region} or C{Polytope}
+        @param leaf_size: number of boxes in a leaf
+        @type leaf_size: int >= 2
+        """
+        self.leaf_size = leaf_size
+        self._leaf = dict()
+        self._root = _Node()
+        self._root.items = []
+
+        if not regions:
+            return
+        items = []
+        for key, region in enumerate(regions):
+            box = bounding_box(region)
+            if box is None:
+                self._leaf[key] = None
+                continue
+            items.append((key, box[0], box[1]))
+        self._build(self._root, items)
+
+    def __len__(self):
+        return len(self._leaf)
+
+    def __contains__(self, key):
+        return key in self._leaf
+
+    def insert(self, key, region):
+        """Add C{region} under C{key}, which must be new."""
+        if key in self._leaf:
+            raise ValueError('key already in index: ' + str(key))
+        box = bounding_box(region)
+        if box is None:
+            self._leaf[key] = None
+            return
+        lower, upper = box
+
+        node = self._root
+        while node.children is not None:
+            node = min(node.children,
+                       key=lambda c: _enlargement(c, lower, upper))
+        node.items.append((key, lower, upper))
+        self._leaf[key] = node
+
+        if len(node.items) > self.leaf_size:
+            self._build(node, node.items)
+        self._refit_up(node)
+
+    def remove(self, key):
+        """Remove the region stored under C{key}."""
+        node = self._leaf.pop(key)
+        if node is None:
+            return
+        node.items = [x for x in node.items if x[0] != key]
+
+        # drop empty leaf, collapse parent with single child
+        if not node.items and node.parent is not None:
+            parent = node.parent
+            parent.children.remove(node)
+            if len(parent.children) == 1:
+                child = parent.children[0]
+                parent.items = child.items
+                parent.children = child.children
+                if parent.items is not None:
+                    for x in parent.items:
+                        self._leaf[x[0]] = parent
+                else:
+                    for c in parent.children:
+                        c.parent = parent
+            node = parent
+        self._refit_up(node)
+
+    def update(self, key, region):
+        """Replace the region stored under C{key}."""
+        self.remove(key)
+        self.insert(key, region)
+
+    def query(self, region, abs_tol=1e-5):
+        """Return keys of regions whose bounding boxes meet that of C{region}.
+
+        Boxes are enlarged by C{abs_tol}, which exceeds
+        the default tolerance of C{pc.is_adjacent},
+        so all regions adjacent to C{region} are returned.
+
+        @type region: C{Region} or C{Polytope}
+        @return: sorted keys
+        @rtype: list
+        """
+        box = bounding_box(region)
+        if box is None:
+            return []
+        return self.query_box(box[0], box[1], abs_tol)
+
+    def query_box(self, lower, upper, abs_tol=0.):
+        """Return keys of regions whose bounding boxes meet a box.
+
+        @param lower, upper: corners of box
+        @type lower, upper: 1d arrays
+        @return: sorted keys
+        @rtype: list
+        """
+        lower = np.asarray(lower, dtype=float).flatten() - abs_tol
+        upper = np.asarray(upper, dtype=float).flatten() + abs_tol
+        keys = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node.lower is None or \
+                    not _overlap(node.lower, node.upper, lower, upper):
+                continue
+            if node.children is not None:
+                stack.extend(node.children)
+                continue
+            for key, l, u in node.items:
+                if _overlap(l, u, lower, upper):
+                    keys.append(key)
+        keys.sort()
+        return keys
+
+    def _build(self, node, items):
+        """Make C{node} the root of a balanced subtree of C{items}."""
+        if len(items) <= self.leaf_size:
+            node.items = list(items)
+            node.children = None
+            for x in items:
+                self._leaf[x[0]] = node
+            node.refit()
+            return
+
+        centers = np.array([l + u for key, l, u in items])
+        axis = np.argmax(centers.max(axis=0) - centers.min(axis=0))
+        order = np.argsort(centers[:, axis], kind='mergesort')
+        half = len(items) // 2
+
+        node.items = None
+        node.children = []
+        for part in (order[:half], order[half:]):
+            child = _Node(node)
+            self._build(child, [items[k] for k in part])
+            node.children.append(child)
+        node.refit()
+
+    def _refit_up(self, node):
+        while node is not None:
+            node.refit()
+            node = node.parent
+
+def _overlap(l1, u1, l2, u2):
+    return np.all(l1 <= u2) and np.all(l2 <= u1)
+
+def _enlargement(node, lower, upper):
+    """Increase of the sum of side lengths of C{node} to contain a box."""
+    if node.lower is None:
+        return 0.
+    l = np.minimum(node.lower, lower)
+    u = np.maximum(node.upper, upper)
+    return np.sum(u - l) - np.sum(node.upper - node.lower)
+
+class PointLocator(object):
+    """Find the regions that contain many points at once.
+
+    The H-representations of all polytopes of the regions
+    are stacked in one matrix.
+    The bounding box of the regions is divided into a uniform grid
+    with about as many cells as regions,
+    and each grid cell lists the regions whose bounding boxes meet it.
+    The points in a grid cell are tested against
+    the rows of those regions with a single matrix product.
+
+    Regions and tolerance are as for C{pc.is_inside}:
+    a point belongs to a polytope C{A x <= b} if
+    C{A x - b < abs_tol}.
+    """
+    def __init__(self, regions, abs_tol=1e-7):
+        """Precompute stacked polytopes and grid of C{regions}.
+
+        @type regions: list of C{Region} or C{Polytope},
+            or L{PropPreservingPartition}, or L{PackedPartition},
+            whose arrays are used without creating C{Region}s
+        """
+        self.abs_tol = abs_tol
+        self._cells = dict()
+
+        if hasattr(regions, 'region_ptr'):
+            # PackedPartition
+            self._A = regions.A
+            self._b = regions.b
+            ptr = regions.poly_ptr
+            self._rows = [
+                zip(ptr[first:last], ptr[first+1:last+1])
+                for first, last in zip(regions.region_ptr[:-1],
+                                       regions.region_ptr[1:])
+            ]
+            lower, upper = regions.region_boxes()
+            boxes = [
+                (key, (l, u))
+                for key, (l, u) in enumerate(zip(lower, upper))
+                if np.all(l < u)
+            ]
+        else:
+            regions = list(regions)
+            # rows of polytopes, in order of regions
+            A = []
+            b = []
+            self._rows = []
+            n_rows = 0
+            for region in regions:
+                polys = list(region) if len(region) > 0 else [region]
+                rows = []
+                for p in polys:
+                    m = p.A.shape[0]
+                    A.append(p.A)
+                    b.append(p.b.flatten())
+                    rows.append((n_rows, n_rows + m))
+                    n_rows += m
+                self._rows.append(rows)
+
+            boxes = [(key, bounding_box(region))
+                     for key, region in enumerate(regions)]
+            boxes = [(key, box) for key, box in boxes if box is not None]
+            if boxes:
+                self._A = np.vstack(A).astype(float)
+                self._b = np.hstack(b).astype(float)
+        if not boxes:
+            self.lower = None
+            return
+
+        # uniform grid over all regions
+        self.dim = self._A.shape[1]
+        self.lower = np.min([l for key, (l, u) in boxes], axis=0)
+        self.upper = np.max([u for key, (l, u) in boxes], axis=0)
+        n = max(1, int(np.ceil(
+            (2. * len(boxes)) ** (1. / self.dim))))
+        self.shape = tuple([n] * self.dim)
+        self.size = (self.upper - self.lower) / n
+
+        # regions by grid cell, in increasing order
+        tol = _margin(abs_tol)
+        self._keys = collections.defaultdict(list)
+        for key, (l, u) in boxes:
+            first = self._grid_index(l - tol)
+            last = self._grid_index(u + tol)
+            ranges = [xrange(i, j + 1) for i, j in zip(first, last)]
+            for idx in itertools.product(*ranges):
+                cell_id = np.ravel_multi_index(idx, self.shape)
+                self._keys[cell_id].append(key)
+
+    def locate(self, points):
+        """Return index of first region that contains each point.
+
+        @param points: one point per row
+        @type points: 2d array of shape C{(n_points, dim)}
+        @return: region indices, -1 for points in no region
+        @rtype: 1d array of int
+        """
+        points = np.asarray(points, dtype=float)
+        if self.lower is None:
+            return -np.ones(len(points), dtype=int)
+        points = points.reshape((-1, self.dim))
+        found = -np.ones(points.shape[0], dtype=int)
+        if points.shape[0] == 0:
+            return found
+
+        tol = _margin(self.abs_tol)
+        outside = np.any((points < self.lower - tol) |
+                         (points > self.upper + tol), axis=1)
+        idx = self._grid_index(points)
+        cell_ids = np.ravel_multi_index(idx.T, self.shape)
+        cell_ids[outside] = -1
+
+        order = np.argsort(cell_ids, kind='mergesort')
+        sorted_ids = cell_ids[order]
+        ids, starts = np.unique(sorted_ids, return_index=True)
+        ends = np.append(starts[1:], len(order))
+        for cell_id, start, end in zip(ids, starts, ends):
+            if cell_id < 0:
+                continue
+            cand = self._candidates(cell_id)
+            if cand is None:
+                continue
+            A, b, starts_poly, owners = cand
+            k = order[start:end]
+            test = A.dot(points[k].T) - b[:, np.newaxis] < self.abs_tol
+            inside = np.logical_and.reduceat(test, starts_poly, axis=0)
+            hit = inside.any(axis=0)
+            first = inside.argmax(axis=0)
+            found[k[hit]] = owners[first[hit]]
+        return found
+
+    def _grid_index(self, x):
+        """Return indices of grid cells containing points C{x}."""
+        idx = np.floor((x - self.lower) / self.size).astype(int)
+        return np.clip(idx, 0, np.array(self.shape) - 1)
+
+    def _candidates(self, cell_id):
+        """Return stacked rows of regions meeting a grid cell.
+
+        @return: C{(A, b, starts, owners)} where C{starts}
+            are the first rows of polytopes and C{owners}
+            their region indices, or C{None}
+        """
+        try:
+            return self._cells[cell_id]
+        except KeyError:
+            pass
+        rows = []
+        starts = []
+        owners = []
+        for key in self._keys.get(cell_id, []):
+            for first, last in self._rows[key]:
+                starts.append(len(rows))
+                owners.append(key)
+                rows.extend(xrange(first, last))
+        if rows:
+            cand = (self._A[rows], self._b[rows],
+                    np.array(starts), np.array(owners))
+        else:
+            cand = None
+        self._cells[cell_id] = cand
+        return cand
+
+def _margin(abs_tol):
+    """Enlargement of boxes that contain points within C{abs_tol}."""
+    return max(1e-5, 10 * abs_tol)
@@ -0,0 +1,363 @@
+# Copyright (c) 2015 by California Institute of Technology
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the California Institute of Technology nor
+#    the names of its contributors may be used to endorse or promote
+#    products derived from this software without specific prior
+#    written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL CALTECH
+# OR THE CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+"""
+Binary files of L{AbstractPwa} and L{AbstractSwitched}.
+
+An abstraction file is an uncompressed numpy C{.npz} archive.
+Large data are stored as arrays:
+
+  - partitions packed as in L{PackedPartition}
+  - transitions of C{ts} in compressed sparse rows
+    over the indices of C{ts.states},
+    with an index into a table of edge labels per transition
+  - state labels C{'ap'} as bitsets
+  - index maps, e.g., C{ppp2ts}, C{ppp2pwa}, C{ppp2orig}
+
+Everything else (version, dynamics, discretization parameters,
+names of states and propositions) is a pickled C{dict},
+stored as the C{uint8} array C{'meta'}.
+
+Because the archive is not compressed,
+its arrays can be memory-mapped when loading.
+Partitions are then returned as L{PackedPartition}s
+that read only the regions indexed,
+and C{ts} is rebuilt on first access.
+
+See Also
+========
+L{AbstractPwa.save}, L{AbstractSwitched.save}
+"""
+import logging
+logger = logging.getLogger(__name__)
+import zipfile
+import struct
+import cPickle as pickle
+
+import numpy as np
+
+from tulip import transys as trs
+from .prop2partition import PackedPartition
+
+_FORMAT = 'tulip.abstraction'
+_VERSION = 1
+_LOCAL_HEADER = struct.Struct('<4s5H3I2H')
+
+def save(abstraction, path):
+    """Write C{abstraction} to file C{path}.
+
+    @type abstraction: L{AbstractPwa} or L{AbstractSwitched}
+    @type path: C{str}
+    """
+    # inline import to avoid circular import
+    from .discretization import AbstractPwa, AbstractSwitched
+    arrays = dict()
+    if type(abstraction) is AbstractPwa:
+        meta = _put_pwa(abstraction, arrays, '')
+    elif type(abstraction) is AbstractSwitched:
+        meta = _put_switched(abstraction, arrays)
+    else:
+        raise TypeError(
+            'cannot save abstraction of type: ' +
+            str(type(abstraction)))
+    meta['format'] = _FORMAT
+    meta['version'] = _VERSION
+    meta['type'] = type(abstraction).__name__
+    arrays['meta'] = np.frombuffer(
+        pickle.dumps(meta, pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+    logger.info('saved abstraction to: ' + str(path))
+
+def load(path, mmap=True):
+    """Read abstraction written by L{save}.
+
+    @param mmap: memory-map the arrays,
+        instead of reading them into memory
+    @type mmap: bool
+
+    @rtype: L{AbstractPwa} or L{AbstractSwitched}
+    """
+    arrays = _read_npz(path, mmap)
+    meta = pickle.loads(arrays['meta'].tostring())
+    if meta.get('format') != _FORMAT:
+        raise ValueError('not an abstraction file: ' + str(path))
+    if meta['version'] > _VERSION:
+        raise ValueError(
+            'abstraction file version ' + str(meta['version']) +
+            ' is newer than the supported version ' + str(_VERSION))
+    if meta['type'] == 'AbstractPwa':
+        return _get_pwa(arrays, meta, '')
+    elif meta['type'] == 'AbstractSwitched':
+        return _get_switched(arrays, meta)
+    raise ValueError('unknown abstraction type: ' + str(meta['type']))
+
+def load_partition(path, mmap=True):
+    """Read partition written by L{PackedPartition.save}.
+
+    @param mmap: memory-map the arrays,
+        instead of reading them into memory
+    @type mmap: bool
+
+    @rtype: L{PackedPartition}
+    """
+    return PackedPartition.from_arrays(_read_npz(path, mmap))
+
+def _put_pwa(ab, arrays, prefix):
+    """Add arrays of L{AbstractPwa} C{ab}, return its metadata."""
+    meta = {
+        'pwa':ab.pwa,
+        'disc_params':ab.disc_params,
+        'stats':ab.stats
+    }
+    for name in ('ppp', 'pwa_ppp', 'orig_ppp'):
+        _put_partition(getattr(ab, name), arrays, meta,
+                       prefix + name + '/')
+    for name in ('ppp2ts', '_ppp2pwa', '_ppp2sys', '_ppp2orig'):
+        _put_list(getattr(ab, name), arrays, meta, prefix + name)
+    _put_ts(ab.ts, arrays, meta, prefix + 'ts/')
+    return meta
+
+def _get_pwa(arrays, meta, prefix):
+    # inline import to avoid circular import
+    from .discretization import AbstractPwa
+    ab = AbstractPwa(
+        ppp=_get_partition(arrays, meta, prefix + 'ppp/'),
+        ppp2ts=_get_list(arrays, meta, prefix + 'ppp2ts'),
+        pwa=meta['pwa'],
+        pwa_ppp=_get_partition(arrays, meta, prefix + 'pwa_ppp/'),
+        ppp2pwa=_get_list(arrays, meta, prefix + '_ppp2pwa'),
+        ppp2sys=_get_list(arrays, meta, prefix + '_ppp2sys'),
+        orig_ppp=_get_partition(arrays, meta, prefix + 'orig_ppp/'),
+        ppp2orig=_get_list(arrays, meta, prefix + '_ppp2orig'),
+        disc_params=meta['disc_params'],
+        stats=meta['stats']
+    )
+    ab._ts_loader = _get_ts(arrays, meta, prefix + 'ts/')
+    return ab
+
+def _put_switched(ab, arrays):
+    """Add arrays of L{AbstractSwitched} C{ab}, return its metadata."""
+    modes = list(ab.modes)
+    meta = {'modes':modes}
+    _put_partition(ab.ppp, arrays, meta, 'ppp/')
+    _put_list(ab.ppp2ts, arrays, meta, 'ppp2ts')
+    _put_ts(ab.ts, arrays, meta, 'ts/')
+    for k, mode in enumerate(modes):
+        prefix = 'mode' + str(k) + '/'
+        meta[prefix] = _put_pwa(ab.modes[mode], arrays, prefix)
+        ppp2mode = None
+        if ab.ppp2modes is not None:
+            ppp2mode = ab.ppp2modes[mode]
+        _put_list(ppp2mode, arrays, meta, prefix + 'ppp2mode')
+    meta['has_ppp2modes'] = ab.ppp2modes is not None
+    return meta
+
+def _get_switched(arrays, meta):
+    # inline import to avoid circular import
+    from .discretization import AbstractSwitched
+    modes = dict()
+    ppp2modes = dict()
+    for k, mode in enumerate(meta['modes']):
+        prefix = 'mode' + str(k) + '/'
+        modes[mode] = _get_pwa(arrays, meta[prefix], prefix)
+        ppp2modes[mode] = _get_list(arrays, meta, prefix + 'ppp2mode')
+    if not meta['has_ppp2modes']:
+        ppp2modes = None
+    ab = AbstractSwitched(
+        ppp=_get_partition(arrays, meta, 'ppp/'),
+        ppp2ts=_get_list(arrays, meta, 'ppp2ts'),
+        modes=modes,
+        ppp2modes=ppp2modes
+    )
+    ab._ts_loader = _get_ts(arrays, meta, 'ts/')
+    return ab
+
+def _put_partition(ppp, arrays, meta, prefix):
+    meta[prefix] = ppp is not None
+    if ppp is None:
+        return
+    if not isinstance(ppp, PackedPartition):
+        ppp = PackedPartition.from_partition(ppp)
+    arrays.update(ppp.to_arrays(prefix))
+
+def _get_partition(arrays, meta, prefix):
+    if not meta[prefix]:
+        return None
+    return PackedPartition.from_arrays(arrays, prefix)
+
+def _put_list(x, arrays, meta, name):
+    """Store list C{x} as an array, if it contains only integers.
+
+    Anything else, e.g., C{None} or a C{dict}, is stored in C{meta}.
+    """
+    if isinstance(x, (list, tuple, np.ndarray)) and all(
+        isinstance(y, (int, long, np.integer)) for y in x
+    ):
+        arrays[name] = np.array(x, dtype=int)
+        meta[name] = 'array'
+    else:
+        meta[name] = x
+
+def _get_list(arrays, meta, name):
+    if isinstance(meta[name], str) and meta[name] == 'array':
+        return arrays[name].tolist()
+    return meta[name]
+
+def _put_ts(ts, arrays, meta, prefix):
+    """Store states, state labels and transitions of C{ts}."""
+    if ts is None:
+        meta[prefix] = None
+        return
+    states = list(ts.states)
+    index = {s:i for i, s in enumerate(states)}
+    aps = sorted(ts.atomic_propositions)
+    bit = {p:j for j, p in enumerate(aps)}
+    holds = np.zeros([len(states), len(aps)], dtype=bool)
+    for i, s in enumerate(states):
+        props = ts.states[s].get('ap', set())
+        holds[i, [bit[p] for p in props]] = True
+
+    labels = []
+    label_index = dict()
+    edges = []
+    for u, v, d in ts.transitions(data=True):
+        label = tuple(sorted(d.iteritems()))
+        if label not in label_index:
+            label_index[label] = len(labels)
+            labels.append(label)
+        edges.append((index[u], index[v], label_index[label]))
+    edges.sort()
+    edges = np.array(edges, dtype=int).reshape(-1, 3)
+    indptr = np.searchsorted(edges[:, 0], np.arange(len(states) + 1))
+
+    arrays[prefix + 'indptr'] = indptr
+    arrays[prefix + 'indices'] = edges[:, 1]
+    arrays[prefix + 'label'] = edges[:, 2]
+    arrays[prefix + 'ap'] = np.packbits(holds, axis=1)
+    meta[prefix] = {
+        'type':type(ts),
+        'states':states,
+        'initial':[index[s] for s in ts.states.initial],
+        'atomic_propositions':aps,
+        'sys_actions':list(getattr(ts, 'sys_actions', [])),
+        'env_actions':list(getattr(ts, 'env_actions', [])),
+        'labels':labels
+    }
+
+def _get_ts(arrays, meta, prefix):
+    if meta[prefix] is None:
+        return None
+    return _TsLoader(
+        meta[prefix],
+        *[arrays[prefix + name]
+          for name in ('indptr', 'indices', 'label', 'ap')])
+
+class _TsLoader(object):
+    """Rebuild transition system stored by L{_put_ts}, when called."""
+    def __init__(self, meta, indptr, indices, label, ap):
+        self.meta = meta
+        self.indptr = indptr
+        self.indices = indices
+        self.label = label
+        self.ap = ap
+
+    def __call__(self):
+        meta = self.meta
+        states = meta['states']
+        aps = meta['atomic_propositions']
+        ts = meta['type']()
+        ts.atomic_propositions.add_from(aps)
+        if meta['sys_actions']:
+            ts.sys_actions.add_from(meta['sys_actions'])
+        if meta['env_actions']:
+            ts.env_actions.add_from(meta['env_actions'])
+        ts.states.add_from(states)
+        holds = np.unpackbits(
+            np.asarray(self.ap), axis=1)[:, :len(aps)].astype(bool)
+        for s, row in zip(states, holds):
+            ts.states.add(s, ap={aps[j] for j in np.flatnonzero(row)})
+        ts.states.initial.add_from(
+            [states[i] for i in meta['initial']])
+        labels = [dict(label) for label in meta['labels']]
+        indptr = np.asarray(self.indptr)
+        indices = np.asarray(self.indices)
+        label = np.asarray(self.label)
+        for i, u in enumerate(states):
+            for k in xrange(indptr[i], indptr[i + 1]):
+                ts.transitions.add(u, states[indices[k]],
+                                   attr_dict=labels[label[k]])
+        return ts
+
+def _read_npz(path, mmap):
+    """Return C{dict} of the arrays in the C{.npz} file C{path}.
+
+    If C{mmap}, then the arrays are memory-mapped.
+    This requires the archive to be uncompressed,
+    as written by C{numpy.savez}.
+    """
+    if not mmap:
+        f = np.load(path)
+        try:
+            return {name:f[name] for name in f.files}
+        finally:
+            f.close()
+    arrays = dict()
+    with zipfile.ZipFile(path) as z, open(path, 'rb') as f:
+        for info in z.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(
+                    'cannot memory-map compressed member: ' +
+                    info.filename)
+            f.seek(info.header_offset)
+            header = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+            name_len, extra_len = header[-2:]
+            f.seek(info.header_offset + _LOCAL_HEADER.size +
+                   name_len + extra_len)
+            major, minor = np.lib.format.read_magic(f)
+            if major == 1:
+                shape, fortran, dtype = \
+                    np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = \
+                    np.lib.format.read_array_header_2_0(f)
+            name = info.filename
+            if name.endswith('.npy'):
+                name = name[:-4]
+            if dtype.hasobject:
+                raise ValueError('cannot memory-map object array: ' + name)
+            if 0 in shape:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(
+                path, dtype=dtype, mode='r', offset=f.tell(),
+                shape=shape, order='F' if fortran else 'C')
+    return arrays
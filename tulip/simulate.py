@@ -0,0 +1,518 @@
+# Copyright (c) 2015 by California Institute of Technology
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the California Institute of Technology nor
+#    the names of its contributors may be used to endorse or promote
+#    products derived from this software without specific prior
+#    written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL CALTECH
+# OR THE CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+"""
+Simulation of many trajectories of hybrid systems in lock-step.
+
+The continuous states of all trajectories are stored in one array,
+and each time step is a few matrix products per subsystem,
+instead of one Python loop iteration per trajectory.
+The results are returned as L{Traces}, a struct of arrays
+indexed by trajectory and time.
+
+  - L{simulate}: open loop, or with a given state feedback
+  - L{simulate_closed_loop}: a L{MealyMachine} picks
+    the transitions of an L{AbstractPwa}, and
+    a L{CompiledController} computes the continuous inputs
+
+See Also
+========
+L{hybrid}, L{abstract.find_controller}
+"""
+from __future__ import absolute_import
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import polytope as pc
+
+from tulip.hybrid import LtiSysDyn, PwaSysDyn, SwitchedSysDyn
+from tulip.abstract.spatial import PointLocator, bounding_box
+from tulip.abstract.find_controller import CompiledController
+
+
+class Traces(object):
+    """Trajectories of a simulation, as arrays.
+    
+    The first axis is the trajectory and the second axis is time:
+    
+      - C{x}: continuous states, shape C{(n_traj, n_steps + 1, n)}
+      - C{u}: inputs, shape C{(n_traj, n_steps, m)}
+      - C{d}: disturbances, shape C{(n_traj, n_steps, p)}
+      - C{subsys}: index of the active PWA subsystem
+        at each step, shape C{(n_traj, n_steps)}
+      - C{mode}: index in C{Plant.modes} of the mode
+        at each step, shape C{(n_traj, n_steps)}
+      - C{cell}: index of the partition region
+        that contains each state, shape C{(n_traj, n_steps + 1)}
+      - C{loc}: for L{simulate_closed_loop}, the regions that
+        the controller steers to, shape C{(n_traj, n_transitions + 1)}
+      - C{ok}: C{False} for trajectories that were stopped,
+        shape C{(n_traj,)}
+    
+    Indices are -1 where undefined, e.g., C{cell} for
+    states outside the partition.
+    After a trajectory is stopped, its states and inputs are NaN.
+    """
+    def __init__(self, n_traj, n_steps, n, m, p):
+        self.x = np.empty([n_traj, n_steps + 1, n])
+        self.x.fill(np.nan)
+        self.u = np.empty([n_traj, n_steps, m])
+        self.u.fill(np.nan)
+        self.d = np.zeros([n_traj, n_steps, p])
+        self.subsys = -np.ones([n_traj, n_steps], dtype=int)
+        self.mode = -np.ones([n_traj, n_steps], dtype=int)
+        self.cell = -np.ones([n_traj, n_steps + 1], dtype=int)
+        self.loc = None
+        self.ok = np.ones(n_traj, dtype=bool)
+    
+    def __len__(self):
+        """Number of trajectories."""
+        return self.x.shape[0]
+    
+    @property
+    def n_steps(self):
+        return self.u.shape[1]
+
+class Plant(object):
+    """One-step update of many continuous states at once.
+    
+    Wraps an L{LtiSysDyn}, L{PwaSysDyn} or L{SwitchedSysDyn}.
+    The active subsystem of each state is found with
+    a L{PointLocator} over the subsystem domains.
+    
+    The modes of a L{SwitchedSysDyn} are numbered
+    by their position in C{modes}.
+    """
+    def __init__(self, sys, abs_tol=1e-7):
+        if isinstance(sys, SwitchedSysDyn):
+            self.modes = sorted(sys.dynamics)
+            pwas = [sys.dynamics[mode] for mode in self.modes]
+        elif isinstance(sys, (LtiSysDyn, PwaSysDyn)):
+            self.modes = [None]
+            pwas = [sys]
+        else:
+            raise TypeError(
+                'Plant: `sys` must be LtiSysDyn, PwaSysDyn '
+                'or SwitchedSysDyn, got: ' + str(type(sys)))
+        
+        self._subsys = []
+        self._locators = []
+        for pwa in pwas:
+            if isinstance(pwa, LtiSysDyn):
+                subsys = [pwa]
+            else:
+                subsys = pwa.list_subsys
+            if len(subsys) > 1:
+                locator = PointLocator(
+                    [s.domain for s in subsys], abs_tol)
+            else:
+                locator = None
+            self._subsys.append(subsys)
+            self._locators.append(locator)
+        
+        s = self._subsys[0][0]
+        self.n = s.A.shape[1]
+        self.m = s.B.shape[1]
+        self.p = s.E.shape[1]
+    
+    def subsystems(self, X, modes=None):
+        """Return index of the active subsystem at each state.
+        
+        @param X: continuous states, one per row
+        @param modes: mode index of each state,
+            or C{None} for the first mode
+        @return: subsystem indices, -1 outside all domains
+        @rtype: 1d array of int
+        """
+        X = np.asarray(X, dtype=float).reshape((-1, self.n))
+        modes = self._check_modes(modes, len(X))
+        idx = np.zeros(len(X), dtype=int)
+        finite = np.all(np.isfinite(X), axis=1)
+        idx[~finite] = -1
+        for mode in np.unique(modes[finite]):
+            k = np.flatnonzero(finite & (modes == mode))
+            locator = self._locators[mode]
+            if locator is not None:
+                idx[k] = locator.locate(X[k])
+        return idx
+    
+    def step(self, X, U, modes=None, disturbance=True, rng=None):
+        """Return successors of the states C{X} under inputs C{U}.
+        
+        Disturbances are sampled uniformly from the C{Wset}
+        of the active subsystem, see L{sample_polytope}.
+        States outside the domains of all subsystems
+        have NaN successors.
+        
+        @param X: continuous states, one per row
+        @param U: inputs, one per row
+        @param modes: see L{subsystems}
+        @param disturbance: if C{False}, then the disturbance is zero
+        @param rng: random number generator,
+            default is C{numpy.random}
+        @type rng: C{numpy.random.RandomState}
+        
+        @return: C{(X_next, D, subsys)}
+            successors, disturbances and active subsystems
+        """
+        X = np.asarray(X, dtype=float).reshape((-1, self.n))
+        U = np.asarray(U, dtype=float).reshape((-1, self.m))
+        modes = self._check_modes(modes, len(X))
+        subsys = self.subsystems(X, modes)
+        
+        X_next = np.empty_like(X)
+        X_next.fill(np.nan)
+        D = np.zeros([len(X), self.p])
+        groups = modes * (1 + max(len(s) for s in self._subsys)) + subsys
+        for group in np.unique(groups[subsys >= 0]):
+            k = np.flatnonzero(groups == group)
+            s = self._subsys[modes[k[0]]][subsys[k[0]]]
+            x = X[k].dot(s.A.T) + U[k].dot(s.B.T) + s.K.T
+            if disturbance and _has_disturbance(s):
+                D[k] = sample_polytope(s.Wset, len(k), rng)
+                x += D[k].dot(s.E.T)
+            X_next[k] = x
+        return X_next, D, subsys
+    
+    def _check_modes(self, modes, size):
+        if modes is None:
+            return np.zeros(size, dtype=int)
+        modes = np.asarray(modes, dtype=int).reshape(-1)
+        if modes.size == 1:
+            modes = np.repeat(modes, size)
+        if np.any((modes < 0) | (modes >= len(self.modes))):
+            raise ValueError('Plant: mode index out of range')
+        return modes
+
+def _has_disturbance(s):
+    """Return C{True} if C{s.Wset} is not the empty default."""
+    return s.Wset is not None and s.Wset.A.size > 0 and np.any(s.E)
+
+def sample_polytope(poly, size, rng=None, max_iter=1000):
+    """Return points sampled uniformly from C{poly}.
+    
+    Uses rejection sampling in the bounding box of C{poly}.
+    
+    @type poly: C{Polytope} or C{Region}, full-dimensional
+    @param size: number of points
+    @param rng: random number generator,
+        default is C{numpy.random}
+    @param max_iter: maximal rounds of rejection
+    
+    @return: one point per row
+    @rtype: 2d array of shape C{(size, poly.dim)}
+    """
+    if rng is None:
+        rng = np.random
+    box = bounding_box(poly)
+    if box is None:
+        raise ValueError(
+            'sample_polytope: polytope is not full-dimensional')
+    l, u = box
+    polys = list(poly) if len(poly) > 0 else [poly]
+    points = np.empty([size, len(l)])
+    missing = np.arange(size)
+    for i in xrange(max_iter):
+        if len(missing) == 0:
+            return points
+        x = l + (u - l) * rng.random_sample((len(missing), len(l)))
+        inside = np.zeros(len(x), dtype=bool)
+        for p in polys:
+            inside |= np.all(
+                x.dot(p.A.T) <= p.b.flatten(), axis=1)
+        points[missing[inside]] = x[inside]
+        missing = missing[~inside]
+    raise Exception(
+        'sample_polytope: rejection sampling did not converge')
+
+def simulate(
+    sys, X0, n_steps,
+    inputs=None, modes=None, partition=None,
+    disturbance=True, seed=None
+):
+    """Simulate trajectories from the rows of C{X0}.
+    
+    Inputs and modes can be arrays given in advance,
+    or functions called at each step with the current
+    states, for state feedback::
+    
+        u = lambda t, X, cells: -X.dot(K.T)
+        traces = simulate(sys, X0, 100, inputs=u)
+    
+    @param sys: system dynamics
+    @type sys: L{LtiSysDyn}, L{PwaSysDyn} or L{SwitchedSysDyn},
+        or L{Plant}
+    
+    @param X0: initial continuous states, one per row
+    @type X0: 2d array of shape C{(n_traj, n)}
+    
+    @param n_steps: number of time steps
+    
+    @param inputs: inputs as an array of shape
+        C{(n_traj, n_steps, m)} or C{(n_steps, m)},
+        or a function C{(t, X, cells)} returning
+        an array of shape C{(n_traj, m)}.
+        If C{None}, then the inputs are zero.
+    
+    @param modes: for L{SwitchedSysDyn}, indices in C{Plant.modes},
+        as an array of shape C{(n_traj, n_steps)} or C{(n_steps,)},
+        or a function as for C{inputs}
+    
+    @param partition: regions to locate the states in,
+        recorded as C{Traces.cell}
+    @type partition: L{PropPreservingPartition}
+        or L{PointLocator}
+    
+    @param disturbance: sample disturbances from C{Wset},
+        otherwise zero
+    @param seed: seed of the random number generator
+    
+    @rtype: L{Traces}
+    """
+    plant = sys if isinstance(sys, Plant) else Plant(sys)
+    rng = np.random.RandomState(seed)
+    locator = _locator(partition)
+    
+    X = np.asarray(X0, dtype=float).reshape((-1, plant.n))
+    n_traj = len(X)
+    traces = Traces(n_traj, n_steps, plant.n, plant.m, plant.p)
+    traces.x[:, 0] = X
+    cells = _locate(locator, X)
+    traces.cell[:, 0] = cells
+    for t in xrange(n_steps):
+        U = _at_step(inputs, t, X, cells, n_traj, plant.m)
+        M = _at_step(modes, t, X, cells, n_traj, None)
+        if M is None:
+            M = np.zeros(n_traj, dtype=int)
+        M = M.astype(int)
+        X, D, subsys = plant.step(X, U, M, disturbance, rng)
+        cells = _locate(locator, X)
+        
+        traces.u[:, t] = U
+        traces.d[:, t] = D
+        traces.mode[:, t] = M
+        traces.subsys[:, t] = subsys
+        traces.x[:, t + 1] = X
+        traces.cell[:, t + 1] = cells
+        traces.ok &= subsys >= 0
+    return traces
+
+def _at_step(values, t, X, cells, n_traj, m):
+    """Return rows of C{values} for step C{t}."""
+    if values is None:
+        if m is None:
+            return None
+        return np.zeros([n_traj, m])
+    if callable(values):
+        v = np.asarray(values(t, X, cells))
+    else:
+        v = np.asarray(values)
+        v = v[:, t] if v.ndim == (2 if m is None else 3) else v[t]
+    if m is None:
+        return np.tile(v, n_traj) if v.ndim == 0 else v
+    if v.ndim == 1:
+        v = np.tile(v, (n_traj, 1))
+    return v
+
+def _locator(partition):
+    if partition is None or isinstance(partition, PointLocator):
+        return partition
+    return PointLocator(partition)
+
+def _locate(locator, X):
+    if locator is None:
+        return -np.ones(len(X), dtype=int)
+    cells = -np.ones(len(X), dtype=int)
+    finite = np.all(np.isfinite(X), axis=1)
+    cells[finite] = locator.locate(X[finite])
+    return cells
+
+def simulate_closed_loop(
+    abstraction, mealy, X0, n_transitions,
+    env_inputs=None, loc_var='loc',
+    R=[], r=[], Q=[], mid_weight=0.0,
+    disturbance=True, seed=None
+):
+    """Simulate a discrete controller applied to an abstraction.
+    
+    For each trajectory and each transition:
+    
+      1. C{mealy} reacts to the environment input,
+         and its output C{loc_var} is the next state
+         of C{abstraction.ts}.
+      2. The inputs that steer the plant from the current
+         region to that state are computed
+         as in L{get_input}, for all trajectories with
+         the same transition together.
+      3. The plant is simulated for the horizon
+         C{N} of C{abstraction.disc_params},
+         applying the inputs in open loop.
+    
+    The first reaction is from state C{'Sinit'},
+    choosing the edge whose C{loc_var} labels
+    the region that contains the initial state,
+    as in L{synth.determinize_machine_init}.
+    
+    A trajectory is stopped when the machine has
+    no reaction, no input is found, or the plant
+    is not in the expected region after C{N} steps.
+    
+    @type abstraction: L{AbstractPwa}
+    @param mealy: input-deterministic machine
+        with output C{loc_var}
+    @type mealy: L{MealyMachine}
+    
+    @param X0: initial continuous states, one per row
+    @param n_transitions: number of discrete transitions
+    
+    @param env_inputs: values of the inputs of C{mealy},
+        as a C{dict}, or a function C{(t, X, loc)} returning
+        a list of C{dict}, one per trajectory.
+        If C{None}, then C{{}}.
+    
+    For the cost parameters see L{get_input},
+    and for the others L{simulate}.
+    
+    @return: traces with C{n_transitions * N} steps
+    @rtype: L{Traces}
+    """
+    pwa = abstraction.pwa
+    plant = Plant(pwa)
+    rng = np.random.RandomState(seed)
+    locator = PointLocator(abstraction.ppp)
+    ts2ppp = {s:i for i, s in enumerate(abstraction.ppp2ts)}
+    N = abstraction.disc_params['N']
+    
+    X = np.asarray(X0, dtype=float).reshape((-1, plant.n))
+    n_traj = len(X)
+    traces = Traces(n_traj, n_transitions * N, plant.n, plant.m, plant.p)
+    traces.loc = -np.ones([n_traj, n_transitions + 1], dtype=int)
+    traces.x[:, 0] = X
+    cells = _locate(locator, X)
+    traces.cell[:, 0] = cells
+    
+    controllers = dict()
+    reactions = dict()
+    ok = traces.ok
+    ok &= cells >= 0
+    
+    state = [None] * n_traj
+    loc = -np.ones(n_traj, dtype=int)
+    for t in xrange(n_transitions + 1):
+        env = _env_inputs(env_inputs, t, X, loc, n_traj)
+        for i in np.flatnonzero(ok):
+            if t == 0:
+                key = ('Sinit', abstraction.ppp2ts[cells[i]], env[i])
+            else:
+                key = (state[i], None, env[i])
+            try:
+                next_state, outputs = reactions[key]
+            except KeyError:
+                try:
+                    next_state, outputs = _react(mealy, key, loc_var)
+                except Exception as e:
+                    logger.info('no reaction: ' + str(e))
+                    next_state, outputs = None, None
+                reactions[key] = (next_state, outputs)
+            if next_state is None or outputs[loc_var] not in ts2ppp:
+                ok[i] = False
+                continue
+            state[i] = next_state
+            end = ts2ppp[outputs[loc_var]]
+            traces.loc[i, t] = end
+            loc[i] = end
+        if t == 0:
+            ok &= traces.loc[:, 0] == cells
+            continue
+        
+        # inputs, by transition
+        start = traces.loc[:, t - 1]
+        U = np.zeros([n_traj, N, plant.m])
+        for s, e in set(zip(start[ok], loc[ok])):
+            k = np.flatnonzero(ok & (start == s) & (loc == e))
+            sys_idx, ssys = abstraction.ppp2sys(s)
+            try:
+                ctrl = controllers[sys_idx]
+            except KeyError:
+                ctrl = CompiledController(
+                    ssys, abstraction, R, r, Q, mid_weight,
+                    transitions=[])
+                controllers[sys_idx] = ctrl
+            U[k], feasible = ctrl.step_batch(X[k], s, e)
+            ok[k[~feasible]] = False
+        
+        # continuous evolution
+        for j in xrange(N):
+            step = (t - 1) * N + j
+            X, D, subsys = plant.step(X, U[:, j], None, disturbance, rng)
+            X[~ok] = np.nan
+            traces.u[ok, step] = U[ok, j]
+            traces.d[:, step] = D
+            traces.mode[ok, step] = 0
+            traces.subsys[:, step] = np.where(ok, subsys, -1)
+            traces.x[:, step + 1] = X
+            traces.cell[:, step + 1] = _locate(locator, X)
+        for i in np.flatnonzero(ok & (traces.cell[:, t * N] != loc)):
+            # on a facet shared with another region ?
+            ok[i] = pc.is_inside(abstraction.ppp[loc[i]], X[i])
+        X[~ok] = np.nan
+    return traces
+
+def _env_inputs(env_inputs, t, X, loc, n_traj):
+    """Return hashable environment inputs of each trajectory."""
+    if env_inputs is None:
+        env = [dict()] * n_traj
+    elif isinstance(env_inputs, dict):
+        env = [env_inputs] * n_traj
+    else:
+        env = env_inputs(t, X, loc)
+    return [tuple(sorted(d.iteritems())) for d in env]
+
+def _react(mealy, key, loc_var):
+    """Return next state and outputs of C{mealy} for C{key}.
+    
+    From C{'Sinit'}, the edge is chosen by the value of C{loc_var}.
+    """
+    from_state, init_loc, env = key
+    inputs = dict(env)
+    if init_loc is None:
+        return mealy.reaction(from_state, inputs)
+    for i, j, d in mealy.edges_iter([from_state], data=True):
+        if d.get(loc_var) != init_loc:
+            continue
+        if all(d.get(k) == v for k, v in inputs.iteritems()):
+            outputs = {k:d[k] for k in mealy.outputs if k in d}
+            return j, outputs
+    raise Exception('no initial reaction with ' +
+                    loc_var + ' = ' + str(init_loc))